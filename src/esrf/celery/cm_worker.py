@@ -1,7 +1,6 @@
 import gc
 import os
 import sys
-import json
 import glob
 import time
 import pprint
@@ -17,6 +16,8 @@ import esrf.sp.workflow
 import esrf.tomo.cryo_tomo_workflow
 
 from esrf.utils.esrf_utils_path import UtilsPath
+from esrf.utils.esrf_utils_header import UtilsHeader
+from esrf.utils.esrf_utils_state import UtilsState
 
 user_name = os.environ["USER"]
 host_name = socket.gethostname()
@@ -133,7 +134,7 @@ def set_location(config_dict):
     logger.info(
         "Location of allParams file: {0}".format(config_dict["all_params_json_file"])
     )
-    if os.path.exists(config_dict["all_params_json_file"]):
+    if UtilsState.exists(config_dict["all_params_json_file"]):
         logger.info("Using existing allParams file")
     return location
 
@@ -174,7 +175,7 @@ def set_ispyb_database(config_dict):
 def create_blackfile_list(config_dict):
     logger = logging.getLogger("cm_worker")
     config_dict["blacklistFile"] = None
-    if os.path.exists(config_dict["all_params_json_file"]):
+    if UtilsState.exists(config_dict["all_params_json_file"]):
         # Check how many movies are present on disk
         list_movies = glob.glob(
             os.path.join(config_dict["dataDirectory"], config_dict["filesPattern"])
@@ -311,18 +312,13 @@ def print_config(config_dict):
 
 
 def update_all_params(config_dict):
-    if os.path.exists(config_dict["all_params_json_file"]):
-        with open(config_dict["all_params_json_file"]) as fd:
-            all_params = json.loads(fd.read())
-    else:
-        all_params = {}
-    key = "config_dict_" + time.strftime("%Y%m%d-%H%M%S", time.localtime(time.time()))
-    all_params[key] = config_dict
     os.makedirs(
         os.path.dirname(config_dict["all_params_json_file"]), exist_ok=True, mode=0o755
     )
-    with open(config_dict["all_params_json_file"], "w") as fd:
-        fd.write(json.dumps(all_params, indent=4))
+    all_params = UtilsState.load(config_dict["all_params_json_file"])
+    key = "config_dict_" + time.strftime("%Y%m%d-%H%M%S", time.localtime(time.time()))
+    all_params[key] = config_dict
+    all_params.close()
 
 
 @app.task()
@@ -495,7 +491,11 @@ def extract_meta_data(movie_path, phase_plate_data=False, super_resolution=True)
     config_dict["doPhaseShiftEstimation"] = dictResults["phasePlateUsed"]
     config_dict["magnification"] = int(dictResults["magnification"])
     config_dict["voltage"] = int(dictResults["accelerationVoltage"])
-    config_dict["imagesCount"] = int(dictResults["numberOffractions"])
+    # Number of frames from the movie header, the EPU XML as fallback
+    try:
+        config_dict["imagesCount"] = UtilsHeader.probe(movie_path).frames
+    except (OSError, RuntimeError):
+        config_dict["imagesCount"] = int(dictResults["numberOffractions"])
     config_dict["dataType"] = 1  # "EPU_TIFF"
     config_dict["gainFlip"] = motioncorr.constants.FLIP_LEFTRIGHT
     config_dict["gainRot"] = motioncorr.constants.ROTATE_180
@@ -26,7 +26,6 @@
 # **************************************************************************
 
 import os
-import json
 import time
 import shutil
 import pathlib
@@ -43,6 +42,10 @@ from motioncorr.protocols import ProtMotionCorr
 
 from esrf.utils.esrf_utils_icat import UtilsIcat
 from esrf.utils.esrf_utils_path import UtilsPath
+from esrf.utils.esrf_utils_state import StateWriter, UtilsState
+from esrf.utils.esrf_utils_snapshot import UtilsSnapshot
+from esrf.utils import esrf_utils_tiltseries
+from esrf.utils.esrf_utils_tiltseries import TiltSeriesIndex
 
 # Debug possibility to turn off upload
 DO_UPLOAD = True
@@ -218,17 +221,22 @@ class MonitorESRFIcatTomo(Monitor):
         self.no_ctf_threads = 0
         if hasattr(protocol, "all_params_json_file"):
             self.all_params_json_file = protocol.all_params_json_file.get()
-            if os.path.exists(self.all_params_json_file):
-                try:
-                    dictall_params = json.loads(open(self.all_params_json_file).read())
-                    self.all_params = collections.OrderedDict(dictall_params)
-                except BaseException:
-                    self.all_params = collections.OrderedDict()
-            else:
-                self.all_params = collections.OrderedDict()
+            try:
+                self.all_params = UtilsState.load(self.all_params_json_file)
+            except BaseException as error:
+                self.info(
+                    "ERROR! Couldn't load {0}, starting a new one: {1}".format(
+                        self.all_params_json_file, error
+                    )
+                )
+                self.all_params = UtilsState.create(self.all_params_json_file)
         else:
             self.all_params_json_file = None
-            self.all_params = collections.OrderedDict()
+            self.all_params = UtilsState.load(None)
+        self.ts_index = TiltSeriesIndex.fromAllParams(self.all_params)
+        self.completed_ts = set()
+        self.stateWriter = StateWriter(self.all_params).start()
+        self.stateWriter.installSignalHandlers()
 
     def step(self):
         self.info("MonitorISPyB: start step ------------------------")
@@ -286,23 +294,46 @@ class MonitorESRFIcatTomo(Monitor):
                     "MonitorIcatTomo: All upstream activities ended, stopping monitor"
                 )
                 finished = True
+            self.logCompletedTiltSeries()
             self.updateJsonFile()
+        if finished:
+            # Leave a complete allParams.json for the next session
+            self.stateWriter.stop()
+            self.all_params.close()
         self.info("MonitorIcatTomo: end step --------------------------")
 
         return finished
 
-    def noInterrupt(self, path, obj):
-        with open(path, "w") as fd:
-            fd.write(obj)
-
-    def updateJsonFile(self):
-        if self.all_params_json_file is not None:
-            thread = threading.Thread(
-                target=self.noInterrupt,
-                args=(self.all_params_json_file, json.dumps(self.all_params, indent=4)),
-            )
-            thread.start()
-            thread.join()
+    def updateJsonFile(self, wait=False):
+        # Saved by the state writer thread, which groups updates coming in
+        # bursts; wait=True returns once they are on disk
+        if wait:
+            self.stateWriter.flush()
+        else:
+            self.stateWriter.markDirty()
+
+    def logCompletedTiltSeries(self):
+        # A series is complete once it has the number of tilts of its mdoc
+        # or, without mdoc, when no tilt arrived for a while
+        for ts_name in self.ts_index.listSeriesName():
+            if ts_name in self.completed_ts:
+                continue
+            tilt_series = self.ts_index.getSeries(ts_name)
+            if tilt_series.directory is not None:
+                no_tilts = UtilsPath.getTiltSerieNoTilts(
+                    tilt_series.directory, ts_name
+                )
+                if no_tilts is not None:
+                    self.ts_index.setExpectedTilts(ts_name, no_tilts)
+            if self.ts_index.isComplete(
+                ts_name, quiescence=esrf_utils_tiltseries.TILT_SERIES_QUIESCENCE
+            ):
+                self.completed_ts.add(ts_name)
+                tilt_angles, _ = self.ts_index.getTiltAngles(ts_name)
+                self.info(
+                    f"Tilt series {ts_name} completed: {len(tilt_angles)} tilts "
+                    f"from {tilt_angles[0]:.2f} to {tilt_angles[-1]:.2f} degrees"
+                )
 
     def iter_updated_set(self, objSet):
         objSet.load()
@@ -318,9 +349,21 @@ class MonitorESRFIcatTomo(Monitor):
             dict_movie = UtilsPath.getTSFileParameters(movie_full_path)
             icat_raw_dir = pathlib.Path(dict_movie["icat_raw_dir"])
             movie_name = dict_movie["movie_name"]
-            if movie_name not in self.all_params:
+            ts_name = dict_movie["ts_name"]
+            if self.ts_index.addTilt(
+                movie_name, ts_name, dict_movie["movie_number"], dict_movie["tilt_angle"]
+            ):
+                tilt_series = self.ts_index.getSeries(ts_name)
+                if tilt_series.directory is None:
+                    tilt_series.directory = dict_movie["directory"]
+            if movie_name not in self.all_params and not self.ts_index.hasStage(
+                movie_name, esrf_utils_tiltseries.STAGE_MOVIE
+            ):
                 if icat_raw_dir.exists():
                     self.info("Movie already archived: {0}".format(movie_name))
+                    self.ts_index.setStage(
+                        movie_name, esrf_utils_tiltseries.STAGE_MOVIE
+                    )
                 elif self.no_movie_threads > 10:
                     no_waiting += 1
                     if no_waiting < 10:
@@ -329,14 +372,21 @@ class MonitorESRFIcatTomo(Monitor):
                         )
                 else:
                     icat_raw_dir.mkdir(mode=0o755, exist_ok=False, parents=True)
-                    # Check if we need to create search snapshot image
-                    search_dir = icat_raw_dir.parent / "Search"
-                    if not search_dir.exists():
-                        search_dir.mkdir(mode=0o755, exist_ok=False)
-                        search_path = UtilsPath.createTiltSerieSearchSnapshot(
-                            dict_movie, search_dir
-                        )
-                        dict_movie["search_path"] = str(search_path)
+                    # Check if we need to create search snapshot image, once
+                    # per tilt series ("" if there is none)
+                    tilt_series = self.ts_index.getSeries(ts_name)
+                    if tilt_series.searchPath is None:
+                        tilt_series.searchPath = ""
+                        search_dir = icat_raw_dir.parent / "Search"
+                        if not search_dir.exists():
+                            search_dir.mkdir(mode=0o755, exist_ok=False)
+                            search_path = UtilsPath.createTiltSerieSearchSnapshot(
+                                dict_movie, search_dir
+                            )
+                            if search_path is not None:
+                                tilt_series.searchPath = str(search_path)
+                    if tilt_series.searchPath:
+                        dict_movie["search_path"] = tilt_series.searchPath
                     # Start threads - if max number of threads not reached
                     self.no_movie_threads += 1
                     grid_name = self.sampleName
@@ -355,6 +405,10 @@ class MonitorESRFIcatTomo(Monitor):
             micrograph_full_path = self.current_dir / micrograph.getFileName()
             dict_micrograph = UtilsPath.getTSFileParameters(micrograph_full_path)
             movie_name = dict_micrograph["movie_name"]
+            if self.ts_index.hasStage(
+                movie_name, esrf_utils_tiltseries.STAGE_MOTION_CORRECTION
+            ):
+                continue
             if movie_name in self.all_params:
                 dict_movie = self.all_params[movie_name]
                 icat_mc_dir = (
@@ -395,6 +449,8 @@ class MonitorESRFIcatTomo(Monitor):
             ctf_working_dir = self.current_dir / str(prot.workingDir)
             dict_micrograph = UtilsPath.getTSFileParameters(mc_full_path)
             movie_name = dict_micrograph["movie_name"]
+            if self.ts_index.hasStage(movie_name, esrf_utils_tiltseries.STAGE_CTF):
+                continue
             if movie_name in self.all_params:
                 dict_movie = self.all_params[movie_name]
                 icat_ctf_dir = pathlib.Path(dict_movie["icat_processed_dir"]) / "CTF"
@@ -471,6 +527,7 @@ class MonitorESRFIcatTomo(Monitor):
                     dictMetadata=dictMetadata,
                 )
             self.all_params[movie_name]["raw_movie_archived"] = True
+            self.ts_index.setStage(movie_name, esrf_utils_tiltseries.STAGE_MOVIE)
             self.all_params[movie_name]["icat_raw_dir"] = str(icat_raw_dir)
             self.info(
                 f"Thread finished for movie {movie_name}, no_movie_threads: {self.no_movie_threads}"
@@ -493,6 +550,19 @@ class MonitorESRFIcatTomo(Monitor):
 
     def archiveAlignedMovieInIcatPlus(
         self, prot, movie_name, micrograph_full_path, icat_mc_dir
+    ):
+        try:
+            self._archiveAlignedMovieInIcatPlus(
+                prot, movie_name, micrograph_full_path, icat_mc_dir
+            )
+        finally:
+            self.no_mc_threads -= 1
+        self.info(
+            f"MC thread finished for movie {movie_name}, no_mc_threads: {self.no_mc_threads}"
+        )
+
+    def _archiveAlignedMovieInIcatPlus(
+        self, prot, movie_name, micrograph_full_path, icat_mc_dir
     ):
         dict_movie = self.all_params[movie_name]
         sample_name = dict_movie["sample_name"]
@@ -503,12 +573,9 @@ class MonitorESRFIcatTomo(Monitor):
         # Create snapshot image
         mc_galley_path = icat_mc_dir / "gallery"
         mc_galley_path.mkdir(mode=0o755)
-        temp_tif_path = mc_galley_path / (micrograph_full_path.stem + ".tif")
         mc_snapshot_path = mc_galley_path / (micrograph_full_path.stem + ".jpg")
-        os.system(f"/cvmfs/sb.esrf.fr/bin/bimg {micrograph_full_path} {temp_tif_path}")
-        os.system(f"/cvmfs/sb.esrf.fr/bin/bscale -bin 12 {temp_tif_path} {mc_snapshot_path}")
-        os.chmod(mc_snapshot_path, mode=0o644)
-        os.remove(str(temp_tif_path))
+        if self.createSnapshot(micrograph_full_path, mc_snapshot_path, binning=12):
+            os.chmod(mc_snapshot_path, mode=0o644)
         # Copy global shift snap shot
         drift_plot_full_path = micrograph_full_path.parent / (
             movie_name + "_global_shifts.png"
@@ -540,14 +607,22 @@ class MonitorESRFIcatTomo(Monitor):
                 raw=[icat_raw_dir],
             )
         self.all_params[movie_name]["mc_archived"] = True
+        self.ts_index.setStage(
+            movie_name, esrf_utils_tiltseries.STAGE_MOTION_CORRECTION
+        )
         self.all_params[movie_name]["icat_mc_path"] = str(icat_mc_path)
         self.all_params[movie_name]["icat_mc_dir"] = str(icat_mc_dir)
-        self.no_mc_threads -= 1
+
+    def archiveCTFInIcatPlus(self, prot, movie_name, ctf_full_path, icat_ctf_dir):
+        try:
+            self._archiveCTFInIcatPlus(prot, movie_name, ctf_full_path, icat_ctf_dir)
+        finally:
+            self.no_ctf_threads -= 1
         self.info(
-            f"MC thread finished for movie {movie_name}, no_mc_threads: {self.no_mc_threads}"
+            f"CTF thread finished for movie {movie_name}, no_ctf_threads: {self.no_ctf_threads}"
         )
 
-    def archiveCTFInIcatPlus(self, prot, movie_name, ctf_full_path, icat_ctf_dir):
+    def _archiveCTFInIcatPlus(self, prot, movie_name, ctf_full_path, icat_ctf_dir):
         dict_movie = self.all_params[movie_name]
         sample_name = dict_movie["sample_name"]
         movie_number = dict_movie["movie_number"]
@@ -568,7 +643,7 @@ class MonitorESRFIcatTomo(Monitor):
         ctf_galley_path = icat_ctf_dir / "gallery"
         ctf_galley_path.mkdir(mode=0o755)
         mc_snapshot_path = ctf_galley_path / (ctf_full_path.stem + ".jpg")
-        os.system(f"/cvmfs/sb.esrf.fr/bin/bimg -minmax 0,300 {ctf_full_path} {mc_snapshot_path}")
+        self.createSnapshot(ctf_full_path, mc_snapshot_path, minmax=(0, 300))
         dict_metadata = {
             "Sample_name": sample_name,
             "EMCTF_resolution_limit": resolution_limit,
@@ -588,9 +663,21 @@ class MonitorESRFIcatTomo(Monitor):
                 raw=[icat_mc_dir],
             )
         self.all_params[movie_name]["ctf_archived"] = True
+        self.ts_index.setStage(movie_name, esrf_utils_tiltseries.STAGE_CTF)
         self.all_params[movie_name]["icat_ctf_path"] = str(icat_ctf_path)
         self.all_params[movie_name]["icat_ctf_dir"] = str(icat_ctf_dir)
-        self.no_ctf_threads -= 1
-        self.info(
-            f"CTF thread finished for movie {movie_name}, no_ctf_threads: {self.no_ctf_threads}"
-        )
+
+    def createSnapshot(self, image_path, snapshot_path, **render_parameters):
+        """
+        Cached snapshot of image_path, returns False if the image couldn't
+        be read (e.g. still being written), the dataset is archived
+        without it.
+        """
+        try:
+            UtilsSnapshot.createCachedSnapshot(
+                image_path, snapshot_path, **render_parameters
+            )
+        except (OSError, RuntimeError, ValueError) as error:
+            self.info(f"ERROR! No snapshot for {image_path}: {error}")
+            return False
+        return True
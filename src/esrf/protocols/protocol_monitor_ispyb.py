@@ -32,11 +32,9 @@
 # [2] Diamond Light Source, Ltd
 
 import os
-import json
 import time
 import pprint
 import shutil
-import threading
 import traceback
 import collections
 
@@ -54,12 +52,19 @@ from relion.protocols import ProtRelionClassify2D
 from motioncorr.protocols import ProtMotionCorr
 from esrf.utils.esrf_utils_ispyb import UtilsISPyB
 from esrf.utils.esrf_utils_path import UtilsPath
+from esrf.utils.esrf_utils_state import StateWriter, UtilsState
 from esrf.utils.esrf_utils_icat import UtilsIcat
+from esrf.utils.esrf_utils_watcher import FileArrivalWatcher
+from esrf.utils.esrf_utils_gridstats import GridSquareStatistics
 from pwem.emlib.image import ImageHandler
 
 # Fix for GPFS problem
 shutil._USE_CP_SENDFILE = False
 
+# Number of seconds a step may wait for the meta-data files of parked
+# movies, by default a step only polls once and does not wait
+SIDECAR_WAIT_TIME = 0
+
 
 class ProtMonitorISPyB_ESRF(ProtMonitor):
     """
@@ -232,7 +237,10 @@ class ProtMonitorISPyB_ESRF(ProtMonitor):
         )  # 4*24 H max monitor time
 
         monitor.addNotifier(PrintNotifier())
-        monitor.loop()
+        try:
+            monitor.loop()
+        finally:
+            monitor.close()
 
 
 class MonitorISPyB_ESRF(Monitor):
@@ -271,19 +279,37 @@ class MonitorISPyB_ESRF(Monitor):
         self.positionY = None
         self.collectionDate = None
         self.collectionTime = None
+        self.sidecarWatcher = FileArrivalWatcher()
         if hasattr(protocol, "all_params_json_file"):
             self.all_params_json_file = protocol.all_params_json_file.get()
-            if os.path.exists(self.all_params_json_file):
-                try:
-                    dictAllParams = json.loads(open(self.all_params_json_file).read())
-                    self.allParams = collections.OrderedDict(dictAllParams)
-                except BaseException:
-                    self.allParams = collections.OrderedDict()
-            else:
-                self.allParams = collections.OrderedDict()
+            try:
+                self.allParams = UtilsState.load(self.all_params_json_file)
+            except BaseException as error:
+                self.info(
+                    "ERROR! Couldn't load {0}, starting a new one: {1}".format(
+                        self.all_params_json_file, error
+                    )
+                )
+                self.allParams = UtilsState.create(self.all_params_json_file)
         else:
             self.all_params_json_file = None
-            self.allParams = collections.OrderedDict()
+            self.allParams = UtilsState.load(None)
+        self.dictGridSquareStatistics = {}
+        self.setUploadedMovieFullPath = UtilsPath.getUploadedMovieFullPaths(
+            self.allParams
+        )
+        self.stateWriter = StateWriter(self.allParams).start()
+        self.stateWriter.installSignalHandlers()
+        self.isClosed = False
+
+    def close(self):
+        # Leaves a complete allParams.json for the next session and releases
+        # the inotify file descriptor of the side-car watcher
+        if not self.isClosed:
+            self.isClosed = True
+            self.sidecarWatcher.close()
+            self.stateWriter.stop()
+            self.allParams.close()
 
     def step(self):
         self.info("MonitorISPyB: start step ------------------------")
@@ -355,22 +381,55 @@ class MonitorISPyB_ESRF(Monitor):
                 )
                 finished = True
 
+        if finished:
+            self.close()
         self.info("MonitorISPyB: end step --------------------------")
 
         return finished
 
-    def noInterrupt(self, path, obj):
-        with open(path, "w") as fd:
-            fd.write(obj)
-
-    def updateJsonFile(self):
-        if self.all_params_json_file is not None:
-            thread = threading.Thread(
-                target=self.noInterrupt,
-                args=(self.all_params_json_file, json.dumps(self.allParams, indent=4)),
+    def updateJsonFile(self, wait=False):
+        # Saved by the state writer thread, which groups updates coming in
+        # bursts; wait=True returns once they are on disk
+        if wait:
+            self.stateWriter.flush()
+        else:
+            self.stateWriter.markDirty()
+
+    def getGridSquareStatistics(self, gridSquare):
+        # Statistics are kept with the grid square entry of allParams, they
+        # are rebuilt from the movies for grid squares without them
+        gridSquareStatistics = self.dictGridSquareStatistics.get(gridSquare)
+        if gridSquareStatistics is not None:
+            return gridSquareStatistics
+        if gridSquare in self.allParams and "statistics" in self.allParams[gridSquare]:
+            gridSquareStatistics = GridSquareStatistics.fromDict(
+                self.allParams[gridSquare]["statistics"]
             )
-            thread.start()
-            thread.join()
+            self.dictGridSquareStatistics[gridSquare] = gridSquareStatistics
+            return gridSquareStatistics
+        # Same movies as the ones archived by archiveGridSquare
+        dictMovie = {}
+        for movieName, entry in self.allParams.items():
+            if not isinstance(entry, dict):
+                continue
+            if entry.get("gridSquare") == gridSquare or (
+                "gridSquare" not in entry
+                and gridSquare in entry.get("movieFullPath", "")
+            ):
+                dictMovie[movieName] = entry
+        return GridSquareStatistics.fromMovies(dictMovie)
+
+    def recordGridSquareStatistics(self, gridSquare, update):
+        # Applies update to the statistics of gridSquare, to be called before
+        # the new values are stored in the movie entry of allParams. update
+        # gives the movie name so that a movie is only counted once.
+        if gridSquare is not None:
+            gridSquareStatistics = self.getGridSquareStatistics(gridSquare)
+            update(gridSquareStatistics)
+            self.dictGridSquareStatistics[gridSquare] = gridSquareStatistics
+            if gridSquare not in self.allParams:
+                self.allParams[gridSquare] = {}
+            self.allParams[gridSquare]["statistics"] = gridSquareStatistics.toDict()
 
     def iter_updated_set(self, objSet):
         objSet.load()
@@ -384,10 +443,13 @@ class MonitorISPyB_ESRF(Monitor):
         if dictFileNameParameters is None:
             movieName = os.path.basename(movieFullPath)
             self.info("File {0} is not a movie, skipping".format(movieFullPath))
-            self.allParams[movieName] = {
-                "movieFullPath": movieFullPath,
-                "movieId": "not a movie",
-            }
+            self.setMovieParams(
+                movieName,
+                {
+                    "movieFullPath": movieFullPath,
+                    "movieId": "not a movie",
+                },
+            )
         else:
             # self.info("dictFileNameParameters: {0}".format(dictFileNameParameters))
             self.movieDirectory = dictFileNameParameters["directory"]
@@ -410,6 +472,7 @@ class MonitorISPyB_ESRF(Monitor):
                 processDir = None
             self.movieDirectory = os.path.dirname(movieFullPath)
 
+            # Meta-data files have been waited for in uploadImportMovies
             (
                 micrographSnapshotFullPath,
                 micrographFullPath,
@@ -417,36 +480,6 @@ class MonitorISPyB_ESRF(Monitor):
                 gridSquareSnapshotFullPath,
             ) = UtilsPath.getMovieJpegMrcXml(movieFullPath)
 
-            startTime = time.time()
-            doContinue = True
-            while doContinue:
-                (
-                    micrographSnapshotFullPath,
-                    micrographFullPath,
-                    xmlMetaDataFullPath,
-                    gridSquareSnapshotFullPath,
-                ) = UtilsPath.getMovieJpegMrcXml(movieFullPath)
-                if (
-                    micrographSnapshotFullPath is None
-                    or micrographFullPath is None
-                    or xmlMetaDataFullPath is None
-                    or gridSquareSnapshotFullPath is None
-                ):
-                    self.info(
-                        "Import movies: waiting for meta-data files to appear on disk..."
-                    )
-                    timeNow = time.time()
-                    deltaTime = timeNow - startTime
-                    if deltaTime > 5:
-                        self.info(
-                            "Import movies: Timeout waiting for meta-data files to appear on disk!!!"
-                        )
-                        doContinue = False
-                    else:
-                        time.sleep(2)
-                else:
-                    doContinue = False
-
             self.info(
                 "Import movies: micrographSnapshotFullPath: {0}".format(
                     micrographSnapshotFullPath
@@ -539,21 +572,30 @@ class MonitorISPyB_ESRF(Monitor):
                         time.sleep(5)
                         noTrialsLeft -= 1
 
-            self.allParams[movieName] = {
-                "movieNumber": movieNumber,
-                "movieFullPath": movieFullPath,
-                "processDir": processDir,
-                "date": date,
-                "hour": hour,
-                "movieId": movieId,
-                "imagesCount": imagesCount,
-                "dosePerFrame": dosePerFrame,
-                "proposal": self.proposal,
-                "gridSquare": gridSquare,
-                "archived": False,
-                "positionX": positionX,
-                "positionY": positionY,
-            }
+            self.recordGridSquareStatistics(
+                gridSquare,
+                lambda statistics: statistics.addMovie(
+                    positionX, positionY, movieName
+                ),
+            )
+            self.setMovieParams(
+                movieName,
+                {
+                    "movieNumber": movieNumber,
+                    "movieFullPath": movieFullPath,
+                    "processDir": processDir,
+                    "date": date,
+                    "hour": hour,
+                    "movieId": movieId,
+                    "imagesCount": imagesCount,
+                    "dosePerFrame": dosePerFrame,
+                    "proposal": self.proposal,
+                    "gridSquare": gridSquare,
+                    "archived": False,
+                    "positionX": positionX,
+                    "positionY": positionY,
+                },
+            )
             if "EM_meta_data" not in self.allParams:
                 self.allParams["EM_meta_data"] = {
                     "EM_directory": prot.filesPath.get(),
@@ -593,10 +635,13 @@ class MonitorISPyB_ESRF(Monitor):
         if dictFileNameParameters is None:
             movieName = os.path.basename(movieFullPath)
             self.info("File {0} is not a movie, skipping".format(movieFullPath))
-            self.allParams[movieName] = {
-                "movieFullPath": movieFullPath,
-                "movieId": "not a movie",
-            }
+            self.setMovieParams(
+                movieName,
+                {
+                    "movieFullPath": movieFullPath,
+                    "movieId": "not a movie",
+                },
+            )
         else:
             # self.info("dictFileNameParameters: {0}".format(dictFileNameParameters))
             self.movieDirectory = dictFileNameParameters["directory"]
@@ -728,21 +773,30 @@ class MonitorISPyB_ESRF(Monitor):
                             time.sleep(5)
                             noTrialsLeft -= 1
 
-                self.allParams[movieName] = {
-                    "movieNumber": movieNumber,
-                    "movieFullPath": movieFullPath,
-                    "processDir": processDir,
-                    "date": date,
-                    "hour": hour,
-                    "movieId": movieId,
-                    "imagesCount": imagesCount,
-                    "dosePerFrame": dosePerFrame,
-                    "proposal": self.proposal,
-                    "gridSquare": gridSquare,
-                    "archived": False,
-                    "positionX": positionX,
-                    "positionY": positionY,
-                }
+                self.recordGridSquareStatistics(
+                    gridSquare,
+                    lambda statistics: statistics.addMovie(
+                        positionX, positionY, movieName
+                    ),
+                )
+                self.setMovieParams(
+                    movieName,
+                    {
+                        "movieNumber": movieNumber,
+                        "movieFullPath": movieFullPath,
+                        "processDir": processDir,
+                        "date": date,
+                        "hour": hour,
+                        "movieId": movieId,
+                        "imagesCount": imagesCount,
+                        "dosePerFrame": dosePerFrame,
+                        "proposal": self.proposal,
+                        "gridSquare": gridSquare,
+                        "archived": False,
+                        "positionX": positionX,
+                        "positionY": positionY,
+                    },
+                )
                 if "EM_meta_data" not in self.allParams:
                     self.allParams["EM_meta_data"] = {
                         "EM_directory": prot.filesPath.get(),
@@ -780,10 +834,13 @@ class MonitorISPyB_ESRF(Monitor):
         if dictFileNameParameters is None:
             movieName = os.path.basename(movieFullPath)
             self.info("File {0} is not a movie, skipping".format(movieFullPath))
-            self.allParams[movieName] = {
-                "movieFullPath": movieFullPath,
-                "movieId": "not a movie",
-            }
+            self.setMovieParams(
+                movieName,
+                {
+                    "movieFullPath": movieFullPath,
+                    "movieId": "not a movie",
+                },
+            )
         else:
             # self.info("dictFileNameParameters: {0}".format(dictFileNameParameters))
             self.movieDirectory = dictFileNameParameters["directory"]
@@ -803,34 +860,17 @@ class MonitorISPyB_ESRF(Monitor):
                 processDir = None
             self.movieDirectory = os.path.dirname(movieFullPath)
             # Get SerialEM metadata
+            # The mdoc file has been waited for in uploadImportMovies
             mdocFullPath = movieFullPath + ".mdoc"
-
-            startTime = time.time()
-            doContinue = True
-            while doContinue:
-                if not os.path.exists(mdocFullPath):
-                    self.info(
-                        "Import movies: waiting for meta-data files to appear on disk..."
-                    )
-                    timeNow = time.time()
-                    deltaTime = timeNow - startTime
-                    if deltaTime > 30:
-                        self.info(
-                            "Import movies: Timeout waiting for meta-data files to appear on disk!!!"
-                        )
-                        doContinue = False
-                    else:
-                        time.sleep(5)
-                else:
-                    doContinue = False
-                    self.info("Import movies: mdocFullPath: {0}".format(mdocFullPath))
-                    dictMetaData = UtilsPath.getMdocMetaData(mdocFullPath)
-                    self.positionX, self.positionY = dictMetaData[
-                        "StagePosition"
-                    ].split(" ")
-                    self.collectionDate, self.collectionTime = dictMetaData[
-                        "DateTime"
-                    ].split("  ")
+            if os.path.exists(mdocFullPath):
+                self.info("Import movies: mdocFullPath: {0}".format(mdocFullPath))
+                dictMetaData = UtilsPath.getMdocMetaData(mdocFullPath)
+                self.positionX, self.positionY = dictMetaData["StagePosition"].split(
+                    " "
+                )
+                self.collectionDate, self.collectionTime = dictMetaData[
+                    "DateTime"
+                ].split("  ")
 
             voltage = self.voltage
             magnification = self.magnification
@@ -907,21 +947,30 @@ class MonitorISPyB_ESRF(Monitor):
                 raise RuntimeError("ISPyB Movie object is None!")
 
             gridSquare = "GridSquare_112345"
-            self.allParams[movieName] = {
-                "movieNumber": movieNumber,
-                "movieFullPath": movieFullPath,
-                "processDir": processDir,
-                "date": date,
-                "hour": hour,
-                "movieId": movieId,
-                "imagesCount": imagesCount,
-                "dosePerFrame": dosePerFrame,
-                "proposal": self.proposal,
-                "gridSquare": gridSquare,
-                "archived": False,
-                "positionX": positionX,
-                "positionY": positionY,
-            }
+            self.recordGridSquareStatistics(
+                gridSquare,
+                lambda statistics: statistics.addMovie(
+                    positionX, positionY, movieName
+                ),
+            )
+            self.setMovieParams(
+                movieName,
+                {
+                    "movieNumber": movieNumber,
+                    "movieFullPath": movieFullPath,
+                    "processDir": processDir,
+                    "date": date,
+                    "hour": hour,
+                    "movieId": movieId,
+                    "imagesCount": imagesCount,
+                    "dosePerFrame": dosePerFrame,
+                    "proposal": self.proposal,
+                    "gridSquare": gridSquare,
+                    "archived": False,
+                    "positionX": positionX,
+                    "positionY": positionY,
+                },
+            )
             if "EM_meta_data" not in self.allParams:
                 self.allParams["EM_meta_data"] = {
                     "EM_directory": prot.filesPath.get(),
@@ -954,32 +1003,92 @@ class MonitorISPyB_ESRF(Monitor):
             #         # Check if old grid squares
             #         self.archiveOldGridSquare(gridSquare)
 
+    def setMovieParams(self, movieName, dictMovie):
+        # Movie entries are set here to keep setUploadedMovieFullPath in sync
+        if movieName in self.allParams:
+            self.setUploadedMovieFullPath.discard(
+                self.allParams[movieName].get("movieFullPath")
+            )
+        self.allParams[movieName] = dictMovie
+        if dictMovie.get("movieId") is not None:
+            self.setUploadedMovieFullPath.add(dictMovie["movieFullPath"])
+
     def uploadImportMovies(self, prot):
         for movieFullPath in prot.getMatchFiles():
-            listMovieFullPath = []
-            for movieName in self.allParams:
-                if (
-                    "movieFullPath" in self.allParams[movieName]
-                    and "movieId" in self.allParams[movieName]
-                ):
-                    if self.allParams[movieName]["movieId"] is not None:
-                        listMovieFullPath.append(
-                            self.allParams[movieName]["movieFullPath"]
-                        )
-            #            listMovieFullPath = [ self.allParams[movieName]["movieFullPath"] for movieName in self.allParams if "movieFullPath" in self.allParams[movieName]]
-            if movieFullPath in listMovieFullPath:
+            if movieFullPath in self.setUploadedMovieFullPath:
                 pass
                 # self.info("Movie already uploaded: {0}".format(movieFullPath))
+            elif movieFullPath in self.sidecarWatcher:
+                pass
+            elif not self.isMovieMetaDataReady(prot, movieFullPath):
+                self.info(
+                    "Import movies: waiting for meta-data files of {0} to appear on disk...".format(
+                        movieFullPath
+                    )
+                )
+                self.watchMovieMetaData(prot, movieFullPath)
             else:
                 self.info("Import movies: movieFullPath: {0}".format(movieFullPath))
-                if self.dataType == 0:  # "EPU"
-                    self.uploadMoviesEPU(prot, movieFullPath)
-                if self.dataType == 1:  # "EPU_TIFF"
-                    self.uploadMoviesEPUTiff(prot, movieFullPath)
-                elif self.dataType == 2:  # "SERIALEM"
-                    self.uploadMoviesSerialEM(prot, movieFullPath)
-                else:
-                    raise RuntimeError("Unknown data type: {0}".format(self.dataType))
+                self.uploadMovie(prot, movieFullPath)
+        # Movies parked while waiting for their meta-data files, uploaded
+        # if their files have appeared (or during SIDECAR_WAIT_TIME seconds
+        # if set) and otherwise at the next step
+        endTime = time.time() + SIDECAR_WAIT_TIME
+        listReady, listTimedOut = self.sidecarWatcher.poll()
+        while True:
+            for movieFullPath in listReady + listTimedOut:
+                if movieFullPath in listTimedOut:
+                    self.info(
+                        "Import movies: Timeout waiting for meta-data files of {0} to appear on disk!!!".format(
+                            movieFullPath
+                        )
+                    )
+                self.info("Import movies: movieFullPath: {0}".format(movieFullPath))
+                self.uploadMovie(prot, movieFullPath)
+            timeLeft = endTime - time.time()
+            if len(self.sidecarWatcher) == 0 or timeLeft <= 0:
+                break
+            listReady, listTimedOut = self.sidecarWatcher.wait(timeLeft)
+
+    def uploadMovie(self, prot, movieFullPath):
+        if self.dataType == 0:  # "EPU"
+            self.uploadMoviesEPU(prot, movieFullPath)
+        elif self.dataType == 1:  # "EPU_TIFF"
+            self.uploadMoviesEPUTiff(prot, movieFullPath)
+        elif self.dataType == 2:  # "SERIALEM"
+            self.uploadMoviesSerialEM(prot, movieFullPath)
+        else:
+            raise RuntimeError("Unknown data type: {0}".format(self.dataType))
+
+    def isMovieMetaDataReady(self, prot, movieFullPath):
+        if self.dataType == 0:  # "EPU"
+            if UtilsPath.getMovieFileNameParameters(movieFullPath) is None:
+                return True
+            return None not in UtilsPath.getMovieJpegMrcXml(movieFullPath)
+        elif self.dataType == 2:  # "SERIALEM"
+            dictFileNameParameters = UtilsPath.getSerialEMMovieFileNameParameters(
+                str(prot.filesPath), movieFullPath
+            )
+            if dictFileNameParameters is None:
+                return True
+            return os.path.exists(movieFullPath + ".mdoc")
+        return True
+
+    def watchMovieMetaData(self, prot, movieFullPath):
+        movieDirectory = os.path.dirname(movieFullPath)
+        if self.dataType == 0:  # "EPU"
+            # Micrograph, xml and grid square snapshot
+            listDirectory = [movieDirectory, os.path.dirname(movieDirectory)]
+            timeout = 5
+        else:
+            listDirectory = [movieDirectory]
+            timeout = 30
+        self.sidecarWatcher.add(
+            movieFullPath,
+            listDirectory,
+            lambda: self.isMovieMetaDataReady(prot, movieFullPath),
+            timeout,
+        )
 
     def uploadAlignMovies(self, prot):
         self.protocol.info("ESRF ISPyB upload motion corr results")
@@ -1125,6 +1234,12 @@ class MonitorISPyB_ESRF(Monitor):
                             time.sleep(5)
                             noTrialsLeft -= 1
                 time.sleep(0.1)
+                self.recordGridSquareStatistics(
+                    self.allParams[movieName].get("gridSquare"),
+                    lambda statistics: statistics.addMotionCorrection(
+                        totalMotion, movieName
+                    ),
+                )
                 self.allParams[movieName]["motionCorrectionId"] = motionCorrectionId
                 self.allParams[movieName]["totalMotion"] = totalMotion
                 self.allParams[movieName][
@@ -1274,6 +1389,12 @@ class MonitorISPyB_ESRF(Monitor):
                             time.sleep(5)
                             noTrialsLeft -= 1
 
+                self.recordGridSquareStatistics(
+                    self.allParams[movieName].get("gridSquare"),
+                    lambda statistics: statistics.addCtf(
+                        defocusU, defocusV, resolutionLimit, movieName
+                    ),
+                )
                 self.allParams[movieName]["CTFid"] = CTFid
                 self.allParams[movieName]["phaseShift"] = phaseShift
                 self.allParams[movieName]["defocusU"] = defocusU
@@ -1307,10 +1428,10 @@ class MonitorISPyB_ESRF(Monitor):
             relionListClass = None
             dictModel = {"numberOfClasses": no2DClasses, "classes": []}
             if isinstance(prot, ProtRelionClassify2D):
-                pathToModelStarFile = os.path.join(
-                    workingDir, "extra", "relion_it025_model.star"
+                pathToModelStarFile = UtilsPath.findLatestRelionModelStarFile(
+                    extraDirectory
                 )
-                if os.path.exists(pathToModelStarFile):
+                if pathToModelStarFile is not None:
                     relionDictModel = UtilsPath.parseRelionModelStarFile(
                         pathToModelStarFile
                     )
@@ -1378,9 +1499,7 @@ class MonitorISPyB_ESRF(Monitor):
         # Archive remaining movies
         self.info("Archiving grid square: {0}".format(gridSquareToBeArchived))
         listPathsToBeArchived = []
-        sumPositionX = 0.0
-        sumPositionY = 0.0
-        indexPosition = 0
+        listMovieNameToBeArchived = []
         for movieName in self.allParams:
             if (
                 "gridSquare" in self.allParams[movieName]
@@ -1388,13 +1507,8 @@ class MonitorISPyB_ESRF(Monitor):
                 and not self.allParams[movieName]["archived"]
             ):
                 listPathsToBeArchived.append(self.allParams[movieName]["movieFullPath"])
+                listMovieNameToBeArchived.append(movieName)
                 self.allParams[movieName]["archived"] = True
-                try:
-                    sumPositionX += float(self.allParams[movieName]["positionX"])
-                    sumPositionY += float(self.allParams[movieName]["positionY"])
-                    indexPosition += 1
-                except ValueError:
-                    pass
             elif (
                 "movieFullPath" in self.allParams[movieName]
                 and gridSquareToBeArchived in self.allParams[movieName]["movieFullPath"]
@@ -1402,23 +1516,17 @@ class MonitorISPyB_ESRF(Monitor):
             ):
                 listPathsToBeArchived.append(self.allParams[movieName]["movieFullPath"])
                 # self.allParams[movieName]["archived"] = True
-                try:
-                    sumPositionX += float(self.allParams[movieName]["positionX"])
-                    sumPositionY += float(self.allParams[movieName]["positionY"])
-                    indexPosition += 1
-                except ValueError:
-                    pass
         noImagesToBeArchived = len(listPathsToBeArchived)
         if noImagesToBeArchived > 0:
-            if indexPosition > 0:
-                meanPositionX = sumPositionX / indexPosition
-                meanPositionY = sumPositionY / indexPosition
-            else:
-                meanPositionX = None
-                meanPositionY = None
+            gridSquareStatistics = self.getGridSquareStatistics(gridSquareToBeArchived)
+            self.info(
+                "Grid square statistics: {0}".format(
+                    pprint.pformat(gridSquareStatistics.getSummary())
+                )
+            )
             dictIcatMetaData = dict(self.allParams["EM_meta_data"])
-            dictIcatMetaData["EM_position_x"] = meanPositionX
-            dictIcatMetaData["EM_position_y"] = meanPositionY
+            dictIcatMetaData["EM_position_x"] = gridSquareStatistics.getMean("positionX")
+            dictIcatMetaData["EM_position_y"] = gridSquareStatistics.getMean("positionY")
             directory = dictIcatMetaData["EM_directory"]
             del dictIcatMetaData["EM_directory"]
             if (
@@ -1446,6 +1554,8 @@ class MonitorISPyB_ESRF(Monitor):
             self.info("dataSetName: {0}".format(dataSetName))
             self.info("no movies: {0}".format(len(listPathsToBeArchived)))
             self.info("dictIcatMetaData: {0}".format(pprint.pformat(dictIcatMetaData)))
+            # The data set entry is on disk before the data set is created
+            self.updateJsonFile(wait=True)
             errorMessage = UtilsIcat.uploadToIcat(
                 listPathsToBeArchived,
                 directory,
@@ -1459,13 +1569,8 @@ class MonitorISPyB_ESRF(Monitor):
                 self.info("ERROR during icat upload!")
                 self.info(errorMessage)
             else:
-                for movieName in self.allParams:
-                    if (
-                        "gridSquare" in self.allParams[movieName]
-                        and self.allParams[movieName]["movieFullPath"]
-                        in listPathsToBeArchived
-                    ):
-                        self.allParams[movieName]["archived"] = True
+                for movieName in listMovieNameToBeArchived:
+                    self.allParams[movieName]["archived"] = True
 
     def archiveOldGridSquare(self, gridSquareNotToArchive=None):
         gridSquare = None
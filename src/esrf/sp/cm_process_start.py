@@ -11,6 +11,7 @@ if "v3_dev" in __file__:
 import motioncorr.constants
 
 from esrf.utils.esrf_utils_path import UtilsPath
+from esrf.utils.esrf_utils_header import UtilsHeader
 from esrf.utils.esrf_utils_ispyb import UtilsISPyB
 from esrf.sp.command_line_parser import getCommandlineOptions
 from esrf.celery.cm_worker import run_workflow_commandline
@@ -70,6 +71,22 @@ listMovies = glob.glob(
     os.path.join(config_dict["dataDirectory"], config_dict["filesPattern"])
 )
 noMovies = len(listMovies)
+# Without --imagesCount, read the number of frames from the first movie header
+if config_dict.get("imagesCount") is None and noMovies > 0:
+    try:
+        movieHeader = UtilsHeader.probe(listMovies[0])
+    except (OSError, RuntimeError) as error:
+        print(
+            "ERROR! Cannot read the number of frames from {0}: {1}".format(
+                listMovies[0], error
+            )
+        )
+        print("Please give the number of frames with '--imagesCount'.")
+        sys.exit(1)
+    config_dict["imagesCount"] = movieHeader.frames
+    print(
+        "Number of frames read from {0}: {1}".format(listMovies[0], movieHeader.frames)
+    )
 # Check that we have voltage, imagesCount and magnification:
 for key in ["magnification", "imagesCount"]:
     if key not in config_dict or config_dict[key] is None:
@@ -104,6 +121,27 @@ else:
     print("Number of movies available on disk: {0}".format(noMovies))
     firstMovieFullPath = listMovies[0]
     print("First movie full path file: {0}".format(firstMovieFullPath))
+    # Check that a sample of the movies have the same format
+    try:
+        movieHeader, listDifference = UtilsHeader.checkHomogeneous(sorted(listMovies))
+    except (OSError, RuntimeError) as error:
+        print("WARNING! Cannot check the format of the movies: {0}".format(error))
+    else:
+        print(
+            "Movie format: {0} {1} frames of {2}x{3} {4}".format(
+                movieHeader.format,
+                movieHeader.frames,
+                movieHeader.width,
+                movieHeader.height,
+                movieHeader.dtype,
+            )
+        )
+        for movieFilePath, field, expected, found in listDifference:
+            print(
+                "WARNING! Movie {0}: {1} is {2}, expected {3}".format(
+                    movieFilePath, field, found, expected
+                )
+            )
 
 
 if noMovies == 0:
@@ -0,0 +1,202 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import math
+import functools
+import collections
+
+# Maximum number of parsed CTF logs kept in memory
+CTF_CACHE_SIZE = 4096
+
+# Number of bytes read from the end of a log file at first, doubled until
+# the final result block is found
+TAIL_SIZE = 8192
+
+GCTF = "Gctf"
+CTFFIND = "CTFFind"
+
+CtfResult = collections.namedtuple(
+    "CtfResult",
+    [
+        "program",
+        "defocusU",
+        "defocusV",
+        "angle",
+        "phaseShift",
+        "ccc",
+        "resolutionLimit",
+        "estimatedBfactor",
+        "rawValues",
+    ],
+)
+
+# Keys of 'rawValues', as labelled in the Gctf 'Final Values' block
+_GCTF_LABELS = {
+    "Defocus_U": "defocusU",
+    "Defocus_V": "defocusV",
+    "Angle": "angle",
+    "Phase_shift": "phaseShift",
+    "CCC": "ccc",
+}
+
+# CTFFind summary lines and the 'rawValues' keys of their values
+_CTFFIND_LINES = (
+    ("Estimated defocus values", ("Defocus_U", "Defocus_V")),
+    ("Estimated azimuth of astigmatism", ("Angle",)),
+    ("Estimated phase shift", ("Phase_shift",)),
+    ("Score", ("CCC",)),
+    ("Thon rings with good fit up to", ("resolutionLimit",)),
+)
+
+
+def _toFloat(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _readTail(fd, fileSize, tailSize):
+    offset = max(0, fileSize - tailSize)
+    fd.seek(offset)
+    text = fd.read().decode(errors="replace")
+    listLine = text.splitlines()
+    if offset > 0 and len(listLine) > 0:
+        # First line is most likely incomplete
+        listLine = listLine[1:]
+    return offset == 0, listLine
+
+
+def _parseGctf(listLine):
+    dictRaw = {}
+    for index in range(len(listLine) - 1, -1, -1):
+        line = listLine[index]
+        if "Final Values" in line and "Final Values" not in dictRaw:
+            if index == 0:
+                return None
+            listLabels = listLine[index - 1].split()
+            listValues = line.split()
+            for label, value in zip(listLabels, listValues):
+                dictRaw.setdefault(label, value)
+            dictRaw["Final Values"] = True
+        elif "Resolution limit" in line:
+            dictRaw.setdefault("resolutionLimit", line.split()[-1])
+        elif "Estimated Bfactor" in line:
+            dictRaw.setdefault("estimatedBfactor", line.split()[-1])
+    if "Final Values" not in dictRaw:
+        return None
+    del dictRaw["Final Values"]
+    return dictRaw
+
+
+def _parseCtffind(listLine):
+    dictRaw = {}
+    for line in listLine:
+        if ":" not in line:
+            continue
+        text, value = line.split(":", 1)
+        for prefix, listKey in _CTFFIND_LINES:
+            if text.strip().startswith(prefix):
+                listValue = value.replace(",", " ").split()
+                for key, value in zip(listKey, listValue):
+                    dictRaw[key] = value
+    if "Defocus_U" not in dictRaw:
+        # Output text file: '# Columns' header and one row of values
+        if not any(line.startswith("# Columns") for line in listLine):
+            return None
+        listRow = [line.split() for line in listLine if not line.startswith("#")]
+        listRow = [row for row in listRow if len(row) >= 7]
+        if len(listRow) == 0:
+            return None
+        row = listRow[-1]
+        dictRaw = {
+            "Defocus_U": row[1],
+            "Defocus_V": row[2],
+            "Angle": row[3],
+            "CCC": row[5],
+            "resolutionLimit": row[6],
+        }
+        phaseShift = _toFloat(row[4])
+        if phaseShift:
+            # Radians in the output file
+            dictRaw["Phase_shift"] = "{0:.2f}".format(math.degrees(phaseShift))
+    return dictRaw
+
+
+@functools.lru_cache(maxsize=CTF_CACHE_SIZE)
+def _parseLog(logFilePath, size, mtime):
+    # size and mtime are only part of the cache key
+    tailSize = TAIL_SIZE
+    with open(logFilePath, "rb") as fd:
+        while True:
+            isWholeFile, listLine = _readTail(fd, size, tailSize)
+            dictRaw = _parseGctf(listLine)
+            program = GCTF
+            if dictRaw is None:
+                dictRaw = _parseCtffind(listLine)
+                program = CTFFIND
+            if dictRaw is not None or isWholeFile:
+                break
+            tailSize *= 4
+    if dictRaw is None:
+        return None
+    dictValue = {
+        key: _toFloat(dictRaw.get(label)) for label, key in _GCTF_LABELS.items()
+    }
+    return CtfResult(
+        program=program,
+        resolutionLimit=_toFloat(dictRaw.get("resolutionLimit")),
+        estimatedBfactor=_toFloat(dictRaw.get("estimatedBfactor")),
+        rawValues=dictRaw,
+        **dictValue
+    )
+
+
+class UtilsCtf(object):
+    """
+    Parser of the CTF estimation logs written by Gctf ('Final Values'
+    block) and CTFFind (summary lines or output file). Only the end of
+    the file is read, results are cached by (path, size, mtime) and
+    shared between callers: 'rawValues' must not be modified.
+    """
+
+    @staticmethod
+    def parseLog(logFilePath):
+        """
+        Returns a CtfResult with numeric defocus (A), angle (degrees),
+        phase shift (degrees), CCC, resolution limit (A) and B-factor,
+        None for the values not in the log. Returns None if the log has
+        no final result (yet).
+        """
+        logFilePath = os.fspath(logFilePath)
+        statResult = os.stat(logFilePath)
+        return _parseLog(logFilePath, statResult.st_size, statResult.st_mtime_ns)
+
+    @staticmethod
+    def clearCache():
+        _parseLog.cache_clear()
@@ -0,0 +1,435 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import json
+import time
+import bisect
+import threading
+
+from esrf.utils import esrf_utils_filename
+from esrf.utils.esrf_utils_filename import UtilsFileName
+
+# Directory mtimes can have a coarse resolution (one second on some NFS
+# servers): a directory scanned less than this number of seconds after its
+# last modification is scanned again even if its mtime hasn't changed.
+MTIME_RESOLUTION = 1.0
+
+# Number of seconds during which the listing of an EPU Data directory is
+# trusted when resolving the side-car files of a movie
+SIDECAR_TTL = 1.0
+
+# Minimum number of seconds between two flushes of the NFS attribute cache
+# of the same directory
+NFS_CACHE_BUST_INTERVAL = 5.0
+
+# Version of the persisted SerialEM discovery index
+SERIALEM_INDEX_VERSION = 1
+
+# Values of the 'extra' file name field of the MotionCor2 plots
+_MOTIONCORR_PNG_EXTRA = {
+    esrf_utils_filename.EPU_MOTIONCORR: {
+        "_global_shifts": "globalShiftPng",
+        "_thumbnail": "thumbnailPng",
+    },
+    esrf_utils_filename.EPU_TIFF_MOTIONCORR: {
+        "global_shifts": "globalShiftPng",
+        "thumbnail": "thumbnailPng",
+    },
+    esrf_utils_filename.SERIALEM_MOTIONCORR: {
+        "global_shifts": "globalShiftPng",
+        "thumbnail": "thumbnailPng",
+    },
+}
+
+
+class DirectoryIndex(object):
+    """
+    In-memory index of the entries of one directory. The directory is
+    listed with os.scandir on the first lookup and listed again only when
+    its mtime changes. Only the names which appeared or disappeared since
+    the previous scan are passed to 'addEntry' / 'removeEntry', so the cost
+    of keeping the index up to date doesn't grow with the directory size.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.fspath(directory)
+        self.mtime = None
+        self.scanTime = None
+        self.names = set()
+        self.lock = threading.RLock()
+
+    def _stat(self):
+        try:
+            return os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def refresh(self, force=False):
+        with self.lock:
+            mtime = self._stat()
+            if (
+                not force
+                and self.scanTime is not None
+                and mtime == self.mtime
+                and (mtime is None or self.scanTime - mtime / 1e9 >= MTIME_RESOLUTION)
+            ):
+                return False
+            scanTime = time.time()
+            try:
+                with os.scandir(self.directory) as iterator:
+                    names = {entry.name for entry in iterator}
+            except FileNotFoundError:
+                names = set()
+            for name in sorted(self.names - names):
+                self.removeEntry(name)
+            for name in sorted(names - self.names):
+                self.addEntry(name)
+            self.names = names
+            self.mtime = mtime
+            self.scanTime = scanTime
+            return True
+
+    def addEntry(self, name):
+        pass
+
+    def removeEntry(self, name):
+        pass
+
+
+class MotionCorrArtifactIndex(DirectoryIndex):
+    """
+    Index of the files written by MotionCor2 in a ProtMotionCorr 'extra'
+    directory: maps each movie name to its global shifts plot, thumbnail
+    and dose weighted micrograph.
+    """
+
+    def __init__(self, directory, layout):
+        DirectoryIndex.__init__(self, directory)
+        if layout not in _MOTIONCORR_PNG_EXTRA:
+            raise RuntimeError("Unknown motion correction layout: {0}".format(layout))
+        self.layout = layout
+        self.dictArtifacts = {}
+        self.dictNameKey = {}
+
+    def addEntry(self, name):
+        if name.endswith(".png"):
+            dictExtra = _MOTIONCORR_PNG_EXTRA[self.layout]
+        elif name.endswith(".mrc"):
+            dictExtra = None
+        else:
+            return
+        filePath = os.path.join(self.directory, name)
+        record = UtilsFileName.parse(filePath, self.layout)
+        if record is None:
+            return
+        if dictExtra is None:
+            key = "doseWeightMrc" if "DW" in record.extra else None
+        else:
+            key = dictExtra.get(record.extra)
+        if key is not None:
+            self.dictArtifacts.setdefault(record.movieName, {})[key] = filePath
+            self.dictNameKey[name] = (record.movieName, key)
+
+    def removeEntry(self, name):
+        if name in self.dictNameKey:
+            movieName, key = self.dictNameKey.pop(name)
+            dictArtifact = self.dictArtifacts[movieName]
+            if dictArtifact.get(key) == os.path.join(self.directory, name):
+                del dictArtifact[key]
+
+    def getArtifacts(self, movieName):
+        with self.lock:
+            self.refresh()
+            return dict(self.dictArtifacts.get(movieName, {}))
+
+
+class GridSquareSnapshotIndex(DirectoryIndex):
+    """
+    Index of the JPEG snapshots of an EPU GridSquare directory. The
+    'Data' sub-directory isn't listed, new movies don't change the mtime
+    of the GridSquare directory itself.
+    """
+
+    def __init__(self, directory):
+        DirectoryIndex.__init__(self, directory)
+        self.listSnapshot = []
+
+    def addEntry(self, name):
+        if name.endswith(".jpg"):
+            bisect.insort(self.listSnapshot, name)
+
+    def removeEntry(self, name):
+        if name.endswith(".jpg"):
+            del self.listSnapshot[bisect.bisect_left(self.listSnapshot, name)]
+
+    def getLastSnapshot(self):
+        with self.lock:
+            self.refresh()
+            if len(self.listSnapshot) == 0:
+                return None
+            return os.path.join(self.directory, self.listSnapshot[-1])
+
+
+class SidecarIndex(DirectoryIndex):
+    """
+    Name set of an EPU Data directory used to find the side-car files
+    (jpg, mrc, tiff, xml) of all the movies of the directory. Within the
+    TTL lookups don't touch the file system at all. When the TTL has
+    expired the NFS attribute cache of the directory is flushed, at most
+    once per 'cacheBustInterval', before checking the directory mtime.
+    """
+
+    def __init__(self, directory, ttl=None, cacheBustInterval=None):
+        DirectoryIndex.__init__(self, directory)
+        self.ttl = ttl
+        self.cacheBustInterval = cacheBustInterval
+        self.checkTime = None
+        self.cacheBustTime = None
+
+    def bustNfsCache(self):
+        # Patch provided by Sebastien 2018/02/09 for forcing NFS cache
+        cacheBustInterval = self.cacheBustInterval
+        if cacheBustInterval is None:
+            cacheBustInterval = NFS_CACHE_BUST_INTERVAL
+        timeNow = time.time()
+        if (
+            self.cacheBustTime is not None
+            and timeNow - self.cacheBustTime < cacheBustInterval
+        ):
+            return False
+        self.cacheBustTime = timeNow
+        try:
+            fd = os.open(self.directory, os.O_DIRECTORY)
+        except FileNotFoundError:
+            return False
+        try:
+            os.fstat(fd)
+        finally:
+            os.close(fd)
+        return True
+
+    def getSidecarFiles(self, filePrefix, listSuffix):
+        ttl = self.ttl if self.ttl is not None else SIDECAR_TTL
+        with self.lock:
+            timeNow = time.time()
+            if self.checkTime is None or timeNow - self.checkTime >= ttl:
+                self.bustNfsCache()
+                self.refresh()
+                self.checkTime = timeNow
+            dictSidecar = {}
+            for suffix in listSuffix:
+                if filePrefix + suffix in self.names:
+                    dictSidecar[suffix] = os.path.join(
+                        self.directory, filePrefix + suffix
+                    )
+                else:
+                    dictSidecar[suffix] = None
+            return dictSidecar
+
+
+class SerialEMDiscoveryIndex(object):
+    """
+    Finds the first (in path order) TIFF movie of a SerialEM session tree
+    together with the defect map and dm4 gain files of its directory.
+
+    The tree is walked depth-first in path order, so the walk stops at the
+    first directory containing a TIFF file. For each directory visited the
+    mtime, the sub-directories, the first TIFF name and the defect / dm4
+    files are recorded and, if 'indexFilePath' is given, persisted as JSON.
+    A directory whose mtime hasn't changed is not listed again.
+    """
+
+    def __init__(self, topDirectory, indexFilePath=None):
+        self.topDirectory = os.fspath(topDirectory)
+        self.indexFilePath = indexFilePath
+        self.dictDirectory = {}
+        self.modified = False
+        self.load()
+
+    def load(self):
+        if self.indexFilePath is None or not os.path.exists(self.indexFilePath):
+            return
+        try:
+            with open(self.indexFilePath) as fd:
+                dictIndex = json.load(fd)
+        except (OSError, ValueError):
+            return
+        if (
+            dictIndex.get("version") == SERIALEM_INDEX_VERSION
+            and dictIndex.get("topDirectory") == self.topDirectory
+        ):
+            self.dictDirectory = dictIndex["directories"]
+
+    def save(self):
+        if self.indexFilePath is None or not self.modified:
+            return
+        dictIndex = {
+            "version": SERIALEM_INDEX_VERSION,
+            "topDirectory": self.topDirectory,
+            "directories": self.dictDirectory,
+        }
+        tmpFilePath = self.indexFilePath + ".tmp"
+        with open(tmpFilePath, "w") as fd:
+            json.dump(dictIndex, fd)
+        os.replace(tmpFilePath, self.indexFilePath)
+        self.modified = False
+
+    def getRecord(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+        record = self.dictDirectory.get(directory)
+        if record is not None and record["mtime"] == mtime:
+            return record
+        scanTime = time.time()
+        listSubdir = []
+        firstTif = None
+        listDefect = []
+        listDm4 = []
+        try:
+            with os.scandir(directory) as iterator:
+                for entry in iterator:
+                    name = entry.name
+                    # Same as os.walk: symbolic links to directories are not followed
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            listSubdir.append(name)
+                    elif name.endswith(".tif"):
+                        if firstTif is None or name < firstTif:
+                            firstTif = name
+                    elif name.startswith("defect") and name.endswith(".txt"):
+                        listDefect.append(name)
+                    elif name.endswith(".dm4"):
+                        listDm4.append(name)
+        except OSError:
+            return None
+        if scanTime - mtime / 1e9 < MTIME_RESOLUTION:
+            # Could still change within the same mtime, list again next time
+            mtime = None
+        if record is not None:
+            for subdir in set(record["subdirs"]) - set(listSubdir):
+                self.dictDirectory.pop(os.path.join(directory, subdir), None)
+        record = {
+            "mtime": mtime,
+            "subdirs": sorted(listSubdir),
+            "firstTif": firstTif,
+            "defect": max(listDefect) if listDefect else None,
+            "dm4": max(listDm4) if listDm4 else None,
+        }
+        self.dictDirectory[directory] = record
+        self.modified = True
+        return record
+
+    def findFirstTif(self, directory):
+        record = self.getRecord(directory)
+        if record is None:
+            return None
+        # A sub-directory name followed by the separator sorts like the
+        # paths of all the files below it
+        listCandidate = [(subdir + os.sep, subdir) for subdir in record["subdirs"]]
+        if record["firstTif"] is not None:
+            listCandidate.append((record["firstTif"], None))
+        for _, subdir in sorted(listCandidate):
+            if subdir is None:
+                return directory
+            tifDir = self.findFirstTif(os.path.join(directory, subdir))
+            if tifDir is not None:
+                return tifDir
+        return None
+
+    def find(self):
+        tifDir = self.findFirstTif(self.topDirectory)
+        self.save()
+        if tifDir is None:
+            return None, None, None, None
+        record = self.dictDirectory[tifDir]
+        defectFilePath = None
+        dm4FilePath = None
+        if record["defect"] is not None:
+            defectFilePath = os.path.join(tifDir, record["defect"])
+        if record["dm4"] is not None:
+            dm4FilePath = os.path.join(tifDir, record["dm4"])
+        return tifDir, record["firstTif"], defectFilePath, dm4FilePath
+
+
+_DICT_INDEX = {}
+_LOCK_INDEX = threading.Lock()
+
+
+def _getIndex(indexClass, directory, *args):
+    key = (indexClass, os.fspath(directory)) + args
+    with _LOCK_INDEX:
+        if key not in _DICT_INDEX:
+            _DICT_INDEX[key] = indexClass(directory, *args)
+        return _DICT_INDEX[key]
+
+
+class UtilsDirCache(object):
+    """
+    Shared, in-memory indexes of the directories polled by the monitors.
+    One index is kept per directory for the lifetime of the process.
+    """
+
+    @staticmethod
+    def getMotionCorrArtifacts(mrcFilePath, layout):
+        """
+        Returns a dictionary with the 'globalShiftPng', 'thumbnailPng' and
+        'doseWeightMrc' files found for the movie of a motion corrected
+        micrograph. Keys are missing for the files not (yet) written.
+        """
+        record = UtilsFileName.parse(mrcFilePath, layout)
+        if record is None:
+            return {}
+        index = _getIndex(
+            MotionCorrArtifactIndex, os.path.dirname(os.fspath(mrcFilePath)), layout
+        )
+        return index.getArtifacts(record.movieName)
+
+    @staticmethod
+    def getGridSquareSnapshot(gridSquareDir):
+        """
+        Returns the last (in name order, i.e. the most recent) JPEG snapshot
+        of a GridSquare directory, None if there is none.
+        """
+        return _getIndex(GridSquareSnapshotIndex, gridSquareDir).getLastSnapshot()
+
+    @staticmethod
+    def getSidecarFiles(directory, filePrefix, listSuffix):
+        """
+        Returns a dictionary with, for each suffix (e.g. ".xml"), the path
+        of the file 'filePrefix + suffix' in 'directory' or None if it
+        doesn't exist. See SidecarIndex for how long results are trusted.
+        """
+        index = _getIndex(SidecarIndex, directory)
+        return index.getSidecarFiles(filePrefix, listSuffix)
+
+    @staticmethod
+    def clearCache():
+        with _LOCK_INDEX:
+            _DICT_INDEX.clear()
@@ -0,0 +1,154 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import pathlib
+import warnings
+import collections
+import concurrent.futures
+
+import numpy
+
+# Number of header lines of the MotionCor2 -Patch-Full.log files
+PATCH_LOG_HEADER_LINES = 3
+
+# Frames counted as 'early' drift, as in RELION: the motion over the
+# first EARLY_FRAMES frames is early, the rest is late
+EARLY_FRAMES = 4
+
+# Below this number of files 'getShiftDataMany' doesn't start a process pool
+SHIFT_DATA_MIN_POOL = 16
+
+DriftStatistics = collections.namedtuple(
+    "DriftStatistics",
+    [
+        "noPoints",
+        "totalMotion",
+        "averageMotionPerFrame",
+        "maxMotionPerFrame",
+        "earlyMotion",
+        "lateMotion",
+    ],
+)
+
+
+class UtilsDrift(object):
+    """
+    Drift statistics of motion corrected movies, computed with NumPy from
+    the full-frame shifts written by MotionCor2 (-Patch-Full.log). The
+    motion of a frame is the distance between its shift and the shift of
+    the previous frame; averages are per step between frames.
+    """
+
+    @staticmethod
+    def getPatchLogPath(micrographFilePath):
+        micrographFilePath = pathlib.Path(micrographFilePath)
+        movieName = micrographFilePath.stem.split("fractions")[0] + "fractions"
+        return micrographFilePath.parent / (movieName + "-Patch-Full.log")
+
+    @staticmethod
+    def loadShifts(patchLogPath):
+        """
+        Returns the x and y shifts (pixels), one value per frame.
+        """
+        with warnings.catch_warnings():
+            # Empty logs are handled by the callers
+            warnings.simplefilter("ignore", UserWarning)
+            table = numpy.loadtxt(
+                patchLogPath,
+                skiprows=PATCH_LOG_HEADER_LINES,
+                usecols=(1, 2),
+                ndmin=2,
+            )
+        return table[:, 0], table[:, 1]
+
+    @staticmethod
+    def computeStatistics(xShift, yShift):
+        steps = numpy.hypot(numpy.diff(xShift), numpy.diff(yShift))
+        if len(steps) == 0:
+            return DriftStatistics(len(xShift), 0.0, 0.0, 0.0, 0.0, 0.0)
+        earlyMotion = float(steps[: EARLY_FRAMES - 1].sum())
+        totalMotion = float(steps.sum())
+        return DriftStatistics(
+            noPoints=len(xShift),
+            totalMotion=totalMotion,
+            averageMotionPerFrame=totalMotion / len(steps),
+            maxMotionPerFrame=float(steps.max()),
+            earlyMotion=earlyMotion,
+            lateMotion=totalMotion - earlyMotion,
+        )
+
+    @staticmethod
+    def getDriftStatistics(micrographFilePath):
+        """
+        Returns the DriftStatistics of a motion corrected micrograph,
+        None if there is no (readable) -Patch-Full.log next to it.
+        """
+        patchLogPath = UtilsDrift.getPatchLogPath(micrographFilePath)
+        if not patchLogPath.exists():
+            return None
+        try:
+            xShift, yShift = UtilsDrift.loadShifts(patchLogPath)
+        except (OSError, ValueError, IndexError):
+            return None
+        return UtilsDrift.computeStatistics(xShift, yShift)
+
+    @staticmethod
+    def getShiftData(micrographFilePath):
+        """
+        Dictionary of the drift statistics rounded to 0.1 pixels. Only
+        'noPoints' is given if the movie didn't move at all.
+        """
+        dictResults = {}
+        driftStatistics = UtilsDrift.getDriftStatistics(micrographFilePath)
+        if driftStatistics is not None:
+            dictResults["noPoints"] = driftStatistics.noPoints
+            if driftStatistics.totalMotion != 0:
+                for key, value in driftStatistics._asdict().items():
+                    if key != "noPoints":
+                        dictResults[key] = round(value, 1)
+        return dictResults
+
+    @staticmethod
+    def getShiftDataMany(listMicrographFilePath, maxWorkers=None):
+        """
+        'getShiftData' for a list of micrographs, in a process pool if there
+        are at least SHIFT_DATA_MIN_POOL of them. Results are in the same
+        order as the micrographs.
+        """
+        listMicrographFilePath = [os.fspath(path) for path in listMicrographFilePath]
+        if len(listMicrographFilePath) < SHIFT_DATA_MIN_POOL or maxWorkers == 1:
+            return list(map(UtilsDrift.getShiftData, listMicrographFilePath))
+        if maxWorkers is None:
+            maxWorkers = min(os.cpu_count() or 1, 8)
+        chunkSize = max(1, len(listMicrographFilePath) // (4 * maxWorkers))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+            return list(
+                executor.map(
+                    UtilsDrift.getShiftData, listMicrographFilePath, chunksize=chunkSize
+                )
+            )
@@ -0,0 +1,145 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import collections
+import concurrent.futures
+import xml.etree.ElementTree
+
+# Kinds of fields extracted from an EPU XML file
+ELEMENT = "ELEMENT"  # Text of the first element with the tag name
+KEY_VALUE = "KEY_VALUE"  # Value of a KeyValueOfstringanyType entry
+CAMERA_KEY_VALUE = "CAMERA_KEY_VALUE"  # Same, in the first CameraSpecificInput
+
+# Below this number of files 'parseMany' doesn't start a process pool
+PARSE_MANY_MIN_POOL = 16
+
+XmlField = collections.namedtuple("XmlField", ["key", "kind", "name"])
+
+EPU_XML_FIELDS = (
+    XmlField("numberOffractions", ELEMENT, "NumberOffractions"),
+    XmlField("magnification", ELEMENT, "NominalMagnification"),
+    XmlField("positionX", ELEMENT, "X"),
+    XmlField("positionY", ELEMENT, "Y"),
+    XmlField("accelerationVoltage", ELEMENT, "AccelerationVoltage"),
+    XmlField("acquisitionDateTime", ELEMENT, "acquisitionDateTime"),
+    XmlField("dose", KEY_VALUE, "Dose"),
+    XmlField("phasePlateUsed", KEY_VALUE, "PhasePlateUsed"),
+    XmlField("superResolutionFactor", CAMERA_KEY_VALUE, "SuperResolutionFactor"),
+)
+
+
+def _localName(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+class UtilsEpuXml(object):
+    """
+    Extraction of the meta-data of the EPU XML files written next to each
+    movie. The file is read in a single pass with iterparse: elements
+    are matched by local tag name (namespaces ignored) when they end and
+    are cleared as soon as they have been processed.
+    """
+
+    @staticmethod
+    def parse(xmlFilePath, fields=EPU_XML_FIELDS):
+        """
+        Returns a dictionary with the text value of each field found.
+        ELEMENT fields take the first element in document order, key/value
+        fields the last matching entry. Fields not found are missing.
+        """
+        dictElement = {}
+        dictKeyValue = {}
+        dictCameraKeyValue = {}
+        for field in fields:
+            if field.kind == ELEMENT:
+                dictElement[field.name] = field.key
+            elif field.kind == KEY_VALUE:
+                dictKeyValue[field.name] = field.key
+            elif field.kind == CAMERA_KEY_VALUE:
+                dictCameraKeyValue[field.name] = field.key
+            else:
+                raise RuntimeError("Unknown XML field kind: {0}".format(field.kind))
+        dictResults = {}
+        isFirstCameraSpecificInput = True
+        # Key / value pairs since the last element which isn't one
+        listKeyValue = []
+        key = None
+        value = None
+        for _, element in xml.etree.ElementTree.iterparse(xmlFilePath):
+            name = _localName(element.tag)
+            if name == "Key":
+                key = element.text
+            elif name == "Value":
+                value = element.text
+            elif name == "KeyValueOfstringanyType":
+                if key in dictKeyValue:
+                    dictResults[dictKeyValue[key]] = value
+                listKeyValue.append((key, value))
+            else:
+                if name in dictElement:
+                    dictResults[dictElement.pop(name)] = element.text
+                elif name == "CameraSpecificInput" and isFirstCameraSpecificInput:
+                    # Its children are the key / value pairs just before
+                    for key, value in listKeyValue:
+                        if key in dictCameraKeyValue:
+                            dictResults[dictCameraKeyValue[key]] = value
+                    isFirstCameraSpecificInput = False
+                listKeyValue = []
+            element.clear()
+        return dictResults
+
+    @staticmethod
+    def _parseOrNone(xmlFilePath, fields):
+        try:
+            return UtilsEpuXml.parse(xmlFilePath, fields)
+        except (OSError, xml.etree.ElementTree.ParseError):
+            return None
+
+    @staticmethod
+    def parseMany(listXmlFilePath, fields=EPU_XML_FIELDS, maxWorkers=None):
+        """
+        Parses a list of XML files, in a process pool if there are at least
+        PARSE_MANY_MIN_POOL of them. Returns a list of result dictionaries
+        in the same order, None for files which can't be read or parsed.
+        """
+        listXmlFilePath = [os.fspath(xmlFilePath) for xmlFilePath in listXmlFilePath]
+        listFields = [fields] * len(listXmlFilePath)
+        if len(listXmlFilePath) < PARSE_MANY_MIN_POOL or maxWorkers == 1:
+            return list(map(UtilsEpuXml._parseOrNone, listXmlFilePath, listFields))
+        if maxWorkers is None:
+            maxWorkers = min(os.cpu_count() or 1, 8)
+        chunkSize = max(1, len(listXmlFilePath) // (4 * maxWorkers))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+            return list(
+                executor.map(
+                    UtilsEpuXml._parseOrNone,
+                    listXmlFilePath,
+                    listFields,
+                    chunksize=chunkSize,
+                )
+            )
@@ -0,0 +1,51 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import shutil
+
+
+class UtilsFile(object):
+    @staticmethod
+    def linkOrCopy(sourcePath, targetPath):
+        """
+        Puts sourcePath at targetPath as a hardlink, or a copy across file
+        systems. targetPath is replaced atomically.
+        """
+        targetPath = os.fspath(targetPath)
+        if os.path.exists(targetPath) and os.path.samefile(sourcePath, targetPath):
+            return
+        tmpFilePath = targetPath + ".tmp"
+        try:
+            os.link(sourcePath, tmpFilePath)
+        except FileExistsError:
+            os.remove(tmpFilePath)
+            os.link(sourcePath, tmpFilePath)
+        except OSError:
+            shutil.copyfile(sourcePath, tmpFilePath)
+        os.replace(tmpFilePath, targetPath)
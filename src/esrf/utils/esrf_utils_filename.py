@@ -0,0 +1,464 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import re
+import pathlib
+import functools
+import collections
+
+import numpy
+
+# Layouts of movie / micrograph file names
+EPU = "EPU"
+EPU_TIFF = "EPU_TIFF"
+EPU_MOTIONCORR = "EPU_MOTIONCORR"
+EPU_TIFF_MOTIONCORR = "EPU_TIFF_MOTIONCORR"
+SERIALEM_MOTIONCORR = "SERIALEM_MOTIONCORR"
+TOMO = "TOMO"
+
+# Maximum number of parsed paths kept in memory
+PARSE_CACHE_SIZE = 32768
+
+EpuMovie = collections.namedtuple(
+    "EpuMovie",
+    [
+        "directory",
+        "gridSquare",
+        "prefix",
+        "id1",
+        "id2",
+        "id3",
+        "date",
+        "hour",
+        "movieNumber",
+        "extra",
+        "suffix",
+        "movieName",
+    ],
+)
+
+EpuTiffMovie = collections.namedtuple(
+    "EpuTiffMovie",
+    [
+        "directory",
+        "gridSquare",
+        "prefix",
+        "id1",
+        "id2",
+        "id3",
+        "date",
+        "hour",
+        "suffix",
+        "movieName",
+        "movieNumber",
+    ],
+)
+
+EpuMotioncorr = collections.namedtuple(
+    "EpuMotioncorr",
+    [
+        "directory",
+        "gridSquare",
+        "data",
+        "prefix",
+        "id1",
+        "id2",
+        "id3",
+        "date",
+        "hour",
+        "movieNumber",
+        "extra",
+        "suffix",
+        "movieName",
+    ],
+)
+
+EpuTiffMotioncorr = collections.namedtuple(
+    "EpuTiffMotioncorr",
+    [
+        "gridSquare",
+        "prefix",
+        "id1",
+        "id2",
+        "id3",
+        "date",
+        "hour",
+        "extra",
+        "suffix",
+        "movieName",
+        "movieNumber",
+    ],
+)
+
+SerialEMMotioncorr = collections.namedtuple(
+    "SerialEMMotioncorr",
+    ["directory", "prefix", "movieNumber", "extra", "suffix", "movieName"],
+)
+
+TomoMovie = collections.namedtuple(
+    "TomoMovie",
+    [
+        "file_path",
+        "directory",
+        "file_name",
+        "ts_name",
+        "movie_name",
+        "sample_name",
+        "movie_number",
+        "tilt_angle",
+        "date",
+        "time",
+        "extra",
+        "suffix",
+        "icat_raw_dir",
+        "icat_processed_dir",
+        "fractions_name",
+    ],
+)
+
+_EPU_PATTERNS = [
+    re.compile(
+        r"^(.*)/(GridSquare_[0-9]*)/"
+        + r"Data/(.*)_([0-9]*)_Data_([0-9]*)_([0-9]*)_([0-9]*)_([0-9]*)"
+        + r"-([0-9]*)(_?.*)\.(.*)"
+    ),
+    # Without the GridSquare directory
+    re.compile(
+        r"^(.*)/()(.*)_([0-9]*)_Data_([0-9]*)_([0-9]*)_([0-9]*)_([0-9]*)"
+        + r"-([0-9]*)(_?.*)\.(.*)"
+    ),
+]
+
+_EPU_TIFF_PATTERN = re.compile(
+    r"^(.*)/(GridSquare_[0-9]*)/"
+    + r"Data/(.*)_([0-9]*)_Data_([0-9]*)_([0-9]*)_([0-9]*)_([0-9]*)"
+    + r"_fractions\.(.*)"
+)
+
+_EPU_MOTIONCORR_PATTERN = re.compile(
+    r"^(.*)/(GridSquare_[0-9]*)*(_Data_)*(.*)_"
+    + r"([0-9]*)_Data_([0-9]*)_([0-9]*)_([0-9]*)_([0-9]*)-([0-9]*)(_?.*)\.(.*)"
+)
+
+_EPU_TIFF_MOTIONCORR_PATTERN = re.compile(
+    r"^(.*)/Images-Disc(.*)_GridSquare_([0-9]*)_"
+    + r"Data_(.*)_([0-9]*)_Data_([0-9]*)_([0-9]*)_([0-9]*)_([0-9]*)"
+    + r"_fractions_(.*)\.(.*)"
+)
+
+_SERIALEM_MOTIONCORR_PATTERN = re.compile(r"^(.*)/(.*)_([0-9]*)_(.*)\.(.*)")
+
+_TOMO_PATTERN = re.compile(
+    r"^(.+)_(\d+)_(\-*\d+\.\d+)_(\d{8})_(\d{6})_([a-zA-Z0-9]+){1}"
+    + r"([_a-zA-Z0-9]*)\.{1}([a-zA-Z0-9]+)$"
+)
+
+
+def _buildEpu(path):
+    for pattern in _EPU_PATTERNS:
+        m = pattern.match(path)
+        if m is not None:
+            break
+    else:
+        return None
+    _, gridSquare, prefix, id1, id2, id3, date, hour, movieNumber, extra, suffix = (
+        m.groups()
+    )
+    if not hour.isdigit() or not movieNumber.isdigit():
+        return None
+    movieName = "{0}_{1}_Data_{2}_{3}_{4}_{5}-{6}".format(
+        prefix, id1, id2, id3, date, hour, movieNumber
+    )
+    return EpuMovie(
+        directory=os.path.dirname(path),
+        gridSquare=gridSquare or None,
+        prefix=prefix,
+        id1=id1,
+        id2=id2,
+        id3=id3,
+        date=date,
+        hour=hour,
+        movieNumber=movieNumber,
+        extra=extra,
+        suffix=suffix,
+        movieName=movieName,
+    )
+
+
+def _buildEpuTiff(path):
+    m = _EPU_TIFF_PATTERN.match(path)
+    if m is None:
+        return None
+    _, gridSquare, prefix, id1, id2, id3, date, hour, suffix = m.groups()
+    if not hour.isdigit():
+        return None
+    movieName = "{0}_{1}_Data_{2}_{3}_{4}_{5}_fractions".format(
+        prefix, id1, id2, id3, date, hour
+    )
+    return EpuTiffMovie(
+        directory=os.path.dirname(path),
+        gridSquare=gridSquare,
+        prefix=prefix,
+        id1=id1,
+        id2=id2,
+        id3=id3,
+        date=date,
+        hour=hour,
+        suffix=suffix,
+        movieName=movieName,
+        movieNumber=date[-2:] + hour,
+    )
+
+
+def _buildEpuMotioncorr(path):
+    m = _EPU_MOTIONCORR_PATTERN.match(path)
+    if m is None:
+        return None
+    (
+        _,
+        gridSquare,
+        data,
+        prefix,
+        id1,
+        id2,
+        id3,
+        date,
+        hour,
+        movieNumber,
+        extra,
+        suffix,
+    ) = m.groups()
+    movieName = "{0}_{1}_Data_{2}_{3}_{4}_{5}-{6}".format(
+        prefix, id1, id2, id3, date, hour, movieNumber
+    )
+    return EpuMotioncorr(
+        directory=os.path.dirname(path),
+        gridSquare=gridSquare,
+        data=data,
+        prefix=prefix,
+        id1=id1,
+        id2=id2,
+        id3=id3,
+        date=date,
+        hour=hour,
+        movieNumber=movieNumber,
+        extra=extra,
+        suffix=suffix,
+        movieName=movieName,
+    )
+
+
+def _buildEpuTiffMotioncorr(path):
+    m = _EPU_TIFF_MOTIONCORR_PATTERN.match(path)
+    if m is None:
+        return None
+    _, _, gridSquare, prefix, id1, id2, id3, date, hour, extra, suffix = m.groups()
+    movieName = "{0}_{1}_Data_{2}_{3}_{4}_{5}_fractions".format(
+        prefix, id1, id2, id3, date, hour
+    )
+    return EpuTiffMotioncorr(
+        gridSquare=gridSquare,
+        prefix=prefix,
+        id1=id1,
+        id2=id2,
+        id3=id3,
+        date=date,
+        hour=hour,
+        extra=extra,
+        suffix=suffix,
+        movieName=movieName,
+        movieNumber=date[-2:] + hour,
+    )
+
+
+def _buildSerialEMMotioncorr(path):
+    m = _SERIALEM_MOTIONCORR_PATTERN.match(path)
+    if m is None:
+        return None
+    _, prefix, movieNumber, extra, suffix = m.groups()
+    if not movieNumber.isdigit():
+        return None
+    return SerialEMMotioncorr(
+        directory=os.path.dirname(path),
+        prefix=prefix,
+        movieNumber=movieNumber,
+        extra=extra,
+        suffix=suffix,
+        movieName="{0}_{1}".format(prefix, movieNumber),
+    )
+
+
+def _buildTomo(path):
+    file_path = pathlib.Path(path)
+    m = _TOMO_PATTERN.match(file_path.name)
+    if m is None:
+        return None
+    directory = str(file_path.parent)
+    parent_name = str(file_path.parent.name)
+    (
+        ts_name,
+        movie_number,
+        tilt_angle,
+        ts_date,
+        ts_time,
+        fractions_name,
+        extra,
+        suffix,
+    ) = m.groups()
+    movie_name = "_".join(m.groups()[0:6])
+    if "RAW_DATA" in directory or "PROCESSED_DATA" in directory:
+        if "RAW_DATA" in directory:
+            date_dir = directory.split("RAW_DATA")[0]
+        else:
+            date_dir = directory.split("PROCESSED_DATA")[0]
+        icat_raw_dir = os.path.join(
+            date_dir, "RAW_DATA", parent_name, ts_name, movie_number
+        )
+        icat_processed_dir = os.path.join(
+            date_dir, "PROCESSED_DATA", parent_name, ts_name, movie_number
+        )
+    else:
+        icat_raw_dir = directory
+        icat_processed_dir = directory
+    return TomoMovie(
+        file_path=str(file_path),
+        directory=directory,
+        file_name=file_path.name,
+        ts_name=ts_name,
+        movie_name=movie_name,
+        sample_name=f"{parent_name}/{ts_name}",
+        movie_number=int(movie_number),
+        tilt_angle=float(tilt_angle),
+        date=ts_date,
+        time=ts_time,
+        extra=extra,
+        suffix=suffix,
+        icat_raw_dir=icat_raw_dir,
+        icat_processed_dir=icat_processed_dir,
+        fractions_name=fractions_name,
+    )
+
+
+_LAYOUTS = {
+    EPU: _buildEpu,
+    EPU_TIFF: _buildEpuTiff,
+    EPU_MOTIONCORR: _buildEpuMotioncorr,
+    EPU_TIFF_MOTIONCORR: _buildEpuTiffMotioncorr,
+    SERIALEM_MOTIONCORR: _buildSerialEMMotioncorr,
+    TOMO: _buildTomo,
+}
+
+_RECORDS = {
+    EPU: EpuMovie,
+    EPU_TIFF: EpuTiffMovie,
+    EPU_MOTIONCORR: EpuMotioncorr,
+    EPU_TIFF_MOTIONCORR: EpuTiffMotioncorr,
+    SERIALEM_MOTIONCORR: SerialEMMotioncorr,
+    TOMO: TomoMovie,
+}
+
+# Columns which are not strings in the batch results, with fill values
+# for the paths which couldn't be parsed
+_NUMERIC_COLUMNS = {
+    "movie_number": (numpy.int64, -1),
+    "tilt_angle": (numpy.float64, numpy.nan),
+}
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse(path, layout):
+    return _LAYOUTS[layout](path)
+
+
+class UtilsFileName(object):
+    """
+    Grammar of the movie and micrograph file names produced by EPU,
+    SerialEM, MotionCor2 and tomography acquisitions.
+
+    All regular expressions are compiled once at import and parsed
+    paths are kept in a bounded LRU cache. The records returned are
+    immutable named tuples, use '_asdict()' for a mutable copy.
+    """
+
+    @staticmethod
+    def parse(path, layout):
+        if layout not in _LAYOUTS:
+            raise RuntimeError("Unknown file name layout: {0}".format(layout))
+        return _parse(os.fspath(path), layout)
+
+    @staticmethod
+    def parseToDict(path, layout):
+        record = UtilsFileName.parse(path, layout)
+        if record is None:
+            return None
+        return record._asdict()
+
+    @staticmethod
+    def parseMany(paths, layout):
+        """
+        Parses a whole list of paths and returns a dictionary of NumPy
+        arrays, one per record field plus "path" and "valid". Rows for
+        paths which couldn't be parsed have "valid" set to False and
+        empty strings (or -1 / NaN for numeric fields) as values.
+        The LRU cache of 'parse' is bypassed so that a batch of a
+        whole session doesn't evict the entries of the running monitor.
+        """
+        if layout not in _LAYOUTS:
+            raise RuntimeError("Unknown file name layout: {0}".format(layout))
+        build = _LAYOUTS[layout]
+        listPath = [os.fspath(path) for path in paths]
+        listRecord = [build(path) for path in listPath]
+        valid = numpy.array([record is not None for record in listRecord], dtype=bool)
+        listValidRecord = [record for record in listRecord if record is not None]
+        dictColumns = {"path": numpy.array(listPath, dtype=str), "valid": valid}
+        # Transpose the records into columns
+        fields = _RECORDS[layout]._fields
+        if len(listValidRecord) > 0:
+            listColumn = list(zip(*listValidRecord))
+        else:
+            listColumn = [()] * len(fields)
+        for field, column in zip(fields, listColumn):
+            if field in _NUMERIC_COLUMNS:
+                dtype, fillValue = _NUMERIC_COLUMNS[field]
+            else:
+                dtype, fillValue = str, ""
+                if None in column:
+                    column = ["" if value is None else value for value in column]
+            validValues = numpy.array(column, dtype=dtype)
+            if len(validValues) == len(listRecord):
+                dictColumns[field] = validValues
+            else:
+                dictColumns[field] = numpy.full(
+                    len(listRecord), fillValue, dtype=validValues.dtype
+                )
+                dictColumns[field][valid] = validValues
+        return dictColumns
+
+    @staticmethod
+    def clearCache():
+        _parse.cache_clear()
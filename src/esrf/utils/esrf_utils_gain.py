@@ -0,0 +1,400 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import json
+import struct
+import hashlib
+import threading
+import collections
+
+import numpy
+
+from esrf.utils.esrf_utils_file import UtilsFile
+from esrf.utils.esrf_utils_header import UtilsHeader
+
+# Digital Micrograph 4 tag file
+DM4_VERSION = 4
+DM_TAG_GROUP = 20
+DM_TAG_DATA = 21
+DM_TYPE_STRUCT = 15
+DM_TYPE_STRING = 18
+DM_TYPE_ARRAY = 20
+# DM simple type -> numpy type, without byte order
+DM_SIMPLE_TYPE = {
+    2: "i2",
+    3: "i4",
+    4: "u2",
+    5: "u4",
+    6: "f4",
+    7: "f8",
+    8: "u1",
+    9: "i1",
+    10: "u1",
+    11: "i8",
+    12: "u8",
+}
+
+# Data types without an MRC mode are written as float32, as dm2mrc does
+MRC_WRITE_DTYPE = {"i1": "i1", "u1": "u1", "i2": "i2", "u2": "u2", "f4": "f4"}
+# Rows converted and written at a time
+MRC_WRITE_ROWS = 512
+
+# SerialEM defect list keywords which change the geometry and aren't
+# rasterized here, 'clip defect' has to be used for those
+DEFECT_UNSUPPORTED = ["RotationFlip", "WasScaled"]
+
+# Converted gain references and defect maps shared between sessions,
+# keyed by the SHA-256 of the input files
+GAIN_CACHE_DIR = os.environ.get(
+    "ESRF_GAIN_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "scipion-em-esrf", "gain"),
+)
+GAIN_CACHE_MAX_ENTRIES = 32
+HASH_CHUNK_SIZE = 1024**2
+
+# Array of 'count' values of 'dtype' (with byte order) at 'offset' in the
+# DM file, the data isn't read when parsing the tags
+DmArray = collections.namedtuple("DmArray", ["offset", "dtype", "count"])
+
+
+class UtilsGain(object):
+    """
+    In-process replacement of 'dm2mrc' and 'clip defect' for SerialEM
+    gain references and defect lists.
+
+    The DM4 tag tree is parsed without reading the arrays, the image data
+    is then memory-mapped and written to MRC by blocks of rows. Defect
+    lists are rasterized with numpy to the size of a movie, defects given
+    in camera pixels are scaled up for super-resolution movies.
+    """
+
+    @staticmethod
+    def readDm4Tags(dm4FilePath):
+        """
+        Returns the root tag group of a DM4 file and the data byte order.
+        Groups are dicts, or lists when their tags have no names, arrays
+        are DmArray records.
+        """
+        with open(dm4FilePath, "rb") as fd:
+            try:
+                version, _, byteOrder = struct.unpack(">IQI", fd.read(16))
+                if version != DM4_VERSION:
+                    raise RuntimeError(
+                        f"File {dm4FilePath} is not a DM4 file (version {version})"
+                    )
+                byteOrder = "<" if byteOrder == 1 else ">"
+                root = UtilsGain._readGroup(fd, byteOrder)
+            except struct.error as error:
+                raise RuntimeError(f"Truncated DM4 file {dm4FilePath}: {error}")
+        return root, byteOrder
+
+    @staticmethod
+    def _readGroup(fd, byteOrder):
+        _, _, noTags = struct.unpack(">BBQ", fd.read(10))
+        listTag = []
+        for _ in range(noTags):
+            tagType, nameLength = struct.unpack(">BH", fd.read(3))
+            name = fd.read(nameLength).decode("latin-1")
+            # Size of the tag content
+            fd.read(8)
+            if tagType == DM_TAG_GROUP:
+                value = UtilsGain._readGroup(fd, byteOrder)
+            elif tagType == DM_TAG_DATA:
+                value = UtilsGain._readData(fd, byteOrder)
+            else:
+                raise RuntimeError(f"Unknown DM tag type {tagType} at {fd.tell()}")
+            listTag.append((name, value))
+        if all(name == "" for name, _ in listTag):
+            return [value for _, value in listTag]
+        return dict(listTag)
+
+    @staticmethod
+    def _readData(fd, byteOrder):
+        if fd.read(4) != b"%%%%":
+            raise RuntimeError(f"Invalid DM data tag at {fd.tell()}")
+        noInfo = struct.unpack(">Q", fd.read(8))[0]
+        listInfo = struct.unpack(">{0}Q".format(noInfo), fd.read(8 * noInfo))
+        dataType = listInfo[0]
+        if dataType in DM_SIMPLE_TYPE:
+            dtype = numpy.dtype(byteOrder + DM_SIMPLE_TYPE[dataType])
+            return numpy.frombuffer(fd.read(dtype.itemsize), dtype)[0].item()
+        elif dataType == DM_TYPE_STRING:
+            return fd.read(2 * listInfo[1]).decode(
+                "utf-16-le" if byteOrder == "<" else "utf-16-be"
+            )
+        elif dataType == DM_TYPE_STRUCT:
+            dtype = UtilsGain._getStructDtype(listInfo[2:], byteOrder)
+            return tuple(numpy.frombuffer(fd.read(dtype.itemsize), dtype)[0].item())
+        elif dataType == DM_TYPE_ARRAY:
+            elementType = listInfo[1]
+            if elementType in DM_SIMPLE_TYPE:
+                dtype = numpy.dtype(byteOrder + DM_SIMPLE_TYPE[elementType])
+            elif elementType == DM_TYPE_STRUCT:
+                dtype = UtilsGain._getStructDtype(listInfo[3:-1], byteOrder)
+            else:
+                raise RuntimeError(f"Unsupported DM array of type {elementType}")
+            dmArray = DmArray(offset=fd.tell(), dtype=dtype, count=listInfo[-1])
+            fd.seek(dtype.itemsize * dmArray.count, os.SEEK_CUR)
+            return dmArray
+        raise RuntimeError(f"Unsupported DM data type {dataType}")
+
+    @staticmethod
+    def _getStructDtype(listFieldInfo, byteOrder):
+        # Number of fields followed by (name length, type) pairs
+        noFields = listFieldInfo[0]
+        listFieldType = listFieldInfo[2 : 2 + 2 * noFields : 2]
+        if any(fieldType not in DM_SIMPLE_TYPE for fieldType in listFieldType):
+            raise RuntimeError("Unsupported DM struct field type")
+        return numpy.dtype(
+            [
+                ("f{0}".format(index), byteOrder + DM_SIMPLE_TYPE[fieldType])
+                for index, fieldType in enumerate(listFieldType)
+            ]
+        )
+
+    @staticmethod
+    def loadDm4Image(dm4FilePath):
+        """
+        Returns the main image of a DM4 file (the last one of the image
+        list, the first one being the thumbnail) as a read-only memmap of
+        shape (height, width) or (frames, height, width).
+        """
+        root, _ = UtilsGain.readDm4Tags(dm4FilePath)
+        try:
+            imageData = root["ImageList"][-1]["ImageData"]
+            data = imageData["Data"]
+            dimensions = imageData["Dimensions"]
+        except (KeyError, IndexError, TypeError):
+            raise RuntimeError(f"No image in DM4 file {dm4FilePath}")
+        shape = tuple(reversed(dimensions))
+        if int(numpy.prod(shape)) != data.count or data.dtype.names is not None:
+            raise RuntimeError(f"Unsupported image data in DM4 file {dm4FilePath}")
+        return numpy.memmap(
+            dm4FilePath, dtype=data.dtype, mode="r", offset=data.offset, shape=shape
+        )
+
+    @staticmethod
+    def writeMrc(mrcFilePath, data, pixelSize=None):
+        """
+        Writes a 2D or 3D array as MRC by blocks of rows, so that a
+        memory-mapped input is never loaded at once.
+        """
+        if data.ndim == 2:
+            data = data[numpy.newaxis]
+        writeDtype = numpy.dtype("<" + MRC_WRITE_DTYPE.get(data.dtype.str[1:], "f4"))
+        minimum, maximum, total = None, None, 0.0
+        tmpFilePath = str(mrcFilePath) + ".tmp"
+        with open(tmpFilePath, "wb") as fd:
+            fd.write(UtilsHeader.createMrcHeader(data.shape, writeDtype))
+            for frame in data:
+                for row in range(0, frame.shape[0], MRC_WRITE_ROWS):
+                    block = frame[row : row + MRC_WRITE_ROWS].astype(writeDtype)
+                    fd.write(block.tobytes())
+                    blockMin, blockMax = block.min(), block.max()
+                    minimum = blockMin if minimum is None else min(minimum, blockMin)
+                    maximum = blockMax if maximum is None else max(maximum, blockMax)
+                    total += float(block.sum(dtype=numpy.float64))
+            fd.seek(0)
+            fd.write(
+                UtilsHeader.createMrcHeader(
+                    data.shape,
+                    writeDtype,
+                    pixelSize=pixelSize,
+                    statistics=(minimum, maximum, total / max(data.size, 1)),
+                )
+            )
+        os.replace(tmpFilePath, mrcFilePath)
+        return mrcFilePath
+
+    @staticmethod
+    def convertDm4ToMrc(dm4FilePath, mrcFilePath):
+        return UtilsGain.writeMrc(mrcFilePath, UtilsGain.loadDm4Image(dm4FilePath))
+
+    @staticmethod
+    def readDefectList(defectFilePath):
+        """
+        Reads a SerialEM defect list: keyword followed by integers, one
+        or more lines per keyword. Returns keyword -> list of integers.
+        """
+        dictDefect = {}
+        with open(defectFilePath) as fd:
+            for line in fd:
+                listItem = line.split()
+                if not listItem or listItem[0].startswith("#"):
+                    continue
+                try:
+                    listValue = [int(item) for item in listItem[1:]]
+                except ValueError:
+                    raise RuntimeError(
+                        f"Invalid line in defect list {defectFilePath}: {line.strip()}"
+                    )
+                dictDefect.setdefault(listItem[0], []).extend(listValue)
+        return dictDefect
+
+    @staticmethod
+    def createDefectMap(dictDefect, width, height):
+        """
+        Rasterizes a defect list to a (height, width) uint8 array, 1 for
+        defects. Coordinates are camera pixels, scaled by the ratio of
+        width to 'CameraSizeX' for super-resolution images.
+        """
+        for keyword in DEFECT_UNSUPPORTED:
+            if any(dictDefect.get(keyword, [0])):
+                raise RuntimeError(f"Defect list keyword {keyword} is not supported")
+        cameraSizeX = dictDefect.get("CameraSizeX", [width])[0]
+        cameraSizeY = dictDefect.get("CameraSizeY", [height])[0]
+        scale = width // cameraSizeX if cameraSizeX else 0
+        if scale < 1 or cameraSizeX * scale != width or cameraSizeY * scale != height:
+            raise RuntimeError(
+                f"Defect list camera size {cameraSizeX}x{cameraSizeY} "
+                f"doesn't match image size {width}x{height}"
+            )
+        defectMap = numpy.zeros((height, width), dtype=numpy.uint8)
+        offsets = numpy.arange(scale)
+
+        def expand(listIndex):
+            # Camera pixel index -> image pixel indices
+            indices = numpy.asarray(listIndex, dtype=numpy.int64)
+            return (indices[:, numpy.newaxis] * scale + offsets).ravel()
+
+        if dictDefect.get("BadColumns"):
+            defectMap[:, expand(dictDefect["BadColumns"])] = 1
+        if dictDefect.get("BadRows"):
+            defectMap[expand(dictDefect["BadRows"]), :] = 1
+        # Index, first and last pixel along the column / row
+        listPartial = dictDefect.get("PartialBadCol", [])
+        for column, first, last in zip(*[iter(listPartial)] * 3):
+            defectMap[first * scale : (last + 1) * scale, expand([column])] = 1
+        listPartial = dictDefect.get("PartialBadRow", [])
+        for row, first, last in zip(*[iter(listPartial)] * 3):
+            defectMap[expand([row]), first * scale : (last + 1) * scale] = 1
+        listPixel = dictDefect.get("BadPixels", [])
+        if listPixel:
+            pixels = numpy.asarray(listPixel[: len(listPixel) // 2 * 2]).reshape(-1, 2)
+            columns = expand(pixels[:, 0]).reshape(-1, scale)
+            rows = expand(pixels[:, 1]).reshape(-1, scale)
+            defectMap[rows[:, :, numpy.newaxis], columns[:, numpy.newaxis, :]] = 1
+        return defectMap
+
+    @staticmethod
+    def convertDefectList(defectFilePath, width, height, mrcFilePath):
+        defectMap = UtilsGain.createDefectMap(
+            UtilsGain.readDefectList(defectFilePath), width, height
+        )
+        return UtilsGain.writeMrc(mrcFilePath, defectMap)
+
+    @staticmethod
+    def getCache():
+        global _GAIN_CACHE
+        with _LOCK_GAIN_CACHE:
+            if _GAIN_CACHE is None:
+                _GAIN_CACHE = GainCache(GAIN_CACHE_DIR)
+            return _GAIN_CACHE
+
+    @staticmethod
+    def setCache(gainCache):
+        """
+        Replaces the shared GainCache, None restores the default one.
+        """
+        global _GAIN_CACHE
+        with _LOCK_GAIN_CACHE:
+            _GAIN_CACHE = gainCache
+
+
+class GainCache(object):
+    """
+    Converted files keyed by the SHA-256 of the contents of their input
+    files and by the conversion parameters. A conversion is done once and
+    handed out as a hardlink (a copy across file systems); the least
+    recently used entries above maxEntries are removed.
+    """
+
+    def __init__(self, cacheDirectory, maxEntries=GAIN_CACHE_MAX_ENTRIES):
+        self.cacheDirectory = os.fspath(cacheDirectory)
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def getKey(listInputFilePath, parameters):
+        sha256 = hashlib.sha256(json.dumps(parameters, sort_keys=True).encode())
+        for inputFilePath in listInputFilePath:
+            with open(inputFilePath, "rb") as fd:
+                for chunk in iter(lambda: fd.read(HASH_CHUNK_SIZE), b""):
+                    sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def getEntryPath(self, key):
+        return os.path.join(self.cacheDirectory, key[:2], key + ".mrc")
+
+    def _evict(self):
+        listEntry = []
+        for subDirEntry in os.scandir(self.cacheDirectory):
+            if subDirEntry.is_dir():
+                for entry in os.scandir(subDirEntry.path):
+                    if entry.name.endswith(".mrc"):
+                        listEntry.append((entry.stat().st_mtime, entry.path))
+        for _, entryPath in sorted(listEntry)[: -self.maxEntries or None]:
+            try:
+                os.remove(entryPath)
+            except FileNotFoundError:
+                pass
+
+    def getFile(self, listInputFilePath, outputFilePath, convert, **parameters):
+        """
+        Puts the conversion of listInputFilePath at outputFilePath, calling
+        convert(filePath) only if it isn't in the cache. Returns
+        outputFilePath.
+        """
+        entryPath = self.getEntryPath(self.getKey(listInputFilePath, parameters))
+        if os.path.exists(entryPath):
+            os.utime(entryPath)
+        else:
+            try:
+                os.makedirs(os.path.dirname(entryPath), exist_ok=True)
+            except OSError:
+                # Cache not writable
+                convert(outputFilePath)
+                return outputFilePath
+            convertPath = "{0}.{1}.{2}.tmp".format(
+                entryPath, os.getpid(), threading.get_ident()
+            )
+            convert(convertPath)
+            os.replace(convertPath, entryPath)
+            with self.lock:
+                if self.maxEntries > 0:
+                    self._evict()
+        if os.path.exists(entryPath):
+            UtilsFile.linkOrCopy(entryPath, outputFilePath)
+        else:
+            convert(outputFilePath)
+        return outputFilePath
+
+
+_GAIN_CACHE = None
+_LOCK_GAIN_CACHE = threading.Lock()
@@ -0,0 +1,311 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import math
+import bisect
+
+import numpy
+
+# Number of centroids kept by a QuantileSketch
+SKETCH_SIZE = 64
+
+# Quantities followed per grid square, the positions only need a mean
+GRID_SQUARE_QUANTITIES = [
+    "positionX",
+    "positionY",
+    "defocus",
+    "resolutionLimit",
+    "totalMotion",
+]
+SKETCHED_QUANTITIES = ["defocus", "resolutionLimit", "totalMotion"]
+
+# Stages at which the values of a movie are added
+STAGE_MOVIE = "movie"
+STAGE_MOTION_CORRECTION = "motionCorrection"
+STAGE_CTF = "ctf"
+LIST_STAGE = [STAGE_MOVIE, STAGE_MOTION_CORRECTION, STAGE_CTF]
+
+
+def _toFloat(value):
+    # None for missing or invalid values
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(value) or math.isinf(value) else value
+
+
+class QuantileSketch(object):
+    """
+    Fixed size summary of a distribution: at most 'size' centroids (mean,
+    weight) sorted by mean. When full, the adjacent pair with the smallest
+    total weight is merged, so the memory and the cost of an update don't
+    depend on the number of values.
+    """
+
+    def __init__(self, size=SKETCH_SIZE):
+        self.size = size
+        self.listMean = []
+        self.listWeight = []
+
+    def add(self, value, weight=1):
+        index = bisect.bisect(self.listMean, value)
+        self.listMean.insert(index, value)
+        self.listWeight.insert(index, weight)
+        if len(self.listMean) > self.size:
+            index = min(
+                range(len(self.listWeight) - 1),
+                key=lambda i: self.listWeight[i] + self.listWeight[i + 1],
+            )
+            weight = self.listWeight[index] + self.listWeight[index + 1]
+            mean = (
+                self.listMean[index] * self.listWeight[index]
+                + self.listMean[index + 1] * self.listWeight[index + 1]
+            ) / weight
+            self.listMean[index : index + 2] = [mean]
+            self.listWeight[index : index + 2] = [weight]
+
+    def quantile(self, fraction, minimum=None, maximum=None):
+        """
+        Estimated value below which 'fraction' of the values are, linearly
+        interpolated between the centroids and, if given, the minimum and
+        maximum of the values.
+        """
+        if not self.listMean:
+            return None
+        totalWeight = sum(self.listWeight)
+        listRank = []
+        cumulated = 0.0
+        for weight in self.listWeight:
+            listRank.append(cumulated + weight / 2.0)
+            cumulated += weight
+        listValue = list(self.listMean)
+        if minimum is not None:
+            listRank.insert(0, 0.0)
+            listValue.insert(0, minimum)
+        if maximum is not None:
+            listRank.append(totalWeight)
+            listValue.append(maximum)
+        return float(numpy.interp(fraction * totalWeight, listRank, listValue))
+
+    def toDict(self):
+        return {"size": self.size, "mean": self.listMean, "weight": self.listWeight}
+
+    @classmethod
+    def fromDict(cls, dictSketch):
+        sketch = cls(dictSketch["size"])
+        sketch.listMean = list(dictSketch["mean"])
+        sketch.listWeight = list(dictSketch["weight"])
+        return sketch
+
+
+class RunningStatistics(object):
+    """
+    Welford running count / mean / variance with minimum and maximum, and
+    optionally a QuantileSketch of the values.
+    """
+
+    def __init__(self, withSketch=False):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.sketch = QuantileSketch() if withSketch else None
+
+    def add(self, value):
+        value = _toFloat(value)
+        if value is None:
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        if self.sketch is not None:
+            self.sketch.add(value)
+
+    def getMean(self):
+        return self.mean if self.count > 0 else None
+
+    def getVariance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else None
+
+    def getQuantile(self, fraction):
+        if self.sketch is None:
+            return None
+        return self.sketch.quantile(fraction, self.minimum, self.maximum)
+
+    def getSummary(self):
+        variance = self.getVariance()
+        dictSummary = {
+            "count": self.count,
+            "mean": self.getMean(),
+            "std": math.sqrt(variance) if variance is not None else None,
+            "min": self.minimum,
+            "max": self.maximum,
+        }
+        if self.sketch is not None:
+            dictSummary["median"] = self.getQuantile(0.5)
+            dictSummary["p10"] = self.getQuantile(0.1)
+            dictSummary["p90"] = self.getQuantile(0.9)
+        return dictSummary
+
+    def toDict(self):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "m2": self.m2,
+            "min": self.minimum,
+            "max": self.maximum,
+            "sketch": self.sketch.toDict() if self.sketch is not None else None,
+        }
+
+    @classmethod
+    def fromDict(cls, dictStatistics):
+        statistics = cls()
+        statistics.count = dictStatistics["count"]
+        statistics.mean = dictStatistics["mean"]
+        statistics.m2 = dictStatistics["m2"]
+        statistics.minimum = dictStatistics["min"]
+        statistics.maximum = dictStatistics["max"]
+        if dictStatistics.get("sketch") is not None:
+            statistics.sketch = QuantileSketch.fromDict(dictStatistics["sketch"])
+        return statistics
+
+
+class GridSquareStatistics(object):
+    """
+    Running statistics of one grid square, updated as each movie, motion
+    correction and CTF result is recorded. 'toDict' gives a JSON
+    serializable dictionary stored with the session state. The names of
+    the movies counted at each stage are kept, so that a result recorded
+    again (e.g. a movie uploaded again) is only counted once.
+    """
+
+    def __init__(self):
+        self.dictStatistics = {
+            quantity: RunningStatistics(withSketch=quantity in SKETCHED_QUANTITIES)
+            for quantity in GRID_SQUARE_QUANTITIES
+        }
+        self.dictMovieName = {stage: set() for stage in LIST_STAGE}
+
+    def _count(self, stage, movieName):
+        # False if movieName was already counted at this stage
+        if movieName is None:
+            return True
+        if movieName in self.dictMovieName[stage]:
+            return False
+        self.dictMovieName[stage].add(movieName)
+        return True
+
+    def addMovie(self, positionX, positionY, movieName=None):
+        if self._count(STAGE_MOVIE, movieName):
+            self.dictStatistics["positionX"].add(positionX)
+            self.dictStatistics["positionY"].add(positionY)
+
+    def addMotionCorrection(self, totalMotion, movieName=None):
+        if self._count(STAGE_MOTION_CORRECTION, movieName):
+            self.dictStatistics["totalMotion"].add(totalMotion)
+
+    def addCtf(self, defocusU, defocusV, resolutionLimit, movieName=None):
+        if not self._count(STAGE_CTF, movieName):
+            return
+        defocusU = _toFloat(defocusU)
+        defocusV = _toFloat(defocusV)
+        if defocusU is not None and defocusV is not None:
+            self.dictStatistics["defocus"].add((defocusU + defocusV) / 2.0)
+        self.dictStatistics["resolutionLimit"].add(resolutionLimit)
+
+    def getMean(self, quantity):
+        return self.dictStatistics[quantity].getMean()
+
+    def getSummary(self):
+        return {
+            quantity: statistics.getSummary()
+            for quantity, statistics in self.dictStatistics.items()
+        }
+
+    def toDict(self):
+        dictGridSquareStatistics = {
+            quantity: statistics.toDict()
+            for quantity, statistics in self.dictStatistics.items()
+        }
+        dictGridSquareStatistics["movieNames"] = {
+            stage: sorted(setMovieName)
+            for stage, setMovieName in self.dictMovieName.items()
+        }
+        return dictGridSquareStatistics
+
+    @classmethod
+    def fromDict(cls, dictGridSquareStatistics):
+        gridSquareStatistics = cls()
+        for quantity, dictStatistics in dictGridSquareStatistics.items():
+            if quantity in gridSquareStatistics.dictStatistics:
+                gridSquareStatistics.dictStatistics[quantity] = (
+                    RunningStatistics.fromDict(dictStatistics)
+                )
+        for stage, listMovieName in dictGridSquareStatistics.get(
+            "movieNames", {}
+        ).items():
+            if stage in gridSquareStatistics.dictMovieName:
+                gridSquareStatistics.dictMovieName[stage] = set(listMovieName)
+        return gridSquareStatistics
+
+    @classmethod
+    def fromMovies(cls, listDictMovie):
+        """
+        Statistics of the movie entries of a session state, for sessions
+        started before the statistics were recorded. With a dictionary of
+        movie name to entry the movies are counted by name, the motion
+        correction and CTF stages only if the entry has their results.
+        """
+        if isinstance(listDictMovie, dict):
+            listItem = listDictMovie.items()
+        else:
+            listItem = [(None, dictMovie) for dictMovie in listDictMovie]
+        gridSquareStatistics = cls()
+        for movieName, dictMovie in listItem:
+            gridSquareStatistics.addMovie(
+                dictMovie.get("positionX"), dictMovie.get("positionY"), movieName
+            )
+            if dictMovie.get("totalMotion") is not None:
+                gridSquareStatistics.addMotionCorrection(
+                    dictMovie["totalMotion"], movieName
+                )
+            if (
+                dictMovie.get("defocusU") is not None
+                or dictMovie.get("resolutionLimit") is not None
+            ):
+                gridSquareStatistics.addCtf(
+                    dictMovie.get("defocusU"),
+                    dictMovie.get("defocusV"),
+                    dictMovie.get("resolutionLimit"),
+                    movieName,
+                )
+        return gridSquareStatistics
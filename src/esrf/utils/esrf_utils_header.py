@@ -0,0 +1,307 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import struct
+import collections
+
+import numpy
+
+MRC = "MRC"
+TIFF = "TIFF"
+
+# MRC2014 header
+MRC_HEADER_SIZE = 1024
+MRC_MODE_DTYPE = {
+    0: numpy.int8,
+    1: numpy.int16,
+    2: numpy.float32,
+    6: numpy.uint16,
+    12: numpy.float16,
+}
+MRC_MACHST_BIG_ENDIAN = 0x11
+
+# TIFF tags
+TIFF_IMAGE_WIDTH = 256
+TIFF_IMAGE_LENGTH = 257
+TIFF_BITS_PER_SAMPLE = 258
+TIFF_COMPRESSION = 259
+TIFF_X_RESOLUTION = 282
+TIFF_RESOLUTION_UNIT = 296
+TIFF_SAMPLE_FORMAT = 339
+# Angstrom per resolution unit (2: inch, 3: cm)
+TIFF_UNIT_ANGSTROM = {2: 2.54e8, 3: 1e8}
+# Field type -> (struct format, size)
+TIFF_FIELD_TYPE = {
+    1: ("B", 1),
+    3: ("H", 2),
+    4: ("I", 4),
+    5: ("II", 8),
+    16: ("Q", 8),
+}
+TIFF_SAMPLE_KIND = {1: "u", 2: "i", 3: "f"}
+
+# Movies probed by 'checkHomogeneous'
+HOMOGENEITY_SAMPLE_SIZE = 10
+HOMOGENEITY_FIELDS = ["format", "frames", "width", "height", "dtype"]
+
+# 'dtype' is a numpy dtype string ('<u2', '<f4'...), 'pixelSize' in A, None
+# if not in the header, 'dataOffset' the offset of the first frame for MRC
+MovieHeader = collections.namedtuple(
+    "MovieHeader",
+    [
+        "path",
+        "format",
+        "frames",
+        "width",
+        "height",
+        "dtype",
+        "pixelSize",
+        "compression",
+        "dataOffset",
+    ],
+)
+
+
+class UtilsHeader(object):
+    """
+    Reads the frame count, dimensions, data type and pixel size of MRC and
+    multi-page TIFF movies from their headers only: the 1024 bytes MRC
+    header, or the chain of TIFF image file directories (no pixel data
+    is decoded), so probing doesn't depend on the size of the movie.
+    """
+
+    @staticmethod
+    def probe(movieFilePath):
+        movieFilePath = os.fspath(movieFilePath)
+        with open(movieFilePath, "rb") as fd:
+            magic = fd.read(4)
+            fd.seek(0)
+            try:
+                if magic[:2] in [b"II", b"MM"]:
+                    return UtilsHeader._probeTiff(movieFilePath, fd)
+                return UtilsHeader._probeMrc(movieFilePath, fd)
+            except struct.error as error:
+                raise RuntimeError(f"Truncated header in {movieFilePath}: {error}")
+
+    @staticmethod
+    def _probeMrc(movieFilePath, fd):
+        header = fd.read(MRC_HEADER_SIZE)
+        if len(header) < MRC_HEADER_SIZE:
+            raise RuntimeError(f"File {movieFilePath} is neither a MRC nor a TIFF file")
+        byteOrder = ">" if header[212] == MRC_MACHST_BIG_ENDIAN else "<"
+        nx, ny, nz, mode = struct.unpack_from(byteOrder + "4i", header, 0)
+        mx = struct.unpack_from(byteOrder + "i", header, 28)[0]
+        xlen = struct.unpack_from(byteOrder + "f", header, 40)[0]
+        nsymbt = struct.unpack_from(byteOrder + "i", header, 92)[0]
+        if mode not in MRC_MODE_DTYPE:
+            raise RuntimeError(f"Unsupported MRC mode {mode} in {movieFilePath}")
+        dtype = numpy.dtype(MRC_MODE_DTYPE[mode]).newbyteorder(byteOrder)
+        pixelSize = xlen / mx if mx > 0 and xlen > 0 else None
+        return MovieHeader(
+            path=movieFilePath,
+            format=MRC,
+            frames=nz,
+            width=nx,
+            height=ny,
+            dtype=dtype.str,
+            pixelSize=pixelSize,
+            compression=None,
+            dataOffset=MRC_HEADER_SIZE + nsymbt,
+        )
+
+    @staticmethod
+    def createMrcHeader(shape, dtype, pixelSize=None, statistics=None):
+        """
+        Returns a little endian MRC2014 header for data of the given
+        (frames, height, width) shape and dtype (one of MRC_MODE_DTYPE,
+        uint8 is written as mode 0). statistics is (min, max, mean).
+        """
+        dtype = numpy.dtype(dtype)
+        if dtype == numpy.uint8:
+            mode = 0
+        else:
+            listMode = [
+                mode
+                for mode, modeDtype in MRC_MODE_DTYPE.items()
+                if numpy.dtype(modeDtype) == dtype.newbyteorder("=")
+            ]
+            if not listMode:
+                raise RuntimeError(f"No MRC mode for data type {dtype}")
+            mode = listMode[0]
+        nz, ny, nx = shape
+        header = bytearray(MRC_HEADER_SIZE)
+        struct.pack_into("<10i", header, 0, nx, ny, nz, mode, 0, 0, 0, nx, ny, nz)
+        if pixelSize is not None:
+            struct.pack_into(
+                "<3f", header, 40, nx * pixelSize, ny * pixelSize, nz * pixelSize
+            )
+        struct.pack_into("<3f3i", header, 52, 90.0, 90.0, 90.0, 1, 2, 3)
+        if statistics is not None:
+            struct.pack_into("<3f", header, 76, *statistics)
+        struct.pack_into("<i", header, 108, 20140)
+        header[208:212] = b"MAP "
+        header[212:214] = b"\x44\x44"
+        return bytes(header)
+
+    @staticmethod
+    def _probeTiff(movieFilePath, fd):
+        header = fd.read(16)
+        byteOrder = "<" if header[:2] == b"II" else ">"
+        version = struct.unpack_from(byteOrder + "H", header, 2)[0]
+        if version == 42:
+            # Classic TIFF: 2 bytes entry count, 12 bytes entries, 4 bytes offsets
+            countFormat, entrySize, offsetFormat = "H", 12, "I"
+            ifdOffset = struct.unpack_from(byteOrder + "I", header, 4)[0]
+        elif version == 43:
+            # BigTIFF
+            countFormat, entrySize, offsetFormat = "Q", 20, "Q"
+            ifdOffset = struct.unpack_from(byteOrder + "Q", header, 8)[0]
+        else:
+            raise RuntimeError(f"File {movieFilePath} is not a TIFF file")
+        countSize = struct.calcsize(countFormat)
+        offsetSize = struct.calcsize(offsetFormat)
+        dictTag = None
+        noFrames = 0
+        setOffset = set()
+        while ifdOffset != 0 and ifdOffset not in setOffset:
+            setOffset.add(ifdOffset)
+            fd.seek(ifdOffset)
+            noEntries = struct.unpack(byteOrder + countFormat, fd.read(countSize))[0]
+            if dictTag is None:
+                entries = fd.read(noEntries * entrySize + offsetSize)
+                dictTag = UtilsHeader._readTags(
+                    fd, entries, noEntries, entrySize, byteOrder, offsetFormat
+                )
+                nextOffset = entries[noEntries * entrySize :]
+            else:
+                fd.seek(ifdOffset + countSize + noEntries * entrySize)
+                nextOffset = fd.read(offsetSize)
+            noFrames += 1
+            if len(nextOffset) < offsetSize:
+                break
+            ifdOffset = struct.unpack(byteOrder + offsetFormat, nextOffset)[0]
+        if dictTag is None:
+            raise RuntimeError(f"TIFF file {movieFilePath} has no image")
+        bitsPerSample = dictTag.get(TIFF_BITS_PER_SAMPLE, 1)
+        kind = TIFF_SAMPLE_KIND.get(dictTag.get(TIFF_SAMPLE_FORMAT, 1), "u")
+        if bitsPerSample in [8, 16, 32, 64]:
+            dtype = numpy.dtype(
+                "{0}{1}{2}".format(byteOrder, kind, bitsPerSample // 8)
+            ).str
+        else:
+            # Packed formats, e.g. 4 bits or EER
+            dtype = None
+        pixelSize = None
+        xResolution = dictTag.get(TIFF_X_RESOLUTION)
+        unitAngstrom = TIFF_UNIT_ANGSTROM.get(dictTag.get(TIFF_RESOLUTION_UNIT, 2))
+        if xResolution and unitAngstrom is not None:
+            pixelSize = unitAngstrom / xResolution
+        return MovieHeader(
+            path=movieFilePath,
+            format=TIFF,
+            frames=noFrames,
+            width=dictTag.get(TIFF_IMAGE_WIDTH),
+            height=dictTag.get(TIFF_IMAGE_LENGTH),
+            dtype=dtype,
+            pixelSize=pixelSize,
+            compression=dictTag.get(TIFF_COMPRESSION, 1),
+            dataOffset=None,
+        )
+
+    @staticmethod
+    def _readTags(fd, entries, noEntries, entrySize, byteOrder, offsetFormat):
+        # First value of the tags needed, rationals as float
+        dictTag = {}
+        setTag = {
+            TIFF_IMAGE_WIDTH,
+            TIFF_IMAGE_LENGTH,
+            TIFF_BITS_PER_SAMPLE,
+            TIFF_COMPRESSION,
+            TIFF_X_RESOLUTION,
+            TIFF_RESOLUTION_UNIT,
+            TIFF_SAMPLE_FORMAT,
+        }
+        # Value or offset field: 4 bytes in TIFF, 8 bytes in BigTIFF
+        valueSize = struct.calcsize(offsetFormat)
+        for index in range(noEntries):
+            entry = entries[index * entrySize : (index + 1) * entrySize]
+            tag, fieldType = struct.unpack_from(byteOrder + "HH", entry, 0)
+            if tag not in setTag or fieldType not in TIFF_FIELD_TYPE:
+                continue
+            valueFormat, size = TIFF_FIELD_TYPE[fieldType]
+            count = struct.unpack_from(byteOrder + offsetFormat, entry, 4)[0]
+            valueField = entry[4 + valueSize :]
+            if size * count > valueSize:
+                # Value stored elsewhere, only the first one is read
+                valueOffset = struct.unpack(byteOrder + offsetFormat, valueField)[0]
+                position = fd.tell()
+                fd.seek(valueOffset)
+                valueField = fd.read(size)
+                fd.seek(position)
+            values = struct.unpack_from(byteOrder + valueFormat, valueField, 0)
+            if fieldType == 5:
+                dictTag[tag] = values[0] / values[1] if values[1] else None
+            else:
+                dictTag[tag] = values[0]
+        return dictTag
+
+    @staticmethod
+    def checkHomogeneous(listMovieFilePath, sampleSize=HOMOGENEITY_SAMPLE_SIZE):
+        """
+        Probes up to sampleSize movies evenly spread over the list and
+        compares them with the first one. Returns the MovieHeader of the
+        first movie and a list of (path, field, expected, found) for the
+        differences; movies which can't be probed give field 'error'.
+        """
+        listMovieFilePath = list(listMovieFilePath)
+        if not listMovieFilePath:
+            raise RuntimeError("No movies to check")
+        noMovies = len(listMovieFilePath)
+        listIndex = sorted(
+            set(numpy.linspace(0, noMovies - 1, min(sampleSize, noMovies)).astype(int))
+        )
+        reference = UtilsHeader.probe(listMovieFilePath[listIndex[0]])
+        listDifference = []
+        for index in listIndex[1:]:
+            movieFilePath = listMovieFilePath[index]
+            try:
+                movieHeader = UtilsHeader.probe(movieFilePath)
+            except (OSError, RuntimeError) as error:
+                listDifference.append((movieFilePath, "error", None, str(error)))
+                continue
+            for field in HOMOGENEITY_FIELDS:
+                if getattr(movieHeader, field) != getattr(reference, field):
+                    listDifference.append(
+                        (
+                            movieFilePath,
+                            field,
+                            getattr(reference, field),
+                            getattr(movieHeader, field),
+                        )
+                    )
+        return reference, listDifference
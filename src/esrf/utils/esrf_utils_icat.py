@@ -33,6 +33,7 @@ import traceback
 
 from pyicat_plus.client.main import IcatClient
 from esrf.utils.ESRFMetadataManagerClient import MetadataManagerClient
+from esrf.utils import esrf_utils_filename
 from esrf.utils.esrf_utils_path import UtilsPath
 
 
@@ -106,23 +107,27 @@ class UtilsIcat(object):
     @staticmethod
     def findGridSquaresNotUploaded(allParams, gridSquareNotToArchive=None, timeout=900):
         listGridSquares = []
+        listMovieFullPath = []
+        timeNow = time.time()
         for key, entry in allParams.items():
             if "archived" in entry and not entry["archived"]:
                 if "gridSquare" in entry:
                     gridSquare = entry["gridSquare"]
                     if (
-                        time.time() > allParams[gridSquare]["lastMovieTime"] + timeout
+                        timeNow > allParams[gridSquare]["lastMovieTime"] + timeout
                         and gridSquare not in listGridSquares
                     ):
                         listGridSquares.append(gridSquare)
                 elif "movieFullPath" in entry:
-                    movieFullPath = entry["movieFullPath"]
-                    dictFileNameParameters = (
-                        UtilsPath.getEpuTiffMovieFileNameParameters(movieFullPath)
-                    )
-                    gridSquare = dictFileNameParameters["gridSquare"]
-                    if gridSquare not in listGridSquares:
-                        listGridSquares.append(gridSquare)
+                    listMovieFullPath.append(entry["movieFullPath"])
+        if len(listMovieFullPath) > 0:
+            # Movies without grid square entry, parse all paths at once
+            dictColumns = UtilsPath.parseMany(
+                listMovieFullPath, esrf_utils_filename.EPU_TIFF
+            )
+            for gridSquare in dictColumns["gridSquare"][dictColumns["valid"]]:
+                if gridSquare not in listGridSquares:
+                    listGridSquares.append(str(gridSquare))
         return listGridSquares
 
     @staticmethod
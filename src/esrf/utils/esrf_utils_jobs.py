@@ -0,0 +1,190 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import time
+import threading
+import subprocess
+import collections
+import concurrent.futures
+
+# Jobs running at the same time, all tools together
+MAX_WORKERS = 8
+
+# Seconds before a job is killed
+DEFAULT_TIMEOUT = 300
+
+# Jobs of the same tool running at the same time, tools not listed are only
+# limited by MAX_WORKERS
+TOOL_CONCURRENCY = {
+    "bimg": 2,
+    "bscale": 2,
+    "dm2mrc": 1,
+    "clip": 1,
+}
+
+JobResult = collections.namedtuple(
+    "JobResult", ["args", "returnCode", "stdout", "stderr", "duration"]
+)
+
+
+class JobError(RuntimeError):
+    def __init__(self, message, jobResult):
+        super().__init__(message)
+        self.jobResult = jobResult
+
+
+class JobTimeoutError(JobError):
+    pass
+
+
+class JobEngine(object):
+    """
+    Runs external tools with subprocess in a bounded pool. Each tool (the
+    base name of the executable) has its own queue limited to its
+    concurrency, and at most maxWorkers jobs run at any time. Jobs are
+    killed after their timeout; stdout and stderr are captured and a
+    non-zero exit code raises JobError from the future.
+    """
+
+    def __init__(
+        self,
+        maxWorkers=MAX_WORKERS,
+        toolConcurrency=None,
+        defaultTimeout=DEFAULT_TIMEOUT,
+    ):
+        self.maxWorkers = maxWorkers
+        self.toolConcurrency = dict(TOOL_CONCURRENCY)
+        if toolConcurrency is not None:
+            self.toolConcurrency.update(toolConcurrency)
+        self.defaultTimeout = defaultTimeout
+        self.slots = threading.BoundedSemaphore(maxWorkers)
+        self.dictExecutor = {}
+        self.lock = threading.Lock()
+        self.isShutdown = False
+
+    def _getExecutor(self, tool):
+        with self.lock:
+            if self.isShutdown:
+                raise RuntimeError("Job engine is shut down")
+            executor = self.dictExecutor.get(tool)
+            if executor is None:
+                executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=min(
+                        self.toolConcurrency.get(tool, self.maxWorkers), self.maxWorkers
+                    ),
+                    thread_name_prefix="JobEngine_" + tool,
+                )
+                self.dictExecutor[tool] = executor
+        return executor
+
+    def _runJob(self, args, timeout, cwd, check):
+        with self.slots:
+            startTime = time.time()
+            process = subprocess.Popen(
+                args,
+                cwd=cwd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            try:
+                stdout, stderr = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                stdout, stderr = process.communicate()
+                jobResult = JobResult(
+                    args, process.returncode, stdout, stderr, time.time() - startTime
+                )
+                raise JobTimeoutError(
+                    f"Job {args} killed after {timeout} s", jobResult
+                ) from None
+        jobResult = JobResult(
+            args, process.returncode, stdout, stderr, time.time() - startTime
+        )
+        if check and process.returncode != 0:
+            raise JobError(
+                "Job {0} failed with exit code {1}: {2}".format(
+                    args,
+                    process.returncode,
+                    stderr.decode("utf-8", errors="replace").strip(),
+                ),
+                jobResult,
+            )
+        return jobResult
+
+    def submit(self, args, timeout=None, cwd=None, check=True):
+        """
+        Returns a concurrent.futures.Future of the JobResult.
+        """
+        args = [str(arg) for arg in args]
+        if timeout is None:
+            timeout = self.defaultTimeout
+        tool = os.path.basename(args[0])
+        return self._getExecutor(tool).submit(self._runJob, args, timeout, cwd, check)
+
+    def run(self, args, timeout=None, cwd=None, check=True):
+        return self.submit(args, timeout=timeout, cwd=cwd, check=check).result()
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            self.isShutdown = True
+            listExecutor = list(self.dictExecutor.values())
+            self.dictExecutor = {}
+        for executor in listExecutor:
+            executor.shutdown(wait=wait)
+
+
+_JOB_ENGINE = None
+_LOCK_JOB_ENGINE = threading.Lock()
+
+
+class UtilsJobs(object):
+    @staticmethod
+    def getEngine():
+        global _JOB_ENGINE
+        with _LOCK_JOB_ENGINE:
+            if _JOB_ENGINE is None:
+                _JOB_ENGINE = JobEngine()
+            return _JOB_ENGINE
+
+    @staticmethod
+    def submit(args, timeout=None, cwd=None, check=True):
+        return UtilsJobs.getEngine().submit(args, timeout=timeout, cwd=cwd, check=check)
+
+    @staticmethod
+    def run(args, timeout=None, cwd=None, check=True):
+        return UtilsJobs.getEngine().run(args, timeout=timeout, cwd=cwd, check=check)
+
+    @staticmethod
+    def shutdown(wait=True):
+        global _JOB_ENGINE
+        with _LOCK_JOB_ENGINE:
+            jobEngine = _JOB_ENGINE
+            _JOB_ENGINE = None
+        if jobEngine is not None:
+            jobEngine.shutdown(wait=wait)
@@ -0,0 +1,438 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import glob
+import json
+import time
+import struct
+import logging
+import threading
+import collections
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Journal of an allParams snapshot file: one JSON record per line,
+# {"set": {key: value}} or {"del": key}
+JOURNAL_SUFFIX = ".journal"
+
+# The journal is compacted into the snapshot when it is larger than the
+# snapshot times COMPACT_RATIO, and at least COMPACT_MIN_SIZE bytes
+COMPACT_RATIO = 1.0
+COMPACT_MIN_SIZE = 4 * 1024**2
+
+# Binary copy of the JSON snapshot, loaded instead of it when it was
+# written from the current one: magic, format version, size and mtime
+# (ns) of the JSON snapshot, then the same data as MessagePack. Only
+# written and read when msgpack is installed.
+BINARY_SNAPSHOT = os.environ.get("ESRF_BINARY_SNAPSHOT", "1") == "1"
+BINARY_SNAPSHOT_SUFFIX = ".bin"
+BINARY_MAGIC = b"ESRFSTATE\n"
+BINARY_VERSION = 2
+BINARY_HEADER = struct.Struct("<10sHQq")
+
+logger = logging.getLogger(__name__)
+
+
+class UtilsJournal(object):
+    """
+    allParams is stored as a JSON snapshot (the allParams.json file, same
+    format as before) plus an append-only journal next to it. Journals
+    being compacted are renamed to '<journal>.<time_ns>' first, so the
+    state is always the snapshot, the renamed journals in order and then
+    the current journal. Replaying a record twice gives the same state.
+    """
+
+    @staticmethod
+    def getJournalPath(jsonFilePath):
+        return os.fspath(jsonFilePath) + JOURNAL_SUFFIX
+
+    @staticmethod
+    def listRotatedJournalPath(jsonFilePath):
+        journalPath = UtilsJournal.getJournalPath(jsonFilePath)
+        listPath = [
+            path
+            for path in glob.glob(glob.escape(journalPath) + ".*")
+            if path[len(journalPath) + 1 :].isdigit()
+        ]
+        return sorted(listPath, key=lambda path: int(path.rsplit(".", 1)[1]))
+
+    @staticmethod
+    def exists(jsonFilePath):
+        return os.path.exists(jsonFilePath) or os.path.exists(
+            UtilsJournal.getJournalPath(jsonFilePath)
+        )
+
+    @staticmethod
+    def getBinarySnapshotPath(jsonFilePath):
+        return os.path.splitext(os.fspath(jsonFilePath))[0] + BINARY_SNAPSHOT_SUFFIX
+
+    @staticmethod
+    def readSnapshot(jsonFilePath):
+        if not os.path.exists(jsonFilePath):
+            return collections.OrderedDict()
+        dictParams = UtilsJournal.readBinarySnapshot(jsonFilePath)
+        if dictParams is None:
+            with open(jsonFilePath) as fd:
+                dictParams = json.load(fd, object_pairs_hook=collections.OrderedDict)
+        return dictParams
+
+    @staticmethod
+    def readBinarySnapshot(jsonFilePath):
+        """
+        Returns the binary copy of the JSON snapshot, None if there is none
+        or it isn't the copy of the current JSON snapshot.
+        """
+        binaryFilePath = UtilsJournal.getBinarySnapshotPath(jsonFilePath)
+        if msgpack is None or not os.path.exists(binaryFilePath):
+            return None
+        stat = os.stat(jsonFilePath)
+        with open(binaryFilePath, "rb") as fd:
+            header = fd.read(BINARY_HEADER.size)
+            if len(header) < BINARY_HEADER.size:
+                return None
+            magic, version, jsonSize, jsonMtimeNs = BINARY_HEADER.unpack(header)
+            if (
+                magic != BINARY_MAGIC
+                or version != BINARY_VERSION
+                or jsonSize != stat.st_size
+                or jsonMtimeNs != stat.st_mtime_ns
+            ):
+                return None
+            data = fd.read()
+        try:
+            dictParams = msgpack.unpackb(data, raw=False)
+        except Exception as error:
+            logger.warning(
+                "Couldn't read {0}, using {1}: {2}".format(
+                    binaryFilePath, jsonFilePath, error
+                )
+            )
+            return None
+        if not isinstance(dictParams, dict):
+            return None
+        # Plain dicts keep the order too, only the top level is expected
+        # to be an OrderedDict
+        return collections.OrderedDict(dictParams)
+
+    @staticmethod
+    def writeSnapshot(jsonFilePath, dictParams):
+        tmpFilePath = "{0}.{1}.tmp".format(jsonFilePath, os.getpid())
+        jsonText = json.dumps(dictParams, indent=4)
+        with open(tmpFilePath, "w") as fd:
+            fd.write(jsonText)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmpFilePath, jsonFilePath)
+        if BINARY_SNAPSHOT and msgpack is not None:
+            # The data as read back from JSON, e.g. with string keys
+            UtilsJournal.writeBinarySnapshot(jsonFilePath, json.loads(jsonText))
+
+    @staticmethod
+    def writeBinarySnapshot(jsonFilePath, dictParams):
+        binaryFilePath = UtilsJournal.getBinarySnapshotPath(jsonFilePath)
+        stat = os.stat(jsonFilePath)
+        tmpFilePath = "{0}.{1}.tmp".format(binaryFilePath, os.getpid())
+        with open(tmpFilePath, "wb") as fd:
+            fd.write(
+                BINARY_HEADER.pack(
+                    BINARY_MAGIC, BINARY_VERSION, stat.st_size, stat.st_mtime_ns
+                )
+            )
+            fd.write(msgpack.packb(dictParams, use_bin_type=True))
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmpFilePath, binaryFilePath)
+
+    @staticmethod
+    def replay(journalPath, dictParams):
+        if not os.path.exists(journalPath):
+            return dictParams
+        with open(journalPath) as fd:
+            for line in fd:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line cut by a crash
+                    continue
+                if "set" in record:
+                    dictParams.update(record["set"])
+                else:
+                    dictParams.pop(record["del"], None)
+        return dictParams
+
+    @staticmethod
+    def read(jsonFilePath, listJournalPath=None):
+        """
+        Returns the allParams stored at jsonFilePath as an OrderedDict:
+        the snapshot with the journals replayed.
+        """
+        dictParams = UtilsJournal.readSnapshot(jsonFilePath)
+        if listJournalPath is None:
+            listJournalPath = UtilsJournal.listRotatedJournalPath(jsonFilePath) + [
+                UtilsJournal.getJournalPath(jsonFilePath)
+            ]
+        for journalPath in listJournalPath:
+            UtilsJournal.replay(journalPath, dictParams)
+        return dictParams
+
+    @staticmethod
+    def load(jsonFilePath):
+        """
+        Returns a ParamsJournal with the allParams stored at jsonFilePath,
+        None gives one which isn't saved.
+        """
+        params = ParamsJournal(jsonFilePath)
+        if jsonFilePath is not None:
+            params.updateClean(UtilsJournal.read(jsonFilePath))
+        return params
+
+    @staticmethod
+    def create(jsonFilePath):
+        """
+        Returns an empty ParamsJournal. What is stored at jsonFilePath is
+        kept with a '.corrupted.<time_ns>' suffix.
+        """
+        suffix = ".corrupted.{0}".format(time.time_ns())
+        for filePath in UtilsJournal.listRotatedJournalPath(jsonFilePath) + [
+            jsonFilePath,
+            UtilsJournal.getJournalPath(jsonFilePath),
+            UtilsJournal.getBinarySnapshotPath(jsonFilePath),
+        ]:
+            if os.path.exists(filePath):
+                os.replace(filePath, filePath + suffix)
+        UtilsJournal.writeSnapshot(jsonFilePath, {})
+        return ParamsJournal(jsonFilePath)
+
+    @staticmethod
+    def compact(jsonFilePath):
+        """
+        Renames the current journal and merges it with the older ones into
+        the snapshot. Can run while a ParamsJournal appends to the file.
+        """
+        journalPath = UtilsJournal.getJournalPath(jsonFilePath)
+        if os.path.exists(journalPath):
+            os.replace(journalPath, "{0}.{1}".format(journalPath, time.time_ns()))
+        UtilsJournal._compactRotated(jsonFilePath)
+
+    @staticmethod
+    def _compactRotated(jsonFilePath):
+        listJournalPath = UtilsJournal.listRotatedJournalPath(jsonFilePath)
+        if not listJournalPath:
+            return
+        UtilsJournal.writeSnapshot(
+            jsonFilePath, UtilsJournal.read(jsonFilePath, listJournalPath)
+        )
+        for journalPath in listJournalPath:
+            os.remove(journalPath)
+
+
+class TrackedParams(collections.OrderedDict):
+    """
+    allParams as an OrderedDict which records the top level keys set,
+    deleted or read since the last flush. 'flush' passes the JSON of the
+    entries of these keys which differ from the last one written to
+    'writeChanges', so that the movies updated in place through
+    'params[movieName][...] = ...' are saved without rewriting the
+    others. A value changed through a reference kept across flushes has
+    to be marked with 'markDirty'.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.touchedLock = threading.Lock()
+        self.dictTouched = {}
+        self.dictWritten = {}
+        super().__init__()
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.markDirty(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.markDirty(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.markDirty(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            self.markDirty(key)
+        return super().pop(key, *args)
+
+    def __reduce__(self):
+        # Pickled as a plain OrderedDict
+        return collections.OrderedDict, (list(self.items()),)
+
+    @staticmethod
+    def getKeyString(key):
+        # Keys are strings once saved, as json.dumps does
+        return key if isinstance(key, str) else json.dumps(key)
+
+    def updateClean(self, dictParams):
+        # Entries already saved, with an unknown hash so that they are
+        # written again when changed and deleted when removed
+        for key, value in dictParams.items():
+            super().__setitem__(key, value)
+            self.dictWritten[key] = None
+
+    def markDirty(self, key):
+        with self.touchedLock:
+            self.dictTouched[key] = None
+
+    def flush(self):
+        """
+        Writes the entries changed since the last flush. If the write
+        fails the entries stay dirty and the exception is raised.
+        """
+        with self.touchedLock:
+            dictTouched, self.dictTouched = self.dictTouched, {}
+        with self.lock:
+            dictChanged = {}
+            dictHash = {}
+            listDeleted = []
+            for key in dictTouched:
+                if key in self:
+                    try:
+                        valueJson = json.dumps(super().__getitem__(key))
+                    except RuntimeError:
+                        # Changed by another thread while serialized
+                        self.markDirty(key)
+                        continue
+                    if self.dictWritten.get(key) == hash(valueJson):
+                        continue
+                    dictHash[key] = hash(valueJson)
+                    dictChanged[self.getKeyString(key)] = valueJson
+                elif key in self.dictWritten:
+                    dictHash[key] = None
+                    listDeleted.append(self.getKeyString(key))
+            if not dictHash:
+                return
+            try:
+                self.writeChanges(dictChanged, listDeleted)
+            except BaseException:
+                with self.touchedLock:
+                    for key in dictHash:
+                        self.dictTouched.setdefault(key, None)
+                raise
+            for key, valueHash in dictHash.items():
+                if valueHash is None:
+                    del self.dictWritten[key]
+                else:
+                    self.dictWritten[key] = valueHash
+
+    def writeChanges(self, dictChanged, listDeleted):
+        """
+        Saves the JSON of the changed entries (key -> JSON string) and
+        removes the deleted keys.
+        """
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class ParamsJournal(TrackedParams):
+    """
+    TrackedParams saved in a journal next to a JSON snapshot, see
+    UtilsJournal. The journal is compacted in the background when it
+    gets large.
+    """
+
+    def __init__(self, jsonFilePath=None):
+        self.jsonFilePath = None if jsonFilePath is None else os.fspath(jsonFilePath)
+        self.compactThread = None
+        super().__init__()
+
+    def writeChanges(self, dictChanged, listDeleted):
+        if self.jsonFilePath is None:
+            return
+        listLine = [
+            '{{"set": {{{0}: {1}}}}}\n'.format(json.dumps(key), valueJson)
+            for key, valueJson in dictChanged.items()
+        ]
+        listLine += [json.dumps({"del": key}) + "\n" for key in listDeleted]
+        journalPath = UtilsJournal.getJournalPath(self.jsonFilePath)
+        with open(journalPath, "a") as fd:
+            fd.write("".join(listLine))
+            fd.flush()
+            os.fsync(fd.fileno())
+            journalSize = fd.tell()
+        snapshotSize = (
+            os.path.getsize(self.jsonFilePath)
+            if os.path.exists(self.jsonFilePath)
+            else 0
+        )
+        if journalSize > max(COMPACT_MIN_SIZE, COMPACT_RATIO * snapshotSize):
+            self.compact()
+
+    def compact(self, wait=False):
+        """
+        Starts merging the journal into the snapshot in a thread, the
+        state is read back from the files so the dict isn't shared.
+        """
+        if self.jsonFilePath is None:
+            return
+        with self.lock:
+            if self.compactThread is not None and self.compactThread.is_alive():
+                if not wait:
+                    return
+                self.compactThread.join()
+            journalPath = UtilsJournal.getJournalPath(self.jsonFilePath)
+            if os.path.exists(journalPath):
+                os.replace(journalPath, "{0}.{1}".format(journalPath, time.time_ns()))
+            self.compactThread = threading.Thread(
+                target=UtilsJournal._compactRotated, args=(self.jsonFilePath,)
+            )
+            self.compactThread.start()
+        if wait:
+            self.compactThread.join()
+
+    def close(self):
+        """
+        Flushes and merges the journal into the snapshot, so that
+        allParams.json is complete.
+        """
+        self.flush()
+        self.compact(wait=True)
@@ -0,0 +1,157 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import functools
+import collections
+
+import numpy
+
+# Maximum number of parsed mdoc files kept in memory
+MDOC_CACHE_SIZE = 256
+
+# Bracketed lines starting a new section
+SECTION_TYPES = ("ZValue", "FrameSet")
+
+# Section fields also returned as NumPy arrays, NaN where missing
+NUMERIC_FIELDS = (
+    "TiltAngle",
+    "ExposureDose",
+    "PixelSpacing",
+    "ExposureTime",
+    "Magnification",
+    "Defocus",
+    "TargetDefocus",
+    "StageZ",
+    "RotationAngle",
+)
+
+MdocData = collections.namedtuple(
+    "MdocData",
+    ["header", "titles", "sectionType", "sectionIndex", "sections", "arrays"],
+)
+
+
+def _toFloat(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return numpy.nan
+
+
+@functools.lru_cache(maxsize=MDOC_CACHE_SIZE)
+def _parse(mdocFilePath, size, mtime):
+    # size and mtime are only part of the cache key
+    header = {}
+    listTitle = []
+    sectionType = None
+    listSectionIndex = []
+    listSection = []
+    current = header
+    with open(mdocFilePath, errors="replace") as fd:
+        for line in fd:
+            line = line.strip()
+            if line.startswith("[") and line.endswith("]"):
+                key, separator, value = line[1:-1].partition("=")
+                key = key.strip()
+                value = value.strip()
+                if separator and key in SECTION_TYPES:
+                    sectionType = key
+                    listSectionIndex.append(int(value))
+                    current = {}
+                    listSection.append(current)
+                elif separator and key == "T":
+                    # Title lines, e.g. "[T = Tilt axis angle = 84.9, binning = 1]"
+                    listTitle.append(value)
+                elif separator:
+                    current[key] = value
+            else:
+                # Values can contain '='
+                key, separator, value = line.partition("=")
+                if separator:
+                    current[key.strip()] = value.strip()
+    arrays = {
+        field: numpy.array(
+            [_toFloat(section.get(field)) for section in listSection],
+            dtype=numpy.float64,
+        )
+        for field in NUMERIC_FIELDS
+    }
+    for array in arrays.values():
+        array.flags.writeable = False
+    sectionIndex = numpy.array(listSectionIndex, dtype=numpy.int64)
+    sectionIndex.flags.writeable = False
+    return MdocData(header, listTitle, sectionType, sectionIndex, listSection, arrays)
+
+
+class UtilsMdoc(object):
+    """
+    Parser of the SerialEM mdoc files. A file is read line by line into a
+    global header, the [T = ...] title lines and one dictionary per
+    [ZValue = n] (tilt series) or
+    [FrameSet = n] (single movie) section. NUMERIC_FIELDS of the sections
+    are also returned as NumPy arrays, one value per section.
+
+    Results are cached by (path, size, mtime) and shared between callers:
+    they must not be modified.
+    """
+
+    @staticmethod
+    def parse(mdocFilePath):
+        mdocFilePath = os.fspath(mdocFilePath)
+        statResult = os.stat(mdocFilePath)
+        return _parse(mdocFilePath, statResult.st_size, statResult.st_mtime_ns)
+
+    @staticmethod
+    def getSection(mdocFilePath, sectionIndex=None, tiltAngle=None):
+        """
+        Returns the header and section fields of one section, selected by
+        its [ZValue] / [FrameSet] index or as the one with the TiltAngle
+        closest to 'tiltAngle'. Returns None if there is no such section.
+        """
+        mdocData = UtilsMdoc.parse(mdocFilePath)
+        if len(mdocData.sections) == 0:
+            return None
+        if sectionIndex is not None:
+            listIndex = numpy.flatnonzero(mdocData.sectionIndex == sectionIndex)
+            if len(listIndex) == 0:
+                return None
+            index = listIndex[0]
+        elif tiltAngle is not None:
+            delta = numpy.abs(mdocData.arrays["TiltAngle"] - tiltAngle)
+            if numpy.all(numpy.isnan(delta)):
+                return None
+            index = numpy.nanargmin(delta)
+        else:
+            raise RuntimeError("Either sectionIndex or tiltAngle must be given")
+        dictSection = dict(mdocData.header)
+        dictSection.update(mdocData.sections[index])
+        return dictSection
+
+    @staticmethod
+    def clearCache():
+        _parse.cache_clear()
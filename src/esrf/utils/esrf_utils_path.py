@@ -28,71 +28,59 @@
 import os
 import pathlib
 import re
-import glob
-import json
-import math
 import time
 import shutil
 import datetime
 import traceback
-import xml.etree.ElementTree
+
+import numpy
+
+from esrf.utils import esrf_utils_filename
+from esrf.utils.esrf_utils_filename import UtilsFileName
+from esrf.utils.esrf_utils_dircache import UtilsDirCache
+from esrf.utils.esrf_utils_epuxml import UtilsEpuXml
+from esrf.utils.esrf_utils_mdoc import UtilsMdoc
+from esrf.utils.esrf_utils_ctf import UtilsCtf
+from esrf.utils.esrf_utils_drift import UtilsDrift
+from esrf.utils.esrf_utils_snapshot import UtilsSnapshot
+from esrf.utils.esrf_utils_star import UtilsStar
+from esrf.utils.esrf_utils_state import UtilsState
+from esrf.utils.esrf_utils_dircache import SerialEMDiscoveryIndex
 
 
 class UtilsPath(object):
     @staticmethod
     def getMovieJpegMrcXml(movieFilePath):
-        gridSquareSnapshot = None
         dictFileName = UtilsPath.getMovieFileNameParameters(movieFilePath)
-        filePrefix = "{directory}/{prefix}_{id1}_Data_{id2}_{id3}_{date}_{hour}".format(
+        filePrefix = "{prefix}_{id1}_Data_{id2}_{id3}_{date}_{hour}".format(
             **dictFileName
         )
-        jpeg = filePrefix + ".jpg"
-        if not os.path.exists(jpeg):
-            jpeg = None
-        mrc = filePrefix + ".mrc"
-        if not os.path.exists(mrc):
-            mrc = None
-        xml = filePrefix + ".xml"
-        if not os.path.exists(xml):
-            xml = None
+        dictSidecar = UtilsDirCache.getSidecarFiles(
+            dictFileName["directory"], filePrefix, [".jpg", ".mrc", ".xml"]
+        )
+        jpeg = dictSidecar[".jpg"]
+        mrc = dictSidecar[".mrc"]
+        xml = dictSidecar[".xml"]
         gridSquareDir = os.path.dirname(os.path.dirname(movieFilePath))
-        listSnapshot = glob.glob(os.path.join(gridSquareDir, "*.jpg"))
-        if len(listSnapshot) > 0:
-            gridSquareSnapshot = listSnapshot[-1]
+        gridSquareSnapshot = UtilsDirCache.getGridSquareSnapshot(gridSquareDir)
 
         return jpeg, mrc, xml, gridSquareSnapshot
 
     @staticmethod
     def getEpuTiffMovieJpegMrcXml(movieFilePath):
-        gridSquareSnapshot = None
-        fileDir = os.path.dirname(movieFilePath)
-        if os.path.exists(fileDir):
-            # Patch provided by Sebastien 2018/02/09 for forcing NFS cache:
-            # logger.debug("NFS cache clear, doing os.fstat on directory {0}".format(fileDir))
-            fd = os.open(fileDir, os.O_DIRECTORY)
-            statResult = os.fstat(fd)  # noqa F841
-            os.close(fd)
         dictFileName = UtilsPath.getEpuTiffMovieFileNameParameters(movieFilePath)
-        filePrefix = "{directory}/{prefix}_{id1}_Data_{id2}_{id3}_{date}_{hour}".format(
+        filePrefix = "{prefix}_{id1}_Data_{id2}_{id3}_{date}_{hour}".format(
             **dictFileName
         )
-        jpeg = filePrefix + ".jpg"
-        if not os.path.exists(jpeg):
-            jpeg = None
-        # Check if we have mrc micrograph
-        microGraph = filePrefix + ".mrc"
-        if not os.path.exists(microGraph):
-            # Check if we have tiff micrograph
-            microGraph = filePrefix + ".tiff"
-            if not os.path.exists(microGraph):
-                microGraph = None
-        xml = filePrefix + ".xml"
-        if not os.path.exists(xml):
-            xml = None
+        dictSidecar = UtilsDirCache.getSidecarFiles(
+            dictFileName["directory"], filePrefix, [".jpg", ".mrc", ".tiff", ".xml"]
+        )
+        jpeg = dictSidecar[".jpg"]
+        # Check if we have mrc micrograph, otherwise tiff micrograph
+        microGraph = dictSidecar[".mrc"] or dictSidecar[".tiff"]
+        xml = dictSidecar[".xml"]
         gridSquareDir = os.path.dirname(os.path.dirname(movieFilePath))
-        listSnapshot = glob.glob(os.path.join(gridSquareDir, "*.jpg"))
-        if len(listSnapshot) > 0:
-            gridSquareSnapshot = listSnapshot[-1]
+        gridSquareSnapshot = UtilsDirCache.getGridSquareSnapshot(gridSquareDir)
 
         return jpeg, microGraph, xml, gridSquareSnapshot
 
@@ -100,222 +88,64 @@ class UtilsPath(object):
     def getSerialEMMovieJpegMdoc(topDir, movieFilePath):
         gridSquareSnapshot = None
         jpeg = None
-        mdoc = movieFilePath + ".mdoc"
-        if not os.path.exists(mdoc):
-            mdoc = None
+        dictSidecar = UtilsDirCache.getSidecarFiles(
+            os.path.dirname(movieFilePath), os.path.basename(movieFilePath), [".mdoc"]
+        )
+        mdoc = dictSidecar[".mdoc"]
         return jpeg, mdoc, gridSquareSnapshot
 
     @staticmethod
-    def getAlignMoviesPngLogFilePath(mrcFilePath):
-        dictResult = {}
-        # Locate png file in same directory
-        mrcDirectory = os.path.dirname(mrcFilePath)
-        dictMrcFile = UtilsPath.getMovieFileNameParametersFromMotioncorrPath(
-            mrcFilePath
-        )
-        mrcMovieNumber = dictMrcFile["movieNumber"]
-        listPng = glob.glob(os.path.join(mrcDirectory, "*.png"))
-        for pngFile in listPng:
-            dictFileNameParameters = (
-                UtilsPath.getMovieFileNameParametersFromMotioncorrPath(pngFile)
-            )
-            movieNumber = dictFileNameParameters["movieNumber"]
-            if (
-                dictFileNameParameters["extra"] == "_global_shifts"
-                and mrcMovieNumber == movieNumber
-            ):
-                dictResult["globalShiftPng"] = pngFile
-            elif (
-                dictFileNameParameters["extra"] == "_thumbnail"
-                and mrcMovieNumber == movieNumber
-            ):
-                dictResult["thumbnailPng"] = pngFile
-        listMrc = glob.glob(os.path.join(mrcDirectory, "*.mrc"))
-        for mrcFile in listMrc:
-            dictFileNameParameters = (
-                UtilsPath.getMovieFileNameParametersFromMotioncorrPath(mrcFile)
-            )
-            movieNumber = dictFileNameParameters["movieNumber"]
-            if (
-                "DW" in dictFileNameParameters["extra"]
-                and mrcMovieNumber == movieNumber
-            ):
-                dictResult["doseWeightMrc"] = mrcFile
+    def _getAlignMoviesPngLogFilePath(mrcFilePath, layout):
+        # Plots and dose weighted micrograph in the same directory
+        dictResult = UtilsDirCache.getMotionCorrArtifacts(mrcFilePath, layout)
         # Find log file
+        mrcDirectory = os.path.dirname(mrcFilePath)
         dictResult["logFileFullPath"] = os.path.join(
             os.path.dirname(mrcDirectory), "logs", "run.stdout"
         )
         return dictResult
 
     @staticmethod
-    def getEpuTiffAlignMoviesPngLogFilePath(mrcFilePath):
-        dictResult = {}
-        # Locate png file in same directory
-        mrcDirectory = os.path.dirname(mrcFilePath)
-        dictMrcFile = UtilsPath.getEpuTiffMovieFileNameParametersFromMotioncorrPath(
-            mrcFilePath
-        )
-        mrcMovieNumber = dictMrcFile["movieNumber"]
-        listPng = glob.glob(os.path.join(mrcDirectory, "*.png"))
-        for pngFile in listPng:
-            dictFileNameParameters = (
-                UtilsPath.getEpuTiffMovieFileNameParametersFromMotioncorrPath(pngFile)
-            )
-            movieNumber = dictFileNameParameters["movieNumber"]
-            if (
-                dictFileNameParameters["extra"] == "global_shifts"
-                and mrcMovieNumber == movieNumber
-            ):
-                dictResult["globalShiftPng"] = pngFile
-            elif (
-                dictFileNameParameters["extra"] == "thumbnail"
-                and mrcMovieNumber == movieNumber
-            ):
-                dictResult["thumbnailPng"] = pngFile
-        listMrc = glob.glob(os.path.join(mrcDirectory, "*.mrc"))
-        for mrcFile in listMrc:
-            dictFileNameParameters = (
-                UtilsPath.getEpuTiffMovieFileNameParametersFromMotioncorrPath(mrcFile)
-            )
-            movieNumber = dictFileNameParameters["movieNumber"]
-            if (
-                "DW" in dictFileNameParameters["extra"]
-                and mrcMovieNumber == movieNumber
-            ):
-                dictResult["doseWeightMrc"] = mrcFile
-        # Find log file
-        dictResult["logFileFullPath"] = os.path.join(
-            os.path.dirname(mrcDirectory), "logs", "run.stdout"
+    def getAlignMoviesPngLogFilePath(mrcFilePath):
+        return UtilsPath._getAlignMoviesPngLogFilePath(
+            mrcFilePath, esrf_utils_filename.EPU_MOTIONCORR
         )
-        return dictResult
 
     @staticmethod
-    def getSerialEMAlignMoviesPngLogFilePath(mrcFilePath):
-        dictResult = {}
-        # Locate png file in same directory
-        mrcDirectory = os.path.dirname(mrcFilePath)
-        dictMrcFile = UtilsPath.getSerialEMMovieFileNameParametersFromMotioncorrPath(
-            mrcFilePath
-        )
-        mrcMovieNumber = dictMrcFile["movieNumber"]
-        listPng = glob.glob(os.path.join(mrcDirectory, "*.png"))
-        for pngFile in listPng:
-            dictFileNameParameters = (
-                UtilsPath.getSerialEMMovieFileNameParametersFromMotioncorrPath(pngFile)
-            )
-            movieNumber = dictFileNameParameters["movieNumber"]
-            if (
-                dictFileNameParameters["extra"] == "global_shifts"
-                and mrcMovieNumber == movieNumber
-            ):
-                dictResult["globalShiftPng"] = pngFile
-            elif (
-                dictFileNameParameters["extra"] == "thumbnail"
-                and mrcMovieNumber == movieNumber
-            ):
-                dictResult["thumbnailPng"] = pngFile
-        listMrc = glob.glob(os.path.join(mrcDirectory, "*.mrc"))
-        for mrcFile in listMrc:
-            dictFileNameParameters = (
-                UtilsPath.getSerialEMMovieFileNameParametersFromMotioncorrPath(mrcFile)
-            )
-            movieNumber = dictFileNameParameters["movieNumber"]
-            if (
-                "DW" in dictFileNameParameters["extra"]
-                and mrcMovieNumber == movieNumber
-            ):
-                dictResult["doseWeightMrc"] = mrcFile
-        # Find log file
-        dictResult["logFileFullPath"] = os.path.join(
-            os.path.dirname(mrcDirectory), "logs", "run.stdout"
+    def getEpuTiffAlignMoviesPngLogFilePath(mrcFilePath):
+        return UtilsPath._getAlignMoviesPngLogFilePath(
+            mrcFilePath, esrf_utils_filename.EPU_TIFF_MOTIONCORR
         )
-        return dictResult
 
     @staticmethod
-    def etree_to_dict(t):
-        p = re.compile("^{(.*)}")
-        m = p.match(t.tag)
-        if m is not None:
-            t.tag = t.tag[m.span()[1] :]
-        listTmp = list(map(UtilsPath.etree_to_dict, t.getchildren()))
-        if len(listTmp) > 0:
-            d = {t.tag: listTmp}
-        else:
-            d = {t.tag: t.text}
-        return d
+    def getSerialEMAlignMoviesPngLogFilePath(mrcFilePath):
+        return UtilsPath._getAlignMoviesPngLogFilePath(
+            mrcFilePath, esrf_utils_filename.SERIALEM_MOTIONCORR
+        )
 
     @staticmethod
-    def get_recursively(search_dict, field):
-        """
-        Takes a dict with nested lists and dicts,
-        and searches all dicts for a key of the field
-        provided.
-        See: https://stackoverflow.com/q/14962485
-        """
-        fields_found = []
-
-        for key, value in search_dict.items():
-            if key == field:
-                fields_found.append(value)
-
-            elif isinstance(value, dict):
-                results = UtilsPath.get_recursively(value, field)
-                for result in results:
-                    fields_found.append(result)
-
-            elif isinstance(value, list):
-                for item in value:
-                    if isinstance(item, dict):
-                        more_results = UtilsPath.get_recursively(item, field)
-                        for another_result in more_results:
-                            fields_found.append(another_result)
-
-        return fields_found
+    def getXmlMetaData(xmlMetaDataFullPath):
+        return UtilsEpuXml.parse(xmlMetaDataFullPath)
 
     @staticmethod
-    def getXmlMetaData(xmlMetaDataFullPath):
-        root = xml.etree.ElementTree.parse(xmlMetaDataFullPath).getroot()
-        dictXML = UtilsPath.etree_to_dict(root)
-        dictResults = {
-            "numberOffractions": UtilsPath.get_recursively(
-                dictXML, "NumberOffractions"
-            )[0],
-            "magnification": UtilsPath.get_recursively(dictXML, "NominalMagnification")[
-                0
-            ],
-            "positionX": UtilsPath.get_recursively(dictXML, "X")[0],
-            "positionY": UtilsPath.get_recursively(dictXML, "Y")[0],
-            "accelerationVoltage": UtilsPath.get_recursively(
-                dictXML, "AccelerationVoltage"
-            )[0],
-            "acquisitionDateTime": UtilsPath.get_recursively(
-                dictXML, "acquisitionDateTime"
-            )[0],
-        }
-        listKeyValue = UtilsPath.get_recursively(dictXML, "KeyValueOfstringanyType")
-        for dictKey, dictValue in listKeyValue:
-            if dictKey["Key"] == "Dose":
-                dictResults["dose"] = dictValue["Value"]
-            if dictKey["Key"] == "PhasePlateUsed":
-                dictResults["phasePlateUsed"] = dictValue["Value"]
-        listKeyValue = UtilsPath.get_recursively(dictXML, "CameraSpecificInput")[0]
-        # print(listKeyValue)
-        for dictKeyValueOfstringanyType in listKeyValue:
-            dictKey = dictKeyValueOfstringanyType["KeyValueOfstringanyType"][0]
-            dictValue = dictKeyValueOfstringanyType["KeyValueOfstringanyType"][1]
-            if dictKey["Key"] == "SuperResolutionFactor":
-                dictResults["superResolutionFactor"] = dictValue["Value"]
-        return dictResults
+    def getXmlMetaDataMany(listXmlMetaDataFullPath):
+        return UtilsEpuXml.parseMany(listXmlMetaDataFullPath)
 
     @staticmethod
     def getMdocMetaData(mdocMetaDataFullPath):
-        dictResults = {}
-        with open(mdocMetaDataFullPath) as f:
-            listLines = f.readlines()
-        for line in listLines:
-            if "=" in line:
-                key, value = line.split("=")
-                dictResults[key.strip()] = value.strip()
+        """
+        Flat dictionary of all the key / value pairs of an mdoc file, the
+        last section overriding the previous ones. Use UtilsMdoc for the
+        per section values of tilt series.
+        """
+        mdocData = UtilsMdoc.parse(mdocMetaDataFullPath)
+        dictResults = dict(mdocData.header)
+        # Bracketed lines are kept with the keys of the previous parser
+        for title in mdocData.titles:
+            dictResults["[T"] = title + "]"
+        for sectionIndex, dictSection in zip(mdocData.sectionIndex, mdocData.sections):
+            dictResults["[" + mdocData.sectionType] = "{0}]".format(sectionIndex)
+            dictResults.update(dictSection)
         return dictResults
 
     @staticmethod
@@ -340,12 +170,11 @@ class UtilsPath(object):
             spectraImageSnapshotFullPath = os.path.join(
                 extraDirectory, mrcFileBase + "_ctf.jpeg"
             )
-            os.system(
-                "/cvmfs/sb.esrf.fr/bin/bimg -minmax 0,300 {0} {1}".format(
-                    spectraImageFullPath, spectraImageSnapshotFullPath
+            try:
+                UtilsSnapshot.createCachedSnapshot(
+                    spectraImageFullPath, spectraImageSnapshotFullPath, minmax=(0, 300)
                 )
-            )
-            if not os.path.exists(spectraImageSnapshotFullPath):
+            except (OSError, RuntimeError, ValueError):
                 spectraImageSnapshotFullPath = None
         return spectraImageFullPath, spectraImageSnapshotFullPath
 
@@ -375,21 +204,9 @@ class UtilsPath(object):
             dictResults["spectraImageSnapshotFullPath"] = spectraImageSnapshotFullPath
             ctfEstimationPath = os.path.join(extraDirectory, mrcFileBase + "_ctf.log")
             if os.path.exists(ctfEstimationPath):
-                f = open(ctfEstimationPath)
-                lines = f.readlines()
-                f.close()
-                for index in range(len(lines)):
-                    if "Final Values" in lines[index]:
-                        listLabels = lines[index - 1].split()
-                        listValues = lines[index].split()
-                        for label, value in zip(listLabels, listValues):
-                            dictResults[label] = value
-                    elif "Resolution limit" in lines[index]:
-                        listValues = lines[index].split()
-                        dictResults["resolutionLimit"] = listValues[-1]
-                    elif "Estimated Bfactor" in lines[index]:
-                        listValues = lines[index].split()
-                        dictResults["estimatedBfactor"] = listValues[-1]
+                ctfResult = UtilsCtf.parseLog(ctfEstimationPath)
+                if ctfResult is not None:
+                    dictResults.update(ctfResult.rawValues)
         # Find log file
         logFilePath = os.path.join(workingDir, "logs", "run.stdout")
         if os.path.exists(logFilePath):
@@ -415,125 +232,43 @@ class UtilsPath(object):
                 movie_name + "_aligned_mic_DW_ctf.log"
             )
             if ctf_estimation_path.exists():
-                f = open(ctf_estimation_path)
-                lines = f.readlines()
-                f.close()
-                for index in range(len(lines)):
-                    if "Final Values" in lines[index]:
-                        listLabels = lines[index - 1].split()
-                        listValues = lines[index].split()
-                        for label, value in zip(listLabels, listValues):
-                            dictResults[label] = value
-                    elif "Resolution limit" in lines[index]:
-                        listValues = lines[index].split()
-                        dictResults["resolutionLimit"] = listValues[-1]
-                    elif "Estimated Bfactor" in lines[index]:
-                        listValues = lines[index].split()
-                        dictResults["estimatedBfactor"] = listValues[-1]
+                ctf_result = UtilsCtf.parseLog(ctf_estimation_path)
+                if ctf_result is not None:
+                    dictResults.update(ctf_result.rawValues)
         # Find log file
         logFilePath = os.path.join(working_dir, "logs", "run.stdout")
         if os.path.exists(logFilePath):
             dictResults["logFilePath"] = logFilePath
         return dictResults
 
+    @staticmethod
+    def parse(path, layout):
+        """
+        Parses a movie or micrograph path, see UtilsFileName for the layouts.
+        """
+        return UtilsFileName.parse(path, layout)
+
+    @staticmethod
+    def parseMany(paths, layout):
+        """
+        Parses a list of paths into columns of NumPy arrays,
+        see UtilsFileName.parseMany.
+        """
+        return UtilsFileName.parseMany(paths, layout)
+
     @staticmethod
     def getMovieFileNameParameters(mrcFilePath):
         """
         FoilHole_19150795_Data_19148847_19148848_20170619_2101-0344.mrc
         """
-        try:
-            dictResult = {}
-            dictResult["directory"] = os.path.dirname(mrcFilePath)
-            p = re.compile(
-                "^(.*)/(GridSquare_[0-9]*)/"
-                + "Data/(.*)_([0-9]*)_Data_([0-9]*)_([0-9]*)_([0-9]*)_([0-9]*)"
-                + "-([0-9]*)(_?.*)\.(.*)"
-            )
-            m = p.match(mrcFilePath)
-            if m is not None:
-                dictResult["gridSquare"] = m.group(2)
-                dictResult["prefix"] = m.group(3)
-                dictResult["id1"] = m.group(4)
-                dictResult["id2"] = m.group(5)
-                dictResult["id3"] = m.group(6)
-                dictResult["date"] = m.group(7)
-                dictResult["hour"] = m.group(8)
-                dictResult["movieNumber"] = m.group(9)
-                dictResult["extra"] = m.group(10)
-                dictResult["suffix"] = m.group(11)
-                dictResult[
-                    "movieName"
-                ] = "{prefix}_{id1}_Data_{id2}_{id3}_{date}_{hour}-{movieNumber}".format(
-                    **dictResult
-                )
-            else:
-                # Try without the GridSquare directory
-                p = re.compile(
-                    "^(.*)/(.*)_([0-9]*)_Data_([0-9]*)_([0-9]*)_([0-9]*)_([0-9]*)"
-                    + "-([0-9]*)(_?.*)\.(.*)"
-                )
-                m = p.match(mrcFilePath)
-                dictResult["gridSquare"] = None
-                dictResult["prefix"] = m.group(2)
-                dictResult["id1"] = m.group(3)
-                dictResult["id2"] = m.group(4)
-                dictResult["id3"] = m.group(5)
-                dictResult["date"] = m.group(6)
-                dictResult["hour"] = m.group(7)
-                dictResult["movieNumber"] = m.group(8)
-                dictResult["extra"] = m.group(9)
-                dictResult["suffix"] = m.group(10)
-                dictResult[
-                    "movieName"
-                ] = "{prefix}_{id1}_Data_{id2}_{id3}_{date}_{hour}-{movieNumber}".format(
-                    **dictResult
-                )
-        except Exception as e:
-            raise e
-            dictResult = None
-        # Check numbers
-        if not dictResult["hour"].isdigit() or not dictResult["movieNumber"].isdigit():
-            dictResult = None
-        return dictResult
+        return UtilsFileName.parseToDict(mrcFilePath, esrf_utils_filename.EPU)
 
     @staticmethod
     def getEpuTiffMovieFileNameParameters(mrcFilePath):
         """
         FoilHole_10859740_Data_10853322_10853324_20210611_233928_fractions.tiff
         """
-        try:
-            # print(mrcFilePath)
-            dictResult = {}
-            dictResult["directory"] = os.path.dirname(mrcFilePath)
-            p = re.compile(
-                "^(.*)/(GridSquare_[0-9]*)/"
-                + "Data/(.*)_([0-9]*)_Data_([0-9]*)_([0-9]*)_([0-9]*)_([0-9]*)"
-                + "_fractions\.(.*)"
-            )
-            m = p.match(mrcFilePath)
-            if m is not None:
-                dictResult["gridSquare"] = m.group(2)
-                dictResult["prefix"] = m.group(3)
-                dictResult["id1"] = m.group(4)
-                dictResult["id2"] = m.group(5)
-                dictResult["id3"] = m.group(6)
-                dictResult["date"] = m.group(7)
-                dictResult["hour"] = m.group(8)
-                dictResult["suffix"] = m.group(9)
-        except Exception as e:
-            raise e
-            dictResult = None
-        # Check numbers
-        if not dictResult["hour"].isdigit():
-            dictResult = None
-        else:
-            dictResult[
-                "movieName"
-            ] = "{prefix}_{id1}_Data_{id2}_{id3}_{date}_{hour}_fractions".format(
-                **dictResult
-            )
-            dictResult["movieNumber"] = dictResult["date"][-2:] + dictResult["hour"]
-        return dictResult
+        return UtilsFileName.parseToDict(mrcFilePath, esrf_utils_filename.EPU_TIFF)
 
     @staticmethod
     def getSerialEMMovieFileNameParameters(topDir, tifFilePath):
@@ -567,87 +302,43 @@ class UtilsPath(object):
         """
         FoilHole_19150795_Data_19148847_19148848_20170619_2101-0344.mrc
         """
-        dictResult = {}
-        p = re.compile(
-            "^(.*)/(GridSquare_[0-9]*)*(_Data_)*(.*)_"
-            + "([0-9]*)_Data_([0-9]*)_([0-9]*)_([0-9]*)_([0-9]*)-([0-9]*)(_?.*)\.(.*)"
-        )
-        m = p.match(mrcFilePath)
-        dictResult["directory"] = os.path.dirname(mrcFilePath)
-        dictResult["gridSquare"] = m.group(2)
-        dictResult["data"] = m.group(3)
-        dictResult["prefix"] = m.group(4)
-        dictResult["id1"] = m.group(5)
-        dictResult["id2"] = m.group(6)
-        dictResult["id3"] = m.group(7)
-        dictResult["date"] = m.group(8)
-        dictResult["hour"] = m.group(9)
-        dictResult["movieNumber"] = m.group(10)
-        dictResult["extra"] = m.group(11)
-        dictResult["suffix"] = m.group(12)
-        dictResult[
-            "movieName"
-        ] = "{prefix}_{id1}_Data_{id2}_{id3}_{date}_{hour}-{movieNumber}".format(
-            **dictResult
+        return (
+            UtilsFileName.parseToDict(mrcFilePath, esrf_utils_filename.EPU_MOTIONCORR)
+            or {}
         )
-        return dictResult
 
     @staticmethod
     def getEpuTiffMovieFileNameParametersFromMotioncorrPath(mrcFilePath):
         """
         GridSquare_10847341_Data_FoilHole_10851620_Data_10853313_10853315_20210611_161457_fractions_aligned_mic.mrc
         """
-        dictResult = {}
-        p = re.compile(
-            "^(.*)/Images-Disc(.*)_GridSquare_([0-9]*)_"
-            + "Data_(.*)_([0-9]*)_Data_([0-9]*)_([0-9]*)_([0-9]*)_([0-9]*)"
-            + "_fractions_(.*)\.(.*)"
-        )
-        m = p.match(mrcFilePath)
-        if m is not None:
-            dictResult["gridSquare"] = m.group(3)
-            dictResult["prefix"] = m.group(4)
-            dictResult["id1"] = m.group(5)
-            dictResult["id2"] = m.group(6)
-            dictResult["id3"] = m.group(7)
-            dictResult["date"] = m.group(8)
-            dictResult["hour"] = m.group(9)
-            dictResult["extra"] = m.group(10)
-            dictResult["suffix"] = m.group(11)
-            dictResult[
-                "movieName"
-            ] = "{prefix}_{id1}_Data_{id2}_{id3}_{date}_{hour}_fractions".format(
-                **dictResult
+        return (
+            UtilsFileName.parseToDict(
+                mrcFilePath, esrf_utils_filename.EPU_TIFF_MOTIONCORR
             )
-            dictResult["movieNumber"] = dictResult["date"][-2:] + dictResult["hour"]
-        return dictResult
+            or {}
+        )
 
     @staticmethod
     def getSerialEMMovieFileNameParametersFromMotioncorrPath(mrcFilePath):
         """
         000064_ProtMotionCorr/extra/grid5_data_140_mx2214_140_00001_aligned_mic.mrc
         """
-        try:
-            dictResult = {}
-            p = re.compile("^(.*)/(.*)_([0-9]*)_(.*).(.*)")
-            m = p.match(mrcFilePath)
-            dictResult["directory"] = os.path.dirname(mrcFilePath)
-            dictResult["prefix"] = m.group(2)
-            dictResult["movieNumber"] = m.group(3)
-            dictResult["extra"] = m.group(4)
-            dictResult["suffix"] = m.group(5)
-            dictResult["movieName"] = "{prefix}_{movieNumber}".format(**dictResult)
-        except BaseException:
-            dictResult = None
-        # Check numbers
-        if not dictResult["movieNumber"].isdigit():
-            dictResult = None
-        return dictResult
+        return UtilsFileName.parseToDict(
+            mrcFilePath, esrf_utils_filename.SERIALEM_MOTIONCORR
+        )
 
     @staticmethod
     def removeFileSystemPrefix(filePath):
         newFilePath = filePath
-        for prefix in ["/gpfs/easy", "/gpfs/jazzy", "/gpfs/ga", "/gpfs/gb", "/gz", "hz"]:
+        for prefix in [
+            "/gpfs/easy",
+            "/gpfs/jazzy",
+            "/gpfs/ga",
+            "/gpfs/gb",
+            "/gz",
+            "hz",
+        ]:
             if filePath.startswith(prefix):
                 newFilePath = filePath.replace(prefix, "")
                 break
@@ -778,61 +469,23 @@ class UtilsPath(object):
 
     @staticmethod
     def getShiftData(file_path):
-        dict_results = {}
-        movie_name = pathlib.Path(file_path).stem.split("fractions")[0] + "fractions"
-        file_dir = pathlib.Path(file_path).parent
-        patch_path = file_dir / (movie_name + "-Patch-Full.log")
-        if patch_path.exists():
-            with open(patch_path) as f:
-                list_lines = f.readlines()
-            x_shift_prev = None
-            y_shift_prev = None
-            total_motion = 0
-            no_points = 0
-            for line in list_lines[3:]:
-                no_points += 1
-                line_parts = line.split()
-                x_shift = float(line_parts[1])
-                y_shift = float(line_parts[2])
-                if x_shift_prev is None:
-                    x_shift_prev = x_shift
-                    y_shift_prev = y_shift
-                else:
-                    delta_x_shift = x_shift - x_shift_prev
-                    delta_y_shift = y_shift - y_shift_prev
-                    shift = math.sqrt(delta_x_shift**2 + delta_y_shift**2)
-                    total_motion += shift
-            dict_results["noPoints"] = no_points
-            if total_motion != 0:
-                dict_results["totalMotion"] = round(total_motion, 1)
-                dict_results["averageMotionPerFrame"] = round(
-                    total_motion / no_points, 1
-                )
-        return dict_results
+        return UtilsDrift.getShiftData(file_path)
 
     @staticmethod
-    def findSerialEMFilePaths(topDirectory):
-        tifDir = None
-        firstTifFileName = None
-        defectFilePath = None
-        dm4FilePath = None
-        listTif = []
-        for dirName, subdirList, fileList in os.walk(topDirectory, topdown=False):
-            for fileName in fileList:
-                if fileName.endswith(".tif"):
-                    listTif.append(os.path.join(dirName, fileName))
-        if len(listTif) > 0:
-            listTif.sort()
-            firstTifPath = listTif[0]
-            tifDir = os.path.dirname(firstTifPath)
-            firstTifFileName = os.path.basename(firstTifPath)
-            listFiles = os.listdir(tifDir)
-            for file in listFiles:
-                if file.startswith("defect") and file.endswith(".txt"):
-                    defectFilePath = os.path.join(tifDir, file)
-                elif file.endswith(".dm4"):
-                    dm4FilePath = os.path.join(tifDir, file)
-        return tifDir, firstTifFileName, defectFilePath, dm4FilePath
+    def getShiftDataMany(list_file_path):
+        return UtilsDrift.getShiftDataMany(list_file_path)
+
+    @staticmethod
+    def findSerialEMFilePaths(topDirectory, indexFilePath=None):
+        """
+        Returns the directory and name of the first tif movie below
+        topDirectory and the defect map and dm4 files of that directory.
+        The index is opt-in: if indexFilePath is given (e.g. a file in the
+        project directory) the directories listed are recorded there and
+        not listed again by later calls unless their mtime has changed,
+        otherwise the index only lives for this call.
+        """
+        return SerialEMDiscoveryIndex(topDirectory, indexFilePath).find()
 
     @staticmethod
     def serialEMFilesPattern(dataDirectory, tifDir):
@@ -849,193 +502,155 @@ class UtilsPath(object):
         filesPattern += "*.tif"
         return filesPattern
 
+    @staticmethod
+    def getProcessedMovieNames(dictAllParams):
+        """
+        Names of the movies which have both motion correction and CTF results
+        """
+        return set(
+            movieName
+            for movieName, dictMovie in dictAllParams.items()
+            if isinstance(dictMovie, dict)
+            and "motionCorrectionId" in dictMovie
+            and "CTFid" in dictMovie
+        )
+
+    @staticmethod
+    def getUploadedMovieFullPaths(dictAllParams):
+        """
+        Paths of the movies uploaded to ISPyB, i.e. with a movie id
+        """
+        return set(
+            dictMovie["movieFullPath"]
+            for dictMovie in dictAllParams.values()
+            if isinstance(dictMovie, dict)
+            and "movieFullPath" in dictMovie
+            and dictMovie.get("movieId") is not None
+        )
+
     @staticmethod
     def getBlacklist(listMovies, allParamsJsonFile):
-        with open(allParamsJsonFile, "r") as f:
-            dictAllParams = json.loads(f.read())
-        dictGridSquare = {}
+        dictAllParams = UtilsState.read(allParamsJsonFile)
         # First find all grid squares which contain
         # movies that have not been processed
-        for movie in listMovies:
-            dictMovieName = UtilsPath.getEpuTiffMovieFileNameParameters(movie)
-            gridSquare = dictMovieName["gridSquare"]
-            if gridSquare not in dictGridSquare:
-                dictGridSquare[gridSquare] = []
-            movieName = os.path.splitext(os.path.basename(movie))[0]
-            if movieName in dictAllParams.keys():
-                dictMovie = dictAllParams[movieName]
-                if "motionCorrectionId" in dictMovie:
-                    if "CTFid" not in dictMovie:
-                        dictGridSquare[gridSquare].append(movieName)
-                else:
-                    dictGridSquare[gridSquare].append(movieName)
-            else:
-                dictGridSquare[gridSquare].append(movieName)
-        # Blacklist all grid squares with less than 50 movies
+        dictColumns = UtilsPath.parseMany(listMovies, esrf_utils_filename.EPU_TIFF)
+        setProcessed = UtilsPath.getProcessedMovieNames(dictAllParams)
+        isNotProcessed = numpy.array(
+            [
+                movieName not in setProcessed
+                for movieName in dictColumns["movieName"][dictColumns["valid"]].tolist()
+            ],
+            dtype=bool,
+        )
+        gridSquares, firstIndex, inverse = numpy.unique(
+            dictColumns["gridSquare"][dictColumns["valid"]],
+            return_index=True,
+            return_inverse=True,
+        )
+        noNotProcessed = numpy.bincount(
+            inverse, weights=isNotProcessed, minlength=len(gridSquares)
+        )
+        # Blacklist all grid squares with less than 25 movies
         blacklist = []
-        for gridSquare in dictGridSquare.keys():
-            if len(dictGridSquare[gridSquare]) < 25:
-                blacklist.append("(.*){0}(.*)".format(gridSquare))
+        for index in numpy.argsort(firstIndex):
+            if noNotProcessed[index] < 25:
+                blacklist.append("(.*){0}(.*)".format(gridSquares[index]))
         return blacklist
 
     @staticmethod
     def getBlacklistAllMovies(listMovies, allParamsJsonFile):
-        with open(allParamsJsonFile, "r") as f:
-            dictAllParams = json.loads(f.read())
-        blacklist = []
-        for movie in listMovies:
-            movieName = os.path.splitext(os.path.basename(movie))[0]
-            if movieName in dictAllParams.keys():
-                dictMovie = dictAllParams[movieName]
-                if "motionCorrectionId" in dictMovie:
-                    if "CTFid" in dictMovie:
-                        blacklist.append(movie)
+        dictAllParams = UtilsState.read(allParamsJsonFile)
+        setProcessed = UtilsPath.getProcessedMovieNames(dictAllParams)
+        blacklist = [
+            movie
+            for movie in listMovies
+            if os.path.splitext(os.path.basename(movie))[0] in setProcessed
+        ]
         return blacklist
 
     @staticmethod
     def getInputParticleDict(pathToInputParticlesStarFile, allParams):
-        with open(pathToInputParticlesStarFile) as fd:
-            listLines = fd.readlines()
-        # Find the line which starts with " 1":
-        indexStart = 0
-        foundStart = False
-        while not foundStart:
-            line = listLines[indexStart]
-            if len(line.split()) > 0 and line.split()[0] == "1":
-                foundStart = True
-                break
-            else:
-                indexStart += 1
-        gridSquareMovieNameStart = listLines[indexStart].split()[3]
-        # print(gridSquareMovieName)
-        movieNameStart = gridSquareMovieNameStart[
-            gridSquareMovieNameStart.find("_Data_") + 6 :
-        ]
-        movieNameStart = os.path.splitext(movieNameStart)[0]
-        movieDictStart = allParams[movieNameStart]
-        firstMovieFullPath = movieDictStart["movieFullPath"]
-        # Find the last entry
-        indexEnd = len(listLines) - 1
-        foundEnd = False
-        while not foundEnd:
-            line = listLines[indexEnd]
-            if len(line.split()) > 0:
-                foundEnd = True
-                break
-            else:
-                indexEnd -= 1
-        numberOfParticles = listLines[indexEnd].split()[0]
-        gridSquareMovieNameEnd = listLines[indexEnd].split()[3]
-        movieNameEnd = gridSquareMovieNameEnd[
-            gridSquareMovieNameEnd.find("_Data_") + 6 :
-        ]
-        movieNameEnd = os.path.splitext(movieNameEnd)[0]
-        movieDictEnd = allParams[movieNameEnd]
-        lastMovieFullPath = movieDictEnd["movieFullPath"]
+        listLabel = ["rlnImageId", "rlnMicrographName"]
+        dictRowStart = UtilsStar.getFirstRow(
+            pathToInputParticlesStarFile, "particles", listLabel
+        )
+        dictRowEnd = UtilsStar.getLastRow(
+            pathToInputParticlesStarFile, "particles", listLabel
+        )
+        listMovieFullPath = []
+        for dictRow in [dictRowStart, dictRowEnd]:
+            gridSquareMovieName = dictRow["rlnMicrographName"]
+            movieName = gridSquareMovieName[gridSquareMovieName.find("_Data_") + 6 :]
+            movieName = os.path.splitext(movieName)[0]
+            listMovieFullPath.append(allParams[movieName]["movieFullPath"])
         particleDict = {
-            "firstMovieFullPath": firstMovieFullPath,
-            "lastMovieFullPath": lastMovieFullPath,
-            "numberOfParticles": numberOfParticles,
+            "firstMovieFullPath": listMovieFullPath[0],
+            "lastMovieFullPath": listMovieFullPath[1],
+            "numberOfParticles": dictRowEnd["rlnImageId"],
         }
         return particleDict
 
     @classmethod
     def parseRelionModelStarFile(cls, filePath):
-        with open(filePath) as fd:
-            lines = fd.readlines()
-        lineIndex = 0
-        found = False
-        # Number of classes:
-        while not found:
-            line = lines[lineIndex]
-            if line.startswith("_rlnNrClasses"):
-                numberOfClasses = int(line.split()[1])
-                found = True
-            else:
-                lineIndex += 1
-        # Information per class
-        found = False
-        while not found:
-            line = lines[lineIndex]
-            if line.startswith("_rlnClassPriorOffsetY"):
-                found = True
-            lineIndex += 1
+        relionModel = UtilsStar.parseModel(filePath)
+        arrayClasses = relionModel.classes
+        if "rlnAccuracyTranslationsAngst" in arrayClasses.dtype.names:
+            accuracyTranslations = arrayClasses["rlnAccuracyTranslationsAngst"]
+        else:
+            # Relion 3.0 gives the translation accuracy in pixels
+            accuracyTranslations = arrayClasses["rlnAccuracyTranslations"]
+        listKey = [
+            "referenceImage",
+            "classDistribution",
+            "accuracyRotations",
+            "accuracyTranslationsAngst",
+            "estimatedResolution",
+            "overallFourierCompleteness",
+            "classPriorOffsetX",
+            "classPriorOffsetY",
+        ]
         listClass = []
-        for index in range(numberOfClasses):
-            line = lines[lineIndex]
-            listLine = line.split()
-            dictClass = {
-                "index": index + 1,
-                "referenceImage": listLine[0],
-                "classDistribution": float(listLine[1]),
-                "accuracyRotations": float(listLine[2]),
-                "accuracyTranslationsAngst": float(listLine[3]),
-                "estimatedResolution": float(listLine[4]),
-                "overallFourierCompleteness": float(listLine[5]),
-                "classPriorOffsetX": float(listLine[6]),
-                "classPriorOffsetY": float(listLine[7]),
-            }
+        for index, values in enumerate(
+            zip(
+                arrayClasses["rlnReferenceImage"].tolist(),
+                arrayClasses["rlnClassDistribution"].astype(float).tolist(),
+                arrayClasses["rlnAccuracyRotations"].astype(float).tolist(),
+                accuracyTranslations.astype(float).tolist(),
+                arrayClasses["rlnEstimatedResolution"].astype(float).tolist(),
+                arrayClasses["rlnOverallFourierCompleteness"].astype(float).tolist(),
+                arrayClasses["rlnClassPriorOffsetX"].astype(float).tolist(),
+                arrayClasses["rlnClassPriorOffsetY"].astype(float).tolist(),
+            )
+        ):
+            dictClass = {"index": index + 1}
+            dictClass.update(zip(listKey, values))
             listClass.append(dictClass)
-            lineIndex += 1
-        dictStarFile = {"numberOfClasses": numberOfClasses, "classes": listClass}
+        dictStarFile = {
+            "numberOfClasses": relionModel.numberOfClasses,
+            "classes": listClass,
+        }
         return dictStarFile
 
+    @staticmethod
+    def findLatestRelionModelStarFile(directory):
+        return UtilsStar.findLatestModelStarFile(directory)
+
     @staticmethod
     def getTSFileParameters(file_path):
-        if type(file_path) == str:
-            file_path = pathlib.Path(file_path)
-        dict_movie = None
-        directory = str(file_path.parent)
-        file_name = file_path.name
-        parent_name = str(file_path.parent.name)
-        reg_exp = "^(.+)_(\d+)_(\-*\d+\.\d+)_(\d{8})_(\d{6})_([a-zA-Z0-9]+){1}([_a-zA-Z0-9]*)\.{1}([a-zA-Z0-9]+)$"
-        p = re.compile(reg_exp)
-        m = p.match(file_name)
-        if m is not None:
-            ts_name = m.group(1)
-            movie_number = m.group(2)
-            tilt_angle = float(m.group(3))
-            ts_date = m.group(4)
-            ts_time = m.group(5)
-            fractions_name = m.group(6)
-            extra = m.group(7)
-            suffix = m.group(8)
-            movie_name = ts_name
-            for index in range(2, 7):
-                movie_name += "_" + m.group(index)
-            if "RAW_DATA" in directory or "PROCESSED_DATA" in directory:
-                if "RAW_DATA" in directory:
-                    date_dir = directory.split("RAW_DATA")[0]
-                else:
-                    date_dir = directory.split("PROCESSED_DATA")[0]
-                icat_raw_dir = os.path.join(
-                    date_dir, "RAW_DATA", parent_name, ts_name, movie_number
-                )
-                icat_processed_dir = os.path.join(
-                    date_dir, "PROCESSED_DATA", parent_name, ts_name, movie_number
-                )
-            else:
-                date_dir = directory
-                icat_raw_dir = directory
-                icat_processed_dir = directory
-            dict_movie = {
-                "file_path": str(file_path),
-                "directory": str(directory),
-                "file_name": file_name,
-                "ts_name": ts_name,
-                "movie_name": movie_name,
-                "sample_name": f"{parent_name}/{ts_name}",
-                "movie_number": int(movie_number),
-                "tilt_angle": tilt_angle,
-                "date": ts_date,
-                "time": ts_time,
-                "extra": extra,
-                "suffix": suffix,
-                "icat_raw_dir": icat_raw_dir,
-                "icat_processed_dir": icat_processed_dir,
-                "fractions_name": fractions_name,
-            }
-        return dict_movie
+        return UtilsFileName.parseToDict(file_path, esrf_utils_filename.TOMO)
+
+    @staticmethod
+    def getTiltSerieNoTilts(movie_dir, ts_name):
+        """
+        Number of tilts in the mdoc file of the tilt series, written in the
+        movie directory by Tomo, None if there is no such file yet.
+        """
+        mdoc_path = pathlib.Path(movie_dir) / (ts_name + ".mdoc")
+        try:
+            mdoc_data = UtilsMdoc.parse(mdoc_path)
+        except OSError:
+            return None
+        return len(mdoc_data.sections) or None
 
     @staticmethod
     def createIcatLink(file_path, icat_dir):
@@ -1058,14 +673,16 @@ class UtilsPath(object):
         gallery_dir = icat_dir / "gallery"
         if not gallery_dir.exists():
             gallery_dir.mkdir(mode=0o755)
-        temp_tif_path = gallery_dir / (icat_movie_path.stem + ".tif")
         snapshot_path = gallery_dir / (icat_movie_path.stem + ".jpg")
-        os.system(
-            f"/cvmfs/sb.esrf.fr/bin/bimg -average -truncate 0,1 -minmax 0,1 {icat_movie_path} {temp_tif_path}"
+        UtilsSnapshot.createCachedSnapshot(
+            icat_movie_path,
+            snapshot_path,
+            average=True,
+            truncate=(0, 1),
+            minmax=(0, 1),
+            binning=20,
         )
-        os.system(f"bscale -bin 20 {temp_tif_path} {snapshot_path}")
         # os.chmod(snapshot_path, mode=0o644)
-        os.remove(str(temp_tif_path))
 
     @staticmethod
     def createTiltSerieSearchSnapshot(dict_movie, search_dir):
@@ -1084,19 +701,25 @@ class UtilsPath(object):
                 search_file_name = new_ts_name + "_Search"
                 search_mrc_path = batch_dir / (search_file_name + ".mrc")
         if search_mrc_path.exists():
-            temp_tif_path = search_dir / (search_file_name + ".tif")
             search_snapshot_path = search_dir / (search_file_name + ".jpg")
             print("*" * 80)
             print(str(search_mrc_path))
             print(str(search_snapshot_path))
             print("*" * 80)
             if not search_snapshot_path.exists():
-                os.system(
-                    f"/cvmfs/sb.esrf.fr/bin/bimg -average {search_mrc_path} {temp_tif_path}"
-                )
-                os.system(f"/cvmfs/sb.esrf.fr/bin/bscale -bin 6 {temp_tif_path} {search_snapshot_path}")
+                try:
+                    UtilsSnapshot.createCachedSnapshot(
+                        search_mrc_path, search_snapshot_path, average=True, binning=6
+                    )
+                except (OSError, RuntimeError, ValueError) as error:
+                    # Still being written or truncated
+                    print(
+                        "WARNING! No search snapshot for {0}: {1}".format(
+                            search_mrc_path, error
+                        )
+                    )
+                    search_snapshot_path = None
                 # os.chmod(search_snapshot_path, mode=0o644)
-                os.remove(str(temp_tif_path))
         else:
             search_snapshot_path = None
         return search_snapshot_path
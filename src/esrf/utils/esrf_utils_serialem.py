@@ -26,24 +26,92 @@
 # **************************************************************************
 
 import os
-import subprocess
+
+from esrf.utils.esrf_utils_gain import UtilsGain
+from esrf.utils.esrf_utils_jobs import UtilsJobs
+from esrf.utils.esrf_utils_header import UtilsHeader
+
+# Conversion backends: in-process with UtilsGain, falling back to the IMOD
+# tools on failure, or only the IMOD tools. The IMOD tools stay the default
+# until the native output has been checked against theirs on real gain
+# references and defect lists (Test.test_nativeParity in
+# test_esrf_utils_gain, run where IMOD is installed).
+NATIVE = "native"
+EXTERNAL = "external"
+GAIN_BACKEND = os.environ.get("ESRF_GAIN_BACKEND", EXTERNAL)
 
 
 class UtilsSerialEM(object):
     @staticmethod
-    def createGainFile(dm4File, gainDir):
+    def createGainFile(dm4File, gainDir, backend=None):
         fileName = os.path.splitext(os.path.basename(dm4File))[0]
         gainFilePath = os.path.join(gainDir, fileName + ".mrc")
-        stdout = subprocess.check_output(["dm2mrc", dm4File, gainFilePath])
-        print(stdout)
+        backend = backend or GAIN_BACKEND
+
+        def convert(mrcFilePath):
+            if backend == NATIVE:
+                try:
+                    UtilsGain.convertDm4ToMrc(dm4File, mrcFilePath)
+                    return
+                except (OSError, RuntimeError, ValueError) as error:
+                    print(
+                        "WARNING! Native conversion of {0} failed, "
+                        "using dm2mrc: {1}".format(dm4File, error)
+                    )
+            jobResult = UtilsJobs.run(["dm2mrc", dm4File, mrcFilePath])
+            print(jobResult.stdout)
+
+        UtilsGain.getCache().getFile(
+            [dm4File], gainFilePath, convert, kind="gain", backend=backend
+        )
         return gainFilePath
 
     @staticmethod
-    def createDefectMapFile(shiftFile, tifFile, gainDir):
+    def createDefectMapFile(shiftFile, tifFile, gainDir, backend=None):
         fileName = os.path.splitext(os.path.basename(shiftFile))[0]
         defectMapPath = os.path.join(gainDir, fileName + ".mrc")
-        stdout = subprocess.check_output(
-            ["clip", "defect", "-D", shiftFile, tifFile, defectMapPath]
+        backend = backend or GAIN_BACKEND
+
+        def runClip(mrcFilePath):
+            jobResult = UtilsJobs.run(
+                ["clip", "defect", "-D", shiftFile, tifFile, mrcFilePath]
+            )
+            print(jobResult.stdout)
+
+        if backend != NATIVE:
+            runClip(defectMapPath)
+            return defectMapPath
+        # Only the size of the movie is used, its content isn't hashed
+        try:
+            movieHeader = UtilsHeader.probe(tifFile)
+        except (OSError, RuntimeError) as error:
+            print(
+                "WARNING! Cannot read the size of {0}, using clip: {1}".format(
+                    tifFile, error
+                )
+            )
+            runClip(defectMapPath)
+            return defectMapPath
+
+        def convert(mrcFilePath):
+            try:
+                UtilsGain.convertDefectList(
+                    shiftFile, movieHeader.width, movieHeader.height, mrcFilePath
+                )
+            except (OSError, RuntimeError, ValueError) as error:
+                print(
+                    "WARNING! Native conversion of {0} failed, "
+                    "using clip: {1}".format(shiftFile, error)
+                )
+                runClip(mrcFilePath)
+
+        UtilsGain.getCache().getFile(
+            [shiftFile],
+            defectMapPath,
+            convert,
+            kind="defect",
+            backend=backend,
+            width=movieHeader.width,
+            height=movieHeader.height,
         )
-        print(stdout)
         return defectMapPath
@@ -0,0 +1,297 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import json
+import pathlib
+import hashlib
+import threading
+
+import numpy
+from PIL import Image
+
+from esrf.utils import esrf_utils_header
+from esrf.utils.esrf_utils_file import UtilsFile
+from esrf.utils.esrf_utils_header import UtilsHeader
+
+JPEG_QUALITY = 90
+
+# Rendered snapshots shared between monitor runs, least recently used
+# entries are evicted above SNAPSHOT_CACHE_MAX_SIZE bytes
+SNAPSHOT_CACHE_DIR = os.environ.get(
+    "ESRF_SNAPSHOT_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "scipion-em-esrf", "snapshots"),
+)
+SNAPSHOT_CACHE_MAX_SIZE = 2 * 1024**3
+
+# Part of the cache keys, changed when the rendering of the same
+# parameters changes
+SNAPSHOT_RENDER_VERSION = 2
+
+
+class UtilsSnapshot(object):
+    """
+    In-process replacement of the Bsoft 'bimg' / 'bscale' snapshot pipeline.
+
+    The image is read (MRC files are memory-mapped, TIFF files are read
+    frame by frame), optionally averaged over its frames ('-average'),
+    clipped ('-truncate low,high'), block binned ('-bin N') and scaled to
+    8 bits before being written as JPEG. The 8-bit scaling maps the
+    '-minmax low,high' window to 0-255, values outside it are clipped.
+    Without it the data range is used, or a percentile window to be
+    robust against hot pixels.
+    """
+
+    @staticmethod
+    def readMrc(mrcFilePath):
+        """
+        Returns a read-only memory map of shape (sections, rows, columns).
+        """
+        movieHeader = UtilsHeader.probe(mrcFilePath)
+        if movieHeader.format != esrf_utils_header.MRC:
+            raise RuntimeError(f"File {mrcFilePath} is not a MRC file")
+        return numpy.memmap(
+            mrcFilePath,
+            dtype=numpy.dtype(movieHeader.dtype),
+            mode="r",
+            offset=movieHeader.dataOffset,
+            shape=(movieHeader.frames, movieHeader.height, movieHeader.width),
+        )
+
+    @staticmethod
+    def loadImage(imageFilePath, average=False):
+        """
+        Returns the first frame or, with average=True, the mean of all frames
+        as a 2D float array.
+        """
+        imageFilePath = pathlib.Path(imageFilePath)
+        if imageFilePath.suffix.lower() in [".mrc", ".mrcs", ".st"]:
+            stack = UtilsSnapshot.readMrc(imageFilePath)
+            if average:
+                image = stack.mean(axis=0, dtype=numpy.float64)
+            else:
+                image = numpy.array(stack[0], dtype=numpy.float64)
+            del stack
+            return image
+        with Image.open(imageFilePath) as tiff:
+            noFrames = getattr(tiff, "n_frames", 1) if average else 1
+            image = None
+            for index in range(noFrames):
+                tiff.seek(index)
+                frame = numpy.asarray(tiff, dtype=numpy.float64)
+                image = frame if image is None else image + frame
+        return image / noFrames
+
+    @staticmethod
+    def binImage(image, binning):
+        """
+        Block average of binning x binning pixels, incomplete blocks at the
+        borders are dropped as done by 'bscale -bin'.
+        """
+        if binning <= 1:
+            return image
+        ny = image.shape[0] // binning
+        nx = image.shape[1] // binning
+        if nx == 0 or ny == 0:
+            raise RuntimeError(f"Image {image.shape} too small for binning {binning}")
+        blocks = image[: ny * binning, : nx * binning].reshape(ny, binning, nx, binning)
+        return blocks.mean(axis=(1, 3))
+
+    @staticmethod
+    def scaleToUint8(image, percentile=None, minmax=None):
+        if minmax is not None:
+            low, high = float(minmax[0]), float(minmax[1])
+        elif percentile is None:
+            low, high = float(image.min()), float(image.max())
+        else:
+            low, high = numpy.percentile(image, [percentile, 100 - percentile])
+        if high <= low:
+            return numpy.zeros(image.shape, dtype=numpy.uint8)
+        scaled = (image - low) * (255.0 / (high - low))
+        return numpy.clip(scaled + 0.5, 0, 255).astype(numpy.uint8)
+
+    @staticmethod
+    def createSnapshot(
+        imageFilePath,
+        snapshotFilePath,
+        average=False,
+        truncate=None,
+        minmax=None,
+        binning=1,
+        percentile=None,
+        quality=JPEG_QUALITY,
+    ):
+        """
+        Renders imageFilePath as JPEG, the options follow the 'bimg' and
+        'bscale' flags of the same name. Returns the snapshot path.
+        """
+        if minmax is not None and minmax[1] <= minmax[0]:
+            raise RuntimeError(f"Invalid minmax range: {minmax}")
+        image = UtilsSnapshot.loadImage(imageFilePath, average=average)
+        if truncate is not None:
+            image = numpy.clip(image, truncate[0], truncate[1])
+        image = UtilsSnapshot.binImage(image, binning)
+        snapshot = Image.fromarray(
+            UtilsSnapshot.scaleToUint8(image, percentile=percentile, minmax=minmax)
+        )
+        tmpFilePath = str(snapshotFilePath) + ".tmp"
+        snapshot.save(tmpFilePath, format="JPEG", quality=quality)
+        os.replace(tmpFilePath, snapshotFilePath)
+        return snapshotFilePath
+
+    @staticmethod
+    def getCache():
+        global _SNAPSHOT_CACHE
+        with _LOCK_SNAPSHOT_CACHE:
+            if _SNAPSHOT_CACHE is None:
+                _SNAPSHOT_CACHE = SnapshotCache(SNAPSHOT_CACHE_DIR)
+            return _SNAPSHOT_CACHE
+
+    @staticmethod
+    def setCache(snapshotCache):
+        """
+        Replaces the shared SnapshotCache, None restores the default one.
+        """
+        global _SNAPSHOT_CACHE
+        with _LOCK_SNAPSHOT_CACHE:
+            _SNAPSHOT_CACHE = snapshotCache
+
+    @staticmethod
+    def createCachedSnapshot(imageFilePath, snapshotFilePath, **renderParameters):
+        """
+        'createSnapshot' through the shared SnapshotCache.
+        """
+        return UtilsSnapshot.getCache().getSnapshot(
+            imageFilePath, snapshotFilePath, **renderParameters
+        )
+
+
+class SnapshotCache(object):
+    """
+    Content-addressed store of rendered snapshots. An entry is keyed by the
+    source path, size and mtime and by the render parameters, it is
+    rendered once and handed out as a hardlink (a copy across file
+    systems) to the requested path. Entries are touched when used and the
+    least recently used ones are evicted above maxSize bytes.
+    """
+
+    def __init__(self, cacheDirectory, maxSize=SNAPSHOT_CACHE_MAX_SIZE):
+        self.cacheDirectory = os.fspath(cacheDirectory)
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.dictEntry = None
+        self.totalSize = 0
+
+    @staticmethod
+    def getKey(imageFilePath, renderParameters):
+        imageFilePath = os.path.realpath(imageFilePath)
+        stat = os.stat(imageFilePath)
+        keyData = json.dumps(
+            [
+                SNAPSHOT_RENDER_VERSION,
+                imageFilePath,
+                stat.st_size,
+                stat.st_mtime_ns,
+                renderParameters,
+            ],
+            sort_keys=True,
+        )
+        return hashlib.sha256(keyData.encode("utf-8")).hexdigest()
+
+    def getEntryPath(self, key):
+        return os.path.join(self.cacheDirectory, key[:2], key + ".jpg")
+
+    def _scan(self):
+        # Entry path -> [last use, size], read once from the cache directory
+        self.dictEntry = {}
+        self.totalSize = 0
+        if not os.path.isdir(self.cacheDirectory):
+            return
+        for subDirEntry in os.scandir(self.cacheDirectory):
+            if not subDirEntry.is_dir():
+                continue
+            for entry in os.scandir(subDirEntry.path):
+                if entry.name.endswith(".jpg"):
+                    stat = entry.stat()
+                    self.dictEntry[entry.path] = [stat.st_mtime, stat.st_size]
+                    self.totalSize += stat.st_size
+
+    def _evict(self):
+        if self.totalSize <= self.maxSize:
+            return
+        listEntry = sorted(self.dictEntry.items(), key=lambda item: item[1][0])
+        for entryPath, (lastUse, size) in listEntry:
+            if self.totalSize <= self.maxSize:
+                break
+            try:
+                os.remove(entryPath)
+            except FileNotFoundError:
+                pass
+            del self.dictEntry[entryPath]
+            self.totalSize -= size
+
+    def getSnapshot(self, imageFilePath, snapshotFilePath, **renderParameters):
+        """
+        Puts the snapshot of imageFilePath at snapshotFilePath, rendering
+        it only if it isn't in the cache. Returns snapshotFilePath.
+        """
+        entryPath = self.getEntryPath(self.getKey(imageFilePath, renderParameters))
+        with self.lock:
+            if self.dictEntry is None:
+                self._scan()
+            isCached = os.path.exists(entryPath)
+            if isCached:
+                os.utime(entryPath)
+                size = os.path.getsize(entryPath)
+                if entryPath not in self.dictEntry:
+                    self.totalSize += size
+                self.dictEntry[entryPath] = [os.path.getmtime(entryPath), size]
+        if not isCached:
+            os.makedirs(os.path.dirname(entryPath), exist_ok=True)
+            renderPath = "{0}.{1}.{2}".format(
+                entryPath, os.getpid(), threading.get_ident()
+            )
+            UtilsSnapshot.createSnapshot(imageFilePath, renderPath, **renderParameters)
+            os.replace(renderPath, entryPath)
+            with self.lock:
+                size = os.path.getsize(entryPath)
+                if entryPath not in self.dictEntry:
+                    self.totalSize += size
+                self.dictEntry[entryPath] = [os.path.getmtime(entryPath), size]
+                self._evict()
+        if os.path.exists(entryPath):
+            UtilsFile.linkOrCopy(entryPath, snapshotFilePath)
+        else:
+            # Evicted at once, larger than the cache
+            UtilsSnapshot.createSnapshot(
+                imageFilePath, snapshotFilePath, **renderParameters
+            )
+        return snapshotFilePath
+
+
+_SNAPSHOT_CACHE = None
+_LOCK_SNAPSHOT_CACHE = threading.Lock()
@@ -0,0 +1,295 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import re
+import functools
+import collections
+
+import numpy
+
+# Bytes read per step when seeking backwards from the end of a file
+TAIL_SIZE = 8192
+
+# Parsed Relion model.star files kept in memory
+MODEL_CACHE_SIZE = 64
+
+# relion_it025_model.star, or run_ct12_it025_model.star for continued runs
+RELION_MODEL_STAR_PATTERN = re.compile(
+    r"^(?:relion|run)(?:_ct[0-9]+)?_it([0-9]+)_model\.star$"
+)
+
+StarLoop = collections.namedtuple("StarLoop", ["blockName", "labels", "dataOffset"])
+
+# 'general': label / value pairs of data_model_general, 'classes': read-only
+# structured array of data_model_classes with one field per label
+RelionModel = collections.namedtuple(
+    "RelionModel", ["numberOfClasses", "general", "classes"]
+)
+
+
+def _labelName(label):
+    # '_rlnImageId #1' -> 'rlnImageId'
+    return label.split()[0].lstrip("_")
+
+
+@functools.lru_cache(maxsize=MODEL_CACHE_SIZE)
+def _parseModel(modelStarFilePath, size, mtime):
+    # size and mtime are only part of the cache key
+    dictGeneral = UtilsStar.getValues(modelStarFilePath, "model_general")
+    numberOfClasses = int(dictGeneral["rlnNrClasses"])
+    arrayClasses = UtilsStar.loadStructuredArray(modelStarFilePath, "model_classes")
+    arrayClasses = arrayClasses[:numberOfClasses]
+    arrayClasses.flags.writeable = False
+    return RelionModel(numberOfClasses, dictGeneral, arrayClasses)
+
+
+class UtilsStar(object):
+    """
+    Streaming reader of STAR files (Relion). Blocks are addressed by the
+    name following 'data_', columns by their label with or without the
+    leading underscore ('rlnImageId' or '_rlnImageId'). Only the lines
+    up to the requested block are read to find it, loop rows are parsed
+    lazily and the last row of the last loop of a file is found by
+    seeking backwards from the end of the file.
+    """
+
+    @staticmethod
+    def _findBlock(fd, blockName):
+        # Positions fd after the 'data_<blockName>' line
+        while True:
+            line = fd.readline()
+            if not line:
+                raise RuntimeError(f"No block data_{blockName} in {fd.name}")
+            line = line.strip()
+            if line.startswith("data_") and line[5:] == blockName:
+                return
+
+    @staticmethod
+    def _nextLine(fd):
+        # Next line which isn't empty nor a comment, '' at end of file
+        while True:
+            offset = fd.tell()
+            line = fd.readline()
+            if not line:
+                return offset, ""
+            line = line.strip()
+            if line and not line.startswith("#"):
+                return offset, line
+
+    @staticmethod
+    def getLoop(starFilePath, blockName):
+        """
+        Returns the StarLoop of a block: its labels and the offset of its
+        first row.
+        """
+        with open(starFilePath) as fd:
+            UtilsStar._findBlock(fd, blockName)
+            offset, line = UtilsStar._nextLine(fd)
+            if line != "loop_":
+                raise RuntimeError(
+                    f"Block data_{blockName} in {starFilePath} is not a loop"
+                )
+            listLabel = []
+            offset, line = UtilsStar._nextLine(fd)
+            while line.startswith("_"):
+                listLabel.append(_labelName(line))
+                offset, line = UtilsStar._nextLine(fd)
+        return StarLoop(blockName, listLabel, offset)
+
+    @staticmethod
+    def getValues(starFilePath, blockName):
+        """
+        Returns the label / value pairs of a block which isn't a loop.
+        """
+        dictValues = {}
+        with open(starFilePath) as fd:
+            UtilsStar._findBlock(fd, blockName)
+            offset, line = UtilsStar._nextLine(fd)
+            while line.startswith("_"):
+                listItem = line.split(None, 1)
+                dictValues[_labelName(listItem[0])] = (
+                    listItem[1].strip() if len(listItem) > 1 else ""
+                )
+                offset, line = UtilsStar._nextLine(fd)
+        return dictValues
+
+    @staticmethod
+    def _getIndices(starLoop, listLabel):
+        if listLabel is None:
+            return starLoop.labels, list(range(len(starLoop.labels)))
+        listLabel = [_labelName(label) for label in listLabel]
+        for label in listLabel:
+            if label not in starLoop.labels:
+                raise RuntimeError(
+                    f"No label {label} in block data_{starLoop.blockName}"
+                )
+        return listLabel, [starLoop.labels.index(label) for label in listLabel]
+
+    @staticmethod
+    def iterRows(starFilePath, blockName, listLabel=None):
+        """
+        Yields the rows of a loop as dictionaries of strings, limited to the
+        labels in listLabel if given.
+        """
+        starLoop = UtilsStar.getLoop(starFilePath, blockName)
+        listLabel, listIndex = UtilsStar._getIndices(starLoop, listLabel)
+        noLabels = len(starLoop.labels)
+        with open(starFilePath) as fd:
+            fd.seek(starLoop.dataOffset)
+            for line in fd:
+                listValue = line.split()
+                if not listValue or listValue[0].startswith("#"):
+                    continue
+                if len(listValue) != noLabels or listValue[0].startswith("data_"):
+                    break
+                yield {
+                    label: listValue[index]
+                    for label, index in zip(listLabel, listIndex)
+                }
+
+    @staticmethod
+    def getFirstRow(starFilePath, blockName, listLabel=None):
+        for dictRow in UtilsStar.iterRows(starFilePath, blockName, listLabel):
+            return dictRow
+        return None
+
+    @staticmethod
+    def getLastRow(starFilePath, blockName, listLabel=None):
+        """
+        Returns the last row of a loop. If the loop is the last block of the
+        file, which is the case for the Relion particle files, only the
+        end of the file is read.
+        """
+        starLoop = UtilsStar.getLoop(starFilePath, blockName)
+        listLabel, listIndex = UtilsStar._getIndices(starLoop, listLabel)
+        listValue = UtilsStar._readLastLine(starFilePath, starLoop.dataOffset)
+        if listValue is not None and len(listValue) == len(starLoop.labels):
+            return {
+                label: listValue[index] for label, index in zip(listLabel, listIndex)
+            }
+        # Not the last block: stream through the loop
+        dictRow = None
+        for dictRow in UtilsStar.iterRows(starFilePath, blockName, listLabel):
+            pass
+        return dictRow
+
+    @staticmethod
+    def _readLastLine(starFilePath, minOffset):
+        # Fields of the last line which isn't empty nor a comment, None if
+        # it doesn't start after minOffset
+        with open(starFilePath, "rb") as fd:
+            endOffset = fd.seek(0, os.SEEK_END)
+            tail = b""
+            while endOffset > minOffset:
+                startOffset = max(minOffset, endOffset - TAIL_SIZE)
+                fd.seek(startOffset)
+                tail = fd.read(endOffset - startOffset) + tail
+                endOffset = startOffset
+                listLine = tail.split(b"\n")
+                # The first line may be incomplete unless it starts at minOffset
+                if startOffset > minOffset:
+                    listLine = listLine[1:]
+                for line in reversed(listLine):
+                    line = line.strip()
+                    if line and not line.startswith(b"#"):
+                        return line.decode("utf-8").split()
+        return None
+
+    @staticmethod
+    def loadColumns(starFilePath, blockName, listLabel):
+        """
+        Returns a dictionary of NumPy arrays, one per label. Columns are
+        converted to int or float when all their values allow it.
+        """
+        dictList = {_labelName(label): [] for label in listLabel}
+        for dictRow in UtilsStar.iterRows(starFilePath, blockName, listLabel):
+            for label, value in dictRow.items():
+                dictList[label].append(value)
+        dictColumns = {}
+        for label, listValue in dictList.items():
+            column = numpy.array(listValue)
+            for dtype in [numpy.int64, numpy.float64]:
+                try:
+                    column = column.astype(dtype)
+                    break
+                except ValueError:
+                    pass
+            dictColumns[label] = column
+        return dictColumns
+
+    @staticmethod
+    def loadStructuredArray(starFilePath, blockName, listLabel=None):
+        """
+        Returns a loop as a NumPy structured array with one field per label,
+        typed as in 'loadColumns'.
+        """
+        if listLabel is None:
+            listLabel = UtilsStar.getLoop(starFilePath, blockName).labels
+        dictColumns = UtilsStar.loadColumns(starFilePath, blockName, listLabel)
+        arrayRows = numpy.empty(
+            len(next(iter(dictColumns.values()))),
+            dtype=[(label, column.dtype) for label, column in dictColumns.items()],
+        )
+        for label, column in dictColumns.items():
+            arrayRows[label] = column
+        return arrayRows
+
+    @staticmethod
+    def parseModel(modelStarFilePath):
+        """
+        Returns the RelionModel of a Relion model.star file. Results are
+        cached by (path, size, mtime) and shared between callers.
+        """
+        modelStarFilePath = os.fspath(modelStarFilePath)
+        statResult = os.stat(modelStarFilePath)
+        return _parseModel(
+            modelStarFilePath, statResult.st_size, statResult.st_mtime_ns
+        )
+
+    @staticmethod
+    def findLatestModelStarFile(directory):
+        """
+        Returns the path of the model.star file of the highest iteration in
+        directory, None if there is none.
+        """
+        latestIteration = -1
+        latestModelStarFilePath = None
+        try:
+            listEntry = list(os.scandir(directory))
+        except FileNotFoundError:
+            return None
+        for entry in listEntry:
+            match = RELION_MODEL_STAR_PATTERN.match(entry.name)
+            if match is not None and int(match.group(1)) > latestIteration:
+                latestIteration = int(match.group(1))
+                latestModelStarFilePath = entry.path
+        return latestModelStarFilePath
+
+    @staticmethod
+    def clearCache():
+        _parseModel.cache_clear()
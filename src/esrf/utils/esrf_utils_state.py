@@ -0,0 +1,225 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import atexit
+import time
+import logging
+import signal
+import threading
+
+from esrf.utils.esrf_utils_journal import ParamsJournal, UtilsJournal
+from esrf.utils.esrf_utils_statedb import UtilsStateDb
+
+# allParams backends: JSON snapshot and journal, or SQLite database
+JOURNAL = "journal"
+SQLITE = "sqlite"
+STATE_BACKEND = os.environ.get("ESRF_STATE_BACKEND", JOURNAL)
+
+# Minimum number of seconds between two writes of the state by StateWriter
+STATE_WRITE_INTERVAL = float(os.environ.get("ESRF_STATE_WRITE_INTERVAL", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+class UtilsState(object):
+    """
+    Entry point to the allParams of a session, stored with the backend
+    given by ESRF_STATE_BACKEND. A session which has a database keeps
+    using it, and a session started with allParams.json is imported in
+    the database the first time it is loaded with the SQLite backend.
+    """
+
+    @staticmethod
+    def getBackend(jsonFilePath, backend=None):
+        if UtilsStateDb.exists(jsonFilePath):
+            return SQLITE
+        return backend or STATE_BACKEND
+
+    @staticmethod
+    def exists(jsonFilePath):
+        return UtilsStateDb.exists(jsonFilePath) or UtilsJournal.exists(jsonFilePath)
+
+    @staticmethod
+    def read(jsonFilePath):
+        """
+        Returns the allParams of jsonFilePath as an OrderedDict.
+        """
+        if UtilsStateDb.exists(jsonFilePath):
+            return UtilsStateDb.read(jsonFilePath)
+        return UtilsJournal.read(jsonFilePath)
+
+    @staticmethod
+    def load(jsonFilePath, backend=None):
+        """
+        Returns the allParams of jsonFilePath as a TrackedParams to be
+        flushed after updates, None gives one which isn't saved.
+        """
+        if jsonFilePath is None:
+            return ParamsJournal(None)
+        elif UtilsState.getBackend(jsonFilePath, backend) == SQLITE:
+            return UtilsStateDb.load(jsonFilePath)
+        return UtilsJournal.load(jsonFilePath)
+
+    @staticmethod
+    def create(jsonFilePath, backend=None):
+        """
+        Returns empty allParams, replacing what is stored at jsonFilePath.
+        """
+        if UtilsState.getBackend(jsonFilePath, backend) == SQLITE:
+            return UtilsStateDb.create(jsonFilePath)
+        return UtilsJournal.create(jsonFilePath)
+
+
+class StateWriter(object):
+    """
+    Writes allParams (a TrackedParams) in a background thread. 'markDirty'
+    only wakes the thread up, and updates coming in bursts are written
+    together at most once per interval. 'flush' writes at once and
+    returns when the state is on disk. 'stop' writes the pending updates
+    and is called at exit and, with 'installSignalHandlers', on SIGTERM.
+    Errors of the background writes go to 'logger', the entries which
+    couldn't be written are written again at the next interval.
+    """
+
+    def __init__(self, params, interval=STATE_WRITE_INTERVAL, logger=logger):
+        self.params = params
+        self.interval = interval
+        self.logger = logger
+        self.dictPreviousHandler = {}
+        self.condition = threading.Condition()
+        self.writeLock = threading.Lock()
+        self.isDirty = False
+        self.isStopped = False
+        self.lastWriteTime = 0.0
+        self.noWrites = 0
+        self.thread = threading.Thread(
+            target=self._run, name="StateWriter", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def markDirty(self):
+        with self.condition:
+            self.isDirty = True
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.isDirty and not self.isStopped:
+                    self.condition.wait()
+                if self.isStopped:
+                    return
+                # Coalesce the updates coming until the end of the interval
+                delay = self.lastWriteTime + self.interval - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    if self.isStopped:
+                        return
+            try:
+                self.flush()
+            except Exception as error:
+                # The params kept the entries dirty
+                self.logger.warning("Couldn't write state: {0}".format(error))
+                self.markDirty()
+
+    def flush(self):
+        """
+        Writes the pending updates and returns when they are on disk.
+        """
+        with self.writeLock:
+            with self.condition:
+                self.isDirty = False
+            try:
+                self.params.flush()
+            finally:
+                # Failed writes are retried after the interval too
+                self.lastWriteTime = time.monotonic()
+            self.noWrites += 1
+
+    def stop(self):
+        with self.condition:
+            if self.isStopped:
+                return
+            self.isStopped = True
+            self.condition.notify()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.restoreSignalHandlers()
+        self.flush()
+        atexit.unregister(self.stop)
+
+    def installSignalHandlers(self, listSignal=(signal.SIGTERM,)):
+        """
+        Stops the writer before the previous handler of each signal runs,
+        the previous handlers are restored by 'stop'. Only done from the
+        main thread, returns False otherwise.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return False
+        for signalNumber in listSignal:
+            if signalNumber in self.dictPreviousHandler:
+                continue
+            previousHandler = signal.getsignal(signalNumber)
+
+            def handler(signalNumber, frame, previousHandler=previousHandler):
+                self.stop()
+                if callable(previousHandler):
+                    previousHandler(signalNumber, frame)
+                elif previousHandler != signal.SIG_IGN:
+                    signal.signal(signalNumber, signal.SIG_DFL)
+                    os.kill(os.getpid(), signalNumber)
+
+            signal.signal(signalNumber, handler)
+            self.dictPreviousHandler[signalNumber] = (previousHandler, handler)
+        return True
+
+    def restoreSignalHandlers(self):
+        """
+        Puts back the handlers replaced by 'installSignalHandlers', unless
+        they were replaced again since. Signal handlers can only be set
+        from the main thread, elsewhere ours stay and only call the
+        previous ones once stopped.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return False
+        for signalNumber, (
+            previousHandler,
+            handler,
+        ) in self.dictPreviousHandler.items():
+            if (
+                signal.getsignal(signalNumber) is handler
+                and previousHandler is not None
+            ):
+                signal.signal(signalNumber, previousHandler)
+        self.dictPreviousHandler = {}
+        return True
@@ -0,0 +1,352 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import re
+import json
+import time
+import sqlite3
+import collections
+
+from esrf.utils.esrf_utils_journal import TrackedParams, UtilsJournal
+
+DATABASE_SUFFIX = ".sqlite"
+
+# Table of an allParams entry, see 'UtilsStateDb.getTable'
+MOVIES = "movies"
+GRID_SQUARES = "grid_squares"
+DATASETS = "datasets"
+CONFIGS = "configs"
+OTHERS = "others"
+LIST_TABLE = [MOVIES, GRID_SQUARES, DATASETS, CONFIGS, OTHERS]
+
+# Processing stage ids of a movie, NULL until uploaded
+MOVIE_STAGES = ["movieId", "motionCorrectionId", "CTFid"]
+
+# Data set names are '<grid square> [<date time>]'
+DATASET_KEY_PATTERN = re.compile(r"^\S+ \[\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\]$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS movies (
+    key TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    movieFullPath TEXT,
+    gridSquare TEXT,
+    movieId INTEGER,
+    motionCorrectionId INTEGER,
+    CTFid INTEGER,
+    archived INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS movies_movieFullPath ON movies (movieFullPath);
+CREATE INDEX IF NOT EXISTS movies_gridSquare ON movies (gridSquare);
+CREATE INDEX IF NOT EXISTS movies_archived ON movies (archived);
+CREATE INDEX IF NOT EXISTS movies_movieId ON movies (movieId);
+CREATE INDEX IF NOT EXISTS movies_motionCorrectionId ON movies (motionCorrectionId);
+CREATE INDEX IF NOT EXISTS movies_CTFid ON movies (CTFid);
+CREATE TABLE IF NOT EXISTS grid_squares (
+    key TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    lastMovieTime REAL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS datasets (
+    key TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    gridSquare TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS datasets_gridSquare ON datasets (gridSquare);
+CREATE TABLE IF NOT EXISTS configs (
+    key TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS others (
+    key TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+
+class UtilsStateDb(object):
+    """
+    SQLite store of allParams, 'allParams.sqlite' next to allParams.json.
+    Each entry is kept as JSON in the table of its kind, with the fields
+    used for queries copied to indexed columns. 'seq' keeps the order of
+    insertion of the keys.
+    """
+
+    @staticmethod
+    def getDatabasePath(jsonFilePath):
+        return os.path.splitext(os.fspath(jsonFilePath))[0] + DATABASE_SUFFIX
+
+    @staticmethod
+    def exists(jsonFilePath):
+        return os.path.exists(UtilsStateDb.getDatabasePath(jsonFilePath))
+
+    @staticmethod
+    def getTable(key, value):
+        if key.startswith("config_dict_"):
+            return CONFIGS
+        elif DATASET_KEY_PATTERN.match(key):
+            return DATASETS
+        elif key.startswith("GridSquare_"):
+            return GRID_SQUARES
+        elif isinstance(value, dict) and (
+            "movieFullPath" in value or "file_path" in value
+        ):
+            return MOVIES
+        return OTHERS
+
+    @staticmethod
+    def getColumns(table, key, value):
+        # Indexed columns of an entry, besides key, seq and data
+        if table == MOVIES:
+            archived = value.get("archived")
+            return collections.OrderedDict(
+                [
+                    (
+                        "movieFullPath",
+                        value.get("movieFullPath", value.get("file_path")),
+                    ),
+                    ("gridSquare", value.get("gridSquare")),
+                    ("movieId", value.get("movieId")),
+                    ("motionCorrectionId", value.get("motionCorrectionId")),
+                    ("CTFid", value.get("CTFid")),
+                    ("archived", None if archived is None else int(bool(archived))),
+                ]
+            )
+        elif table == GRID_SQUARES:
+            lastMovieTime = (
+                value.get("lastMovieTime") if isinstance(value, dict) else None
+            )
+            return collections.OrderedDict([("lastMovieTime", lastMovieTime)])
+        elif table == DATASETS:
+            return collections.OrderedDict([("gridSquare", key.split(" ", 1)[0])])
+        return collections.OrderedDict()
+
+    @staticmethod
+    def connect(databasePath):
+        connection = sqlite3.connect(databasePath, check_same_thread=False)
+        connection.executescript(SCHEMA)
+        connection.execute("PRAGMA synchronous = NORMAL")
+        return connection
+
+    @staticmethod
+    def writeEntries(connection, listEntry, listDeleted=()):
+        """
+        Inserts or replaces the (key, seq, valueJson) entries and removes
+        the deleted keys, in one transaction.
+        """
+        with connection:
+            for key in listDeleted:
+                for table in LIST_TABLE:
+                    connection.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+            for key, seq, valueJson in listEntry:
+                value = json.loads(valueJson)
+                table = UtilsStateDb.getTable(key, value)
+                dictColumn = UtilsStateDb.getColumns(table, key, value)
+                for otherTable in LIST_TABLE:
+                    # An entry can change of kind, e.g. when it gets a path
+                    if otherTable != table:
+                        connection.execute(
+                            f"DELETE FROM {otherTable} WHERE key = ?", (key,)
+                        )
+                listName = ["key", "seq"] + list(dictColumn) + ["data"]
+                connection.execute(
+                    "INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})".format(
+                        table, ", ".join(listName), ", ".join("?" * len(listName))
+                    ),
+                    [key, seq] + list(dictColumn.values()) + [valueJson],
+                )
+
+    @staticmethod
+    def readEntries(connection):
+        listRow = []
+        for table in LIST_TABLE:
+            listRow += connection.execute(
+                f"SELECT seq, key, data FROM {table}"
+            ).fetchall()
+        dictParams = collections.OrderedDict()
+        for _, key, data in sorted(listRow):
+            dictParams[key] = json.loads(data)
+        return dictParams
+
+    @staticmethod
+    def importJson(jsonFilePath, databasePath=None):
+        """
+        Creates the database of allParams.json (and its journal) of a
+        session started without it.
+        """
+        if databasePath is None:
+            databasePath = UtilsStateDb.getDatabasePath(jsonFilePath)
+        dictParams = UtilsJournal.read(jsonFilePath)
+        tmpFilePath = "{0}.{1}.tmp".format(databasePath, os.getpid())
+        connection = UtilsStateDb.connect(tmpFilePath)
+        try:
+            UtilsStateDb.writeEntries(
+                connection,
+                [
+                    (TrackedParams.getKeyString(key), seq, json.dumps(value))
+                    for seq, (key, value) in enumerate(dictParams.items())
+                ],
+            )
+        finally:
+            connection.close()
+        os.replace(tmpFilePath, databasePath)
+        return databasePath
+
+    @staticmethod
+    def read(jsonFilePath):
+        connection = UtilsStateDb.connect(UtilsStateDb.getDatabasePath(jsonFilePath))
+        try:
+            return UtilsStateDb.readEntries(connection)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def load(jsonFilePath):
+        """
+        Returns a ParamsDatabase for the allParams of jsonFilePath, the
+        database is created from allParams.json if needed.
+        """
+        databasePath = UtilsStateDb.getDatabasePath(jsonFilePath)
+        if not os.path.exists(databasePath) and UtilsJournal.exists(jsonFilePath):
+            UtilsStateDb.importJson(jsonFilePath, databasePath)
+        params = ParamsDatabase(databasePath)
+        params.updateClean(UtilsStateDb.readEntries(params.connection))
+        return params
+
+    @staticmethod
+    def create(jsonFilePath):
+        """
+        Returns an empty ParamsDatabase, the existing database is kept
+        with a '.corrupted.<time_ns>' suffix.
+        """
+        databasePath = UtilsStateDb.getDatabasePath(jsonFilePath)
+        if os.path.exists(databasePath):
+            os.replace(
+                databasePath, "{0}.corrupted.{1}".format(databasePath, time.time_ns())
+            )
+        return ParamsDatabase(databasePath)
+
+
+class ParamsDatabase(TrackedParams):
+    """
+    TrackedParams saved in the SQLite database of UtilsStateDb: entries
+    are held in memory as with allParams.json and the changed ones are
+    written at each flush. The query methods flush first and use the
+    indexes instead of scanning all entries.
+    """
+
+    def __init__(self, databasePath):
+        super().__init__()
+        self.databasePath = os.fspath(databasePath)
+        self.connection = UtilsStateDb.connect(self.databasePath)
+        self.dictSeq = {}
+        self.nextSeq = 0
+        for table in LIST_TABLE:
+            for key, seq in self.connection.execute(f"SELECT key, seq FROM {table}"):
+                self.dictSeq[key] = seq
+                self.nextSeq = max(self.nextSeq, seq + 1)
+
+    def writeChanges(self, dictChanged, listDeleted):
+        listEntry = []
+        for key, valueJson in dictChanged.items():
+            if key not in self.dictSeq:
+                self.dictSeq[key] = self.nextSeq
+                self.nextSeq += 1
+            listEntry.append((key, self.dictSeq[key], valueJson))
+        for key in listDeleted:
+            self.dictSeq.pop(key, None)
+        UtilsStateDb.writeEntries(self.connection, listEntry, listDeleted)
+
+    def query(self, sql, parameters=()):
+        self.flush()
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def findMovie(self, movieFullPath):
+        """
+        Returns the key of the movie entry of movieFullPath, None if there
+        is none.
+        """
+        listRow = self.query(
+            "SELECT key FROM movies WHERE movieFullPath = ?",
+            (os.fspath(movieFullPath),),
+        )
+        return listRow[0][0] if listRow else None
+
+    def listMovie(self, gridSquare=None, archived=None, missingStage=None):
+        """
+        Returns the keys of the movie entries in insertion order, selected
+        by grid square, archived flag and/or a stage id not set yet.
+        """
+        listCondition = []
+        parameters = []
+        if gridSquare is not None:
+            listCondition.append("gridSquare = ?")
+            parameters.append(gridSquare)
+        if archived is not None:
+            listCondition.append("archived = ?")
+            parameters.append(int(bool(archived)))
+        if missingStage is not None:
+            if missingStage not in MOVIE_STAGES:
+                raise RuntimeError(f"Unknown movie stage {missingStage}")
+            listCondition.append(f"{missingStage} IS NULL")
+        sql = "SELECT key FROM movies"
+        if listCondition:
+            sql += " WHERE " + " AND ".join(listCondition)
+        return [key for key, in self.query(sql + " ORDER BY seq", parameters)]
+
+    def listGridSquareNotArchived(self):
+        """
+        Returns the grid squares with movies not archived yet.
+        """
+        listRow = self.query(
+            "SELECT gridSquare FROM movies WHERE archived = 0 AND "
+            "gridSquare IS NOT NULL GROUP BY gridSquare ORDER BY MIN(seq)"
+        )
+        return [gridSquare for gridSquare, in listRow]
+
+    def listDataset(self, gridSquare=None):
+        if gridSquare is None:
+            listRow = self.query("SELECT key FROM datasets ORDER BY seq")
+        else:
+            listRow = self.query(
+                "SELECT key FROM datasets WHERE gridSquare = ? ORDER BY seq",
+                (gridSquare,),
+            )
+        return [key for key, in listRow]
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.connection.close()
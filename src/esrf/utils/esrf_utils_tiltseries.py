@@ -0,0 +1,240 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import time
+import threading
+
+import numpy
+
+# Processing stages of a tilt, bits of the per-tilt status
+STAGE_MOVIE = 1
+STAGE_MOTION_CORRECTION = 2
+STAGE_CTF = 4
+ALL_STAGES = STAGE_MOVIE | STAGE_MOTION_CORRECTION | STAGE_CTF
+LIST_STAGE = [STAGE_MOVIE, STAGE_MOTION_CORRECTION, STAGE_CTF]
+
+# Flags of the tomo monitor state (all_params) giving the stage of a tilt
+DICT_STAGE_FLAG = {
+    STAGE_MOVIE: "raw_movie_archived",
+    STAGE_MOTION_CORRECTION: "mc_archived",
+    STAGE_CTF: "ctf_archived",
+}
+
+# Initial number of tilts allocated per series, doubled when full
+TILT_SERIES_CAPACITY = 64
+
+# Seconds without a new tilt after which a series whose number of tilts
+# isn't known is considered acquired
+TILT_SERIES_QUIESCENCE = 600
+
+
+class TiltSeries(object):
+    """
+    Tilts of one series in compact arrays (tilt angle, movie number and
+    stage status bits, in order of arrival) with per-stage counters.
+    """
+
+    def __init__(self, tsName):
+        self.tsName = tsName
+        self.noTilts = 0
+        self.tiltAngle = numpy.zeros(TILT_SERIES_CAPACITY, dtype=numpy.float32)
+        self.movieNumber = numpy.zeros(TILT_SERIES_CAPACITY, dtype=numpy.int32)
+        self.status = numpy.zeros(TILT_SERIES_CAPACITY, dtype=numpy.uint8)
+        self.listMovieName = []
+        self.dictRow = {}
+        self.dictStageCount = {stage: 0 for stage in LIST_STAGE}
+        self.firstRow = None
+        self.expectedTilts = None
+        self.searchPath = None
+        self.directory = None
+        self.lastTiltTime = None
+
+    def add(self, movieName, movieNumber, tiltAngle):
+        if self.noTilts == len(self.status):
+            newSize = 2 * len(self.status)
+            self.tiltAngle = numpy.resize(self.tiltAngle, newSize)
+            self.movieNumber = numpy.resize(self.movieNumber, newSize)
+            self.status = numpy.resize(self.status, newSize)
+            self.status[self.noTilts :] = 0
+        row = self.noTilts
+        self.tiltAngle[row] = tiltAngle
+        self.movieNumber[row] = movieNumber
+        self.listMovieName.append(movieName)
+        self.dictRow[movieName] = row
+        if self.firstRow is None or movieNumber < self.movieNumber[self.firstRow]:
+            self.firstRow = row
+        self.noTilts += 1
+        self.lastTiltTime = time.monotonic()
+
+    def setStage(self, movieName, stage):
+        row = self.dictRow[movieName]
+        if not self.status[row] & stage:
+            self.status[row] |= stage
+            self.dictStageCount[stage] += 1
+
+    def isComplete(self, quiescence=None):
+        """
+        True if all known tilts went through all stages and, if the number
+        of tilts of the series is known, all tilts arrived. Otherwise, with
+        'quiescence', no tilt must have arrived for that many seconds.
+        """
+        if self.noTilts == 0:
+            return False
+        if self.expectedTilts is not None:
+            if self.noTilts < self.expectedTilts:
+                return False
+        elif (
+            quiescence is not None and time.monotonic() - self.lastTiltTime < quiescence
+        ):
+            return False
+        return all(count == self.noTilts for count in self.dictStageCount.values())
+
+
+class TiltSeriesIndex(object):
+    """
+    In-memory index of the tilt series of a tomo session, updated as
+    files arrive and as stages complete. Tilts are identified by their
+    movie name. 'isComplete', 'hasStage' and 'getFirstTilt' are O(1).
+    Updates are protected by a lock as stages are set from archiving
+    threads.
+    """
+
+    def __init__(self):
+        self.dictSeries = {}
+        self.dictMovie = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, movieName):
+        return movieName in self.dictMovie
+
+    def __len__(self):
+        return len(self.dictMovie)
+
+    def addTilt(self, movieName, tsName, movieNumber, tiltAngle):
+        """
+        Returns True if the tilt is new.
+        """
+        with self.lock:
+            if movieName in self.dictMovie:
+                return False
+            tiltSeries = self.dictSeries.get(tsName)
+            if tiltSeries is None:
+                tiltSeries = TiltSeries(tsName)
+                self.dictSeries[tsName] = tiltSeries
+            tiltSeries.add(movieName, movieNumber, tiltAngle)
+            self.dictMovie[movieName] = tiltSeries
+            return True
+
+    def setStage(self, movieName, stage):
+        with self.lock:
+            self.dictMovie[movieName].setStage(movieName, stage)
+
+    def hasStage(self, movieName, stage):
+        tiltSeries = self.dictMovie.get(movieName)
+        if tiltSeries is None:
+            return False
+        return bool(tiltSeries.status[tiltSeries.dictRow[movieName]] & stage)
+
+    def getSeries(self, tsName):
+        return self.dictSeries.get(tsName)
+
+    def getSeriesName(self, movieName):
+        tiltSeries = self.dictMovie.get(movieName)
+        return tiltSeries.tsName if tiltSeries is not None else None
+
+    def listSeriesName(self):
+        return list(self.dictSeries)
+
+    def setExpectedTilts(self, tsName, expectedTilts):
+        with self.lock:
+            if tsName not in self.dictSeries:
+                self.dictSeries[tsName] = TiltSeries(tsName)
+            self.dictSeries[tsName].expectedTilts = expectedTilts
+
+    def isComplete(self, tsName, quiescence=None):
+        tiltSeries = self.dictSeries.get(tsName)
+        return tiltSeries is not None and tiltSeries.isComplete(quiescence)
+
+    def getFirstTilt(self, tsName):
+        """
+        Movie name of the tilt with the lowest movie number.
+        """
+        tiltSeries = self.dictSeries.get(tsName)
+        if tiltSeries is None or tiltSeries.firstRow is None:
+            return None
+        return tiltSeries.listMovieName[tiltSeries.firstRow]
+
+    def getMissing(self, tsName, stage):
+        """
+        Movie names of the tilts which haven't been through stage, in movie
+        number order.
+        """
+        tiltSeries = self.dictSeries.get(tsName)
+        if tiltSeries is None:
+            return []
+        noTilts = tiltSeries.noTilts
+        listRow = numpy.flatnonzero((tiltSeries.status[:noTilts] & stage) == 0)
+        listRow = listRow[numpy.argsort(tiltSeries.movieNumber[listRow], kind="stable")]
+        return [tiltSeries.listMovieName[row] for row in listRow]
+
+    def getTiltAngles(self, tsName):
+        """
+        Returns the tilt angles and movie names of a series sorted by angle.
+        """
+        tiltSeries = self.dictSeries.get(tsName)
+        if tiltSeries is None:
+            return numpy.zeros(0, dtype=numpy.float32), []
+        arrayTiltAngle = tiltSeries.tiltAngle[: tiltSeries.noTilts]
+        listRow = numpy.argsort(arrayTiltAngle, kind="stable")
+        return arrayTiltAngle[listRow], [
+            tiltSeries.listMovieName[row] for row in listRow
+        ]
+
+    @classmethod
+    def fromAllParams(cls, allParams):
+        """
+        Index of the tilts recorded in the state of the tomo monitor.
+        """
+        tiltSeriesIndex = cls()
+        for movieName, dictMovie in allParams.items():
+            if not isinstance(dictMovie, dict) or "ts_name" not in dictMovie:
+                continue
+            tiltSeriesIndex.addTilt(
+                movieName,
+                dictMovie["ts_name"],
+                dictMovie["movie_number"],
+                dictMovie["tilt_angle"],
+            )
+            for stage, flag in DICT_STAGE_FLAG.items():
+                if dictMovie.get(flag):
+                    tiltSeriesIndex.setStage(movieName, stage)
+            tiltSeries = tiltSeriesIndex.getSeries(dictMovie["ts_name"])
+            if "search_path" in dictMovie:
+                tiltSeries.searchPath = dictMovie["search_path"]
+            if tiltSeries.directory is None:
+                tiltSeries.directory = dictMovie.get("directory")
+        return tiltSeriesIndex
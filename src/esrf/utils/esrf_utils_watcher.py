@@ -0,0 +1,224 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import collections
+
+# Interval in seconds between two checks of all pending entries. Events
+# of files written on another host of a network file system (GPFS, NFS)
+# are not reported by inotify, so pending entries are checked at this
+# interval even if inotify is available.
+POLL_INTERVAL = 2.0
+
+# inotify event masks, see inotify(7)
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+_EVENT_HEADER = struct.Struct("iIII")
+
+_PendingEntry = collections.namedtuple(
+    "_PendingEntry", ["listDirectory", "isReady", "deadline"]
+)
+
+
+class _Inotify(object):
+    """
+    Minimal ctypes binding of the Linux inotify API: one watch per
+    directory, events are only used to know which directories changed.
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errorNumber = ctypes.get_errno()
+            raise OSError(errorNumber, os.strerror(errorNumber))
+        self.dictDirectory = {}
+        self.dictWatch = {}
+
+    def addWatch(self, directory):
+        if directory in self.dictWatch:
+            return True
+        watch = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(directory), _IN_WATCH_MASK
+        )
+        if watch < 0:
+            # Typically the directory doesn't exist yet
+            return False
+        self.dictWatch[directory] = watch
+        self.dictDirectory[watch] = directory
+        return True
+
+    def removeWatch(self, directory):
+        watch = self.dictWatch.pop(directory, None)
+        if watch is not None:
+            del self.dictDirectory[watch]
+            self.libc.inotify_rm_watch(self.fd, watch)
+
+    def readChangedDirectories(self):
+        """
+        Returns the set of watched directories with events since the last
+        call, None if events were lost.
+        """
+        setDirectory = set()
+        while True:
+            try:
+                buffer = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buffer):
+                watch, mask, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+                offset += _EVENT_HEADER.size + length
+                if mask & _IN_Q_OVERFLOW:
+                    return None
+                if watch in self.dictDirectory:
+                    setDirectory.add(self.dictDirectory[watch])
+        return setDirectory
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class FileArrivalWatcher(object):
+    """
+    Keeps track of entries (e.g. movies) waiting for files to appear in
+    one or more directories, without blocking the caller.
+
+    Each entry has a readiness check, a callable returning True when all
+    the files it needs are present, and a timeout. 'poll' re-evaluates the
+    check of an entry when inotify reports a change in one of its
+    directories or, for network file systems, every 'pollInterval'
+    seconds. It returns the entries which became ready and the ones whose
+    timeout expired; both are removed from the pending set.
+    """
+
+    def __init__(self, pollInterval=POLL_INTERVAL, useInotify=True):
+        self.pollInterval = pollInterval
+        self.dictPending = collections.OrderedDict()
+        self.lastPollTime = None
+        self.inotify = None
+        if useInotify and sys.platform.startswith("linux"):
+            try:
+                self.inotify = _Inotify()
+            except (OSError, AttributeError):
+                self.inotify = None
+
+    def __contains__(self, key):
+        return key in self.dictPending
+
+    def __len__(self):
+        return len(self.dictPending)
+
+    def add(self, key, listDirectory, isReady, timeout):
+        listDirectory = [os.fspath(directory) for directory in listDirectory]
+        self.dictPending[key] = _PendingEntry(
+            listDirectory, isReady, time.time() + timeout
+        )
+        if self.inotify is not None:
+            for directory in listDirectory:
+                self.inotify.addWatch(directory)
+
+    def remove(self, key):
+        entry = self.dictPending.pop(key, None)
+        if entry is not None and self.inotify is not None:
+            setWatched = set()
+            for otherEntry in self.dictPending.values():
+                setWatched.update(otherEntry.listDirectory)
+            for directory in entry.listDirectory:
+                if directory not in setWatched:
+                    self.inotify.removeWatch(directory)
+
+    def poll(self):
+        timeNow = time.time()
+        setChanged = set()
+        if self.inotify is not None:
+            setChanged = self.inotify.readChangedDirectories()
+        if (
+            self.lastPollTime is None
+            or timeNow - self.lastPollTime >= self.pollInterval
+        ):
+            self.lastPollTime = timeNow
+            setChanged = None
+        if self.inotify is not None:
+            # Directories created after the entry was added
+            for entry in self.dictPending.values():
+                for directory in entry.listDirectory:
+                    self.inotify.addWatch(directory)
+        listReady = []
+        listTimedOut = []
+        for key, entry in self.dictPending.items():
+            if (
+                setChanged is None
+                or not setChanged.isdisjoint(entry.listDirectory)
+                or timeNow >= entry.deadline
+            ):
+                if entry.isReady():
+                    listReady.append(key)
+                    continue
+            if timeNow >= entry.deadline:
+                listTimedOut.append(key)
+        for key in listReady + listTimedOut:
+            self.remove(key)
+        return listReady, listTimedOut
+
+    def wait(self, timeout):
+        """
+        Blocks until an entry is ready, has timed out, or until 'timeout'
+        seconds have passed, and returns the result of 'poll'.
+        """
+        endTime = time.time() + timeout
+        while True:
+            listReady, listTimedOut = self.poll()
+            timeNow = time.time()
+            if len(listReady) > 0 or len(listTimedOut) > 0 or timeNow >= endTime:
+                return listReady, listTimedOut
+            sleepTime = min(self.pollInterval, endTime - timeNow)
+            for entry in self.dictPending.values():
+                sleepTime = min(sleepTime, max(entry.deadline - timeNow, 0.0))
+            if self.inotify is not None:
+                try:
+                    select.select([self.inotify.fd], [], [], sleepTime)
+                except InterruptedError:
+                    pass
+            else:
+                time.sleep(sleepTime)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
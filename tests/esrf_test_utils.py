@@ -0,0 +1,50 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import numpy
+
+
+def writeMrc(mrcFilePath, data, mode=2, nsymbt=0, byteOrder="<"):
+    # Minimal MRC file: header, extended header of nsymbt bytes and data
+    data = numpy.asarray(data)
+    if data.ndim == 2:
+        data = data[numpy.newaxis]
+    header = numpy.zeros(256, dtype=byteOrder + "i4")
+    header[0:3] = data.shape[2], data.shape[1], data.shape[0]
+    header[3] = mode
+    header[23] = nsymbt
+    headerBytes = bytearray(header.tobytes())
+    headerBytes[208:212] = b"MAP "
+    headerBytes[212:214] = b"\x44\x44" if byteOrder == "<" else b"\x11\x11"
+    dtype = numpy.dtype(
+        {0: numpy.int8, 1: numpy.int16, 2: numpy.float32, 6: numpy.uint16}[mode]
+    ).newbyteorder(byteOrder)
+    with open(mrcFilePath, "wb") as fd:
+        fd.write(bytes(headerBytes))
+        fd.write(b"\0" * nsymbt)
+        fd.write(data.astype(dtype).tobytes())
@@ -0,0 +1,129 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import pathlib
+import tempfile
+import unittest
+
+from esrf.utils import esrf_utils_ctf
+from esrf.utils.esrf_utils_ctf import UtilsCtf
+from esrf.utils.esrf_utils_path import UtilsPath
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), "testdata")
+MRC_FILE_BASE = "GridSquare_7828225_Data_FoilHole_8853794_Data_7832898_7832899_20190711_0913-4443_aligned_mic"
+GCTF_LOG_PATH = os.path.join(TEST_DATA_DIR, MRC_FILE_BASE + "_ctf.log")
+TS_MOVIE_NAME = "grid1_Position_13_001_17.00_20230302_005937_fractions"
+CTFFIND_PATH = os.path.join(TEST_DATA_DIR, TS_MOVIE_NAME + "_ctffind4.txt")
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.workingDir = tempfile.mkdtemp(prefix="ProtGctf_")
+        os.makedirs(os.path.join(self.workingDir, "extra"))
+        os.makedirs(os.path.join(self.workingDir, "logs"))
+        open(os.path.join(self.workingDir, "logs", "run.stdout"), "w").close()
+        UtilsCtf.clearCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.workingDir)
+
+    def test_parseLog_gctf(self):
+        ctfResult = UtilsCtf.parseLog(GCTF_LOG_PATH)
+        self.assertEqual(ctfResult.program, esrf_utils_ctf.GCTF)
+        self.assertEqual(ctfResult.defocusU, 23173.92)
+        self.assertEqual(ctfResult.defocusV, 22988.54)
+        self.assertEqual(ctfResult.angle, 35.6)
+        self.assertEqual(ctfResult.ccc, -0.07629)
+        self.assertIsNone(ctfResult.phaseShift)
+        self.assertEqual(ctfResult.resolutionLimit, 3.381)
+        self.assertEqual(ctfResult.estimatedBfactor, 82.54)
+        # Only the end of the file is needed
+        self.assertGreater(os.path.getsize(GCTF_LOG_PATH), 2 * esrf_utils_ctf.TAIL_SIZE)
+        self.assertIs(ctfResult, UtilsCtf.parseLog(GCTF_LOG_PATH))
+
+    def test_parseLog_ctffind(self):
+        ctfResult = UtilsCtf.parseLog(CTFFIND_PATH)
+        self.assertEqual(ctfResult.program, esrf_utils_ctf.CTFFIND)
+        self.assertAlmostEqual(ctfResult.defocusU, 13964.01, places=2)
+        self.assertAlmostEqual(ctfResult.defocusV, 16052.90, places=2)
+        self.assertAlmostEqual(ctfResult.angle, 48.83, places=2)
+        self.assertEqual(ctfResult.ccc, 0.001816)
+        self.assertEqual(ctfResult.resolutionLimit, 16.413)
+        self.assertIsNone(ctfResult.estimatedBfactor)
+
+    def test_parseLog_notFinished(self):
+        logFilePath = os.path.join(self.workingDir, "extra", "running_ctf.log")
+        with open(GCTF_LOG_PATH) as fdIn, open(logFilePath, "w") as fdOut:
+            fdOut.write(fdIn.read().split("Final Values")[0].rsplit("\n", 2)[0])
+        self.assertIsNone(UtilsCtf.parseLog(logFilePath))
+        # The cache is invalidated when Gctf writes the final block
+        shutil.copy(GCTF_LOG_PATH, logFilePath)
+        self.assertEqual(UtilsCtf.parseLog(logFilePath).defocusU, 23173.92)
+
+    def test_getCtfMetaData(self):
+        shutil.copy(
+            GCTF_LOG_PATH,
+            os.path.join(self.workingDir, "extra", MRC_FILE_BASE + "_ctf.log"),
+        )
+        mrcFilePath = os.path.join("/tmp", "extra", MRC_FILE_BASE + ".mrc")
+        dictResult = UtilsPath.getCtfMetaData(self.workingDir, mrcFilePath)
+        dictRef = {
+            "Angle": "35.60",
+            "CCC": "-0.076290",
+            "Defocus_U": "23173.92",
+            "Defocus_V": "22988.54",
+            "Phase_shift": None,
+            "estimatedBfactor": "82.54",
+            "logFilePath": os.path.join(self.workingDir, "logs", "run.stdout"),
+            "resolutionLimit": "3.381",
+            "spectraImageFullPath": os.path.join(
+                self.workingDir, "extra", MRC_FILE_BASE + "_ctf.mrc"
+            ),
+            "spectraImageSnapshotFullPath": None,
+        }
+        self.assertEqual(dictRef, dictResult)
+
+    def test_getTSCtfMetaData(self):
+        shutil.copy(
+            CTFFIND_PATH,
+            os.path.join(
+                self.workingDir, "extra", TS_MOVIE_NAME + "_aligned_mic_DW_ctf.log"
+            ),
+        )
+        dictResult = UtilsPath.getTSCtfMetaData(
+            pathlib.Path(self.workingDir), TS_MOVIE_NAME
+        )
+        self.assertEqual(dictResult["Defocus_U"], "13964.007812")
+        self.assertEqual(dictResult["resolutionLimit"], "16.413000")
+        self.assertIsNone(dictResult["estimatedBfactor"])
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
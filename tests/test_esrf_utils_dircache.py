@@ -0,0 +1,231 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from esrf.utils import esrf_utils_dircache
+from esrf.utils import esrf_utils_filename
+from esrf.utils.esrf_utils_dircache import UtilsDirCache
+from esrf.utils.esrf_utils_path import UtilsPath
+
+EPU_TIFF_MOTIONCORR_PREFIX = "Images-Disc1_GridSquare_29820840_Data_FoilHole_30945883_Data_29822705_29822707_20220630_{0:06d}_fractions_"
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.runDir = tempfile.mkdtemp(prefix="ProtMotionCorr_")
+        self.extraDir = os.path.join(self.runDir, "extra")
+        os.makedirs(self.extraDir)
+        UtilsDirCache.clearCache()
+
+    def tearDown(self):
+        UtilsDirCache.clearCache()
+        shutil.rmtree(self.runDir)
+
+    def createFiles(self, index, listExtra):
+        listPath = []
+        for extra in listExtra:
+            filePath = os.path.join(
+                self.extraDir, EPU_TIFF_MOTIONCORR_PREFIX.format(index) + extra
+            )
+            open(filePath, "w").close()
+            listPath.append(filePath)
+        return listPath
+
+    def test_getEpuTiffAlignMoviesPngLogFilePath(self):
+        for index in range(100):
+            self.createFiles(
+                index,
+                [
+                    "aligned_mic.mrc",
+                    "aligned_mic_DW.mrc",
+                    "global_shifts.png",
+                    "thumbnail.png",
+                ],
+            )
+        mrcFilePath, doseWeightMrc, globalShiftPng, thumbnailPng = self.createFiles(
+            100,
+            [
+                "aligned_mic.mrc",
+                "aligned_mic_DW.mrc",
+                "global_shifts.png",
+                "thumbnail.png",
+            ],
+        )
+        dictResult = UtilsPath.getEpuTiffAlignMoviesPngLogFilePath(mrcFilePath)
+        dictRef = {
+            "doseWeightMrc": doseWeightMrc,
+            "globalShiftPng": globalShiftPng,
+            "thumbnailPng": thumbnailPng,
+            "logFileFullPath": os.path.join(self.runDir, "logs", "run.stdout"),
+        }
+        self.assertEqual(dictRef, dictResult)
+
+    def test_incrementalRefresh(self):
+        (mrcFilePath,) = self.createFiles(1, ["aligned_mic.mrc"])
+        self.assertEqual(
+            UtilsDirCache.getMotionCorrArtifacts(
+                mrcFilePath, esrf_utils_filename.EPU_TIFF_MOTIONCORR
+            ),
+            {},
+        )
+        (globalShiftPng,) = self.createFiles(1, ["global_shifts.png"])
+        dictResult = UtilsPath.getEpuTiffAlignMoviesPngLogFilePath(mrcFilePath)
+        self.assertEqual(dictResult["globalShiftPng"], globalShiftPng)
+        self.assertNotIn("thumbnailPng", dictResult)
+        os.remove(globalShiftPng)
+        dictResult = UtilsPath.getEpuTiffAlignMoviesPngLogFilePath(mrcFilePath)
+        self.assertNotIn("globalShiftPng", dictResult)
+
+    def test_unchangedDirectoryIsNotScanned(self):
+        (mrcFilePath,) = self.createFiles(1, ["aligned_mic.mrc"])
+        index = esrf_utils_dircache.MotionCorrArtifactIndex(
+            self.extraDir, esrf_utils_filename.EPU_TIFF_MOTIONCORR
+        )
+        self.assertTrue(index.refresh())
+        # Pretend that the scan took place long after the last modification
+        index.scanTime += 2 * esrf_utils_dircache.MTIME_RESOLUTION
+        self.assertFalse(index.refresh())
+        self.createFiles(1, ["thumbnail.png"])
+        os.utime(self.extraDir, ns=(0, index.mtime + 1))
+        self.assertTrue(index.refresh())
+        self.assertIn(
+            "thumbnailPng",
+            index.getArtifacts(
+                "FoilHole_30945883_Data_29822705_29822707_20220630_000001_fractions"
+            ),
+        )
+
+    def test_getGridSquareSnapshot(self):
+        gridSquareDir = os.path.join(self.runDir, "GridSquare_29820840")
+        dataDir = os.path.join(gridSquareDir, "Data")
+        os.makedirs(dataDir)
+        movieFilePath = os.path.join(
+            dataDir,
+            "FoilHole_30945883_Data_29822705_29822707_20220630_091041_fractions.tiff",
+        )
+        open(movieFilePath, "w").close()
+        self.assertIsNone(UtilsPath.getEpuTiffMovieJpegMrcXml(movieFilePath)[3])
+        for name in [
+            "GridSquare_20220630_090512.jpg",
+            "GridSquare_20220630_085908.jpg",
+        ]:
+            open(os.path.join(gridSquareDir, name), "w").close()
+        snapshot = os.path.join(gridSquareDir, "GridSquare_20220630_090512.jpg")
+        self.assertEqual(UtilsDirCache.getGridSquareSnapshot(gridSquareDir), snapshot)
+        self.assertEqual(
+            UtilsPath.getEpuTiffMovieJpegMrcXml(movieFilePath)[3], snapshot
+        )
+        os.remove(snapshot)
+        self.assertEqual(
+            UtilsDirCache.getGridSquareSnapshot(gridSquareDir),
+            os.path.join(gridSquareDir, "GridSquare_20220630_085908.jpg"),
+        )
+
+    def test_getSidecarFiles(self):
+        dataDir = os.path.join(self.runDir, "GridSquare_29820840", "Data")
+        os.makedirs(dataDir)
+        filePrefix = "FoilHole_30945883_Data_29822705_29822707_20220630_091041"
+        movieFilePath = os.path.join(dataDir, filePrefix + "_fractions.tiff")
+        for suffix in ["_fractions.tiff", ".jpg", ".xml"]:
+            open(os.path.join(dataDir, filePrefix + suffix), "w").close()
+        index = esrf_utils_dircache.SidecarIndex(
+            dataDir, ttl=60.0, cacheBustInterval=60.0
+        )
+        dictSidecar = index.getSidecarFiles(filePrefix, [".jpg", ".mrc", ".xml"])
+        self.assertEqual(
+            dictSidecar[".jpg"], os.path.join(dataDir, filePrefix + ".jpg")
+        )
+        self.assertIsNone(dictSidecar[".mrc"])
+        # Within the TTL the name set isn't refreshed
+        open(os.path.join(dataDir, filePrefix + ".mrc"), "w").close()
+        self.assertIsNone(index.getSidecarFiles(filePrefix, [".mrc"])[".mrc"])
+        self.assertFalse(index.bustNfsCache())
+        index.ttl = 0.0
+        self.assertIsNotNone(index.getSidecarFiles(filePrefix, [".mrc"])[".mrc"])
+        # Through UtilsPath, mrc micrograph preferred over tiff
+        jpeg, microGraph, xml, _ = UtilsPath.getEpuTiffMovieJpegMrcXml(movieFilePath)
+        self.assertEqual(microGraph, os.path.join(dataDir, filePrefix + ".mrc"))
+        self.assertEqual(xml, os.path.join(dataDir, filePrefix + ".xml"))
+
+    def test_findSerialEMFilePaths(self):
+        topDirectory = os.path.join(self.runDir, "mx2214")
+        listFile = [
+            "grid5/data/140/data_mx2214_140_00002.tif",
+            "grid5/data/140/data_mx2214_140_00001.tif",
+            "grid5/data/140/defects_mx2214.txt",
+            "grid5/data/140/CountRef_mx2214.dm4",
+            "grid5/data/141/data_mx2214_141_00001.tif",
+            "grid6/data/data_mx2214_00001.tif",
+            "grid5-atlas/atlas.mrc",
+        ]
+        for fileName in listFile:
+            filePath = os.path.join(topDirectory, fileName)
+            os.makedirs(os.path.dirname(filePath), exist_ok=True)
+            open(filePath, "w").close()
+        # Directories last modified long ago
+        for dirName, _, _ in os.walk(topDirectory):
+            os.utime(dirName, (1e9, 1e9))
+        tifDir = os.path.join(topDirectory, "grid5", "data", "140")
+        tupleRef = (
+            tifDir,
+            "data_mx2214_140_00001.tif",
+            os.path.join(tifDir, "defects_mx2214.txt"),
+            os.path.join(tifDir, "CountRef_mx2214.dm4"),
+        )
+        indexFilePath = os.path.join(self.runDir, "serialem_index.json")
+        self.assertEqual(
+            UtilsPath.findSerialEMFilePaths(topDirectory, indexFilePath), tupleRef
+        )
+        # The walk stopped at the first tif directory
+        index = esrf_utils_dircache.SerialEMDiscoveryIndex(topDirectory, indexFilePath)
+        self.assertIn(tifDir, index.dictDirectory)
+        self.assertNotIn(os.path.join(topDirectory, "grid6"), index.dictDirectory)
+        # Nothing changed: the persisted index answers without listing anything
+        with unittest.mock.patch("os.scandir", side_effect=AssertionError):
+            self.assertEqual(
+                UtilsPath.findSerialEMFilePaths(topDirectory, indexFilePath), tupleRef
+            )
+        # A new tif earlier in path order is found
+        os.makedirs(os.path.join(topDirectory, "grid4"))
+        open(os.path.join(topDirectory, "grid4", "a_00001.tif"), "w").close()
+        self.assertEqual(
+            UtilsPath.findSerialEMFilePaths(topDirectory, indexFilePath),
+            (os.path.join(topDirectory, "grid4"), "a_00001.tif", None, None),
+        )
+        self.assertEqual(
+            UtilsPath.findSerialEMFilePaths(self.extraDir), (None, None, None, None)
+        )
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
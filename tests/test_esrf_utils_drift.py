@@ -0,0 +1,163 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import math
+import time
+import shutil
+import tempfile
+import unittest
+
+from esrf.utils import esrf_utils_drift
+from esrf.utils.esrf_utils_drift import UtilsDrift
+from esrf.utils.esrf_utils_path import UtilsPath
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), "testdata")
+MOVIE_NAME = "FoilHole_29901259_Data_28850949_28850951_20210630_051336_fractions"
+MICROGRAPH_PATH = os.path.join(TEST_DATA_DIR, MOVIE_NAME + "_aligned_mic.mrc")
+PATCH_LOG_PATH = os.path.join(TEST_DATA_DIR, MOVIE_NAME + "-Patch-Full.log")
+
+
+def legacyGetShiftTable(patchLogPath):
+    # Line by line parsing before the NumPy engine, kept for benchmarking
+    listX = []
+    listY = []
+    with open(patchLogPath) as fd:
+        listLines = fd.readlines()
+    for line in listLines[3:]:
+        listValues = line.split()
+        listX.append(float(listValues[1]))
+        listY.append(float(listValues[2]))
+    totalMotion = 0.0
+    for index in range(1, len(listX)):
+        totalMotion += math.sqrt(
+            (listX[index] - listX[index - 1]) ** 2
+            + (listY[index] - listY[index - 1]) ** 2
+        )
+    return len(listX), totalMotion
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.workingDir = tempfile.mkdtemp(prefix="UtilsDrift_")
+
+    def tearDown(self):
+        shutil.rmtree(self.workingDir)
+
+    def test_getPatchLogPath(self):
+        self.assertEqual(
+            str(UtilsDrift.getPatchLogPath(MICROGRAPH_PATH)), PATCH_LOG_PATH
+        )
+
+    def test_getDriftStatistics(self):
+        driftStatistics = UtilsDrift.getDriftStatistics(MICROGRAPH_PATH)
+        noPoints, totalMotion = legacyGetShiftTable(PATCH_LOG_PATH)
+        self.assertEqual(driftStatistics.noPoints, noPoints)
+        self.assertAlmostEqual(driftStatistics.totalMotion, totalMotion)
+        self.assertAlmostEqual(
+            driftStatistics.averageMotionPerFrame, totalMotion / (noPoints - 1)
+        )
+        # Second frame: step (-2.10, 1.70) from the first one
+        self.assertAlmostEqual(driftStatistics.maxMotionPerFrame, math.hypot(2.1, 1.7))
+        self.assertAlmostEqual(
+            driftStatistics.earlyMotion + driftStatistics.lateMotion, totalMotion
+        )
+        # Early drift: the three steps between the first EARLY_FRAMES frames
+        self.assertAlmostEqual(
+            driftStatistics.earlyMotion,
+            math.hypot(2.1, 1.7) + math.hypot(1.4, 1.1) + math.hypot(0.9, 0.6),
+        )
+
+    def test_computeStatistics_shortTables(self):
+        self.assertEqual(
+            UtilsDrift.computeStatistics([1.0], [2.0]),
+            esrf_utils_drift.DriftStatistics(1, 0.0, 0.0, 0.0, 0.0, 0.0),
+        )
+        driftStatistics = UtilsDrift.computeStatistics([0.0, 3.0], [0.0, 4.0])
+        self.assertEqual(driftStatistics.totalMotion, 5.0)
+        self.assertEqual(driftStatistics.earlyMotion, 5.0)
+        self.assertEqual(driftStatistics.lateMotion, 0.0)
+
+    def test_getShiftData(self):
+        dictShift = UtilsPath.getShiftData(MICROGRAPH_PATH)
+        driftStatistics = UtilsDrift.getDriftStatistics(MICROGRAPH_PATH)
+        self.assertEqual(dictShift["noPoints"], 40)
+        self.assertEqual(
+            dictShift["totalMotion"], round(driftStatistics.totalMotion, 1)
+        )
+        self.assertIn("maxMotionPerFrame", dictShift)
+        # No log file
+        self.assertEqual(
+            UtilsPath.getShiftData(os.path.join(self.workingDir, MOVIE_NAME + ".mrc")),
+            {},
+        )
+        # Movie that didn't move
+        with open(
+            os.path.join(self.workingDir, MOVIE_NAME + "-Patch-Full.log"), "w"
+        ) as fd:
+            fd.write("#\n#\n#\n")
+            for index in range(5):
+                fd.write("{0} 0.00 0.00\n".format(index + 1))
+        self.assertEqual(
+            UtilsPath.getShiftData(os.path.join(self.workingDir, MOVIE_NAME + ".mrc")),
+            {"noPoints": 5},
+        )
+
+    def test_getShiftDataMany(self):
+        listPath = []
+        for index in range(esrf_utils_drift.SHIFT_DATA_MIN_POOL + 4):
+            movieDir = os.path.join(self.workingDir, "movie_{0}".format(index))
+            os.makedirs(movieDir)
+            shutil.copy(PATCH_LOG_PATH, movieDir)
+            listPath.append(os.path.join(movieDir, MOVIE_NAME + "_aligned_mic.mrc"))
+        listPath.append(os.path.join(self.workingDir, MOVIE_NAME + ".mrc"))
+        listShift = UtilsDrift.getShiftDataMany(listPath, maxWorkers=2)
+        self.assertEqual(len(listShift), len(listPath))
+        self.assertEqual(listShift[0], UtilsPath.getShiftData(MICROGRAPH_PATH))
+        self.assertEqual(listShift[-1], {})
+
+    def test_benchmark_getDriftStatistics(self):
+        noIterations = 2000
+        startTime = time.time()
+        for index in range(noIterations):
+            legacyGetShiftTable(PATCH_LOG_PATH)
+        legacyTime = time.time() - startTime
+        xShift, yShift = UtilsDrift.loadShifts(PATCH_LOG_PATH)
+        startTime = time.time()
+        for index in range(noIterations):
+            UtilsDrift.computeStatistics(xShift, yShift)
+        statisticsTime = time.time() - startTime
+        print(
+            "{0} drift tables: legacy {1:.3f} s, statistics {2:.3f} s".format(
+                noIterations, legacyTime, statisticsTime
+            )
+        )
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
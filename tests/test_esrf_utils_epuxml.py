@@ -0,0 +1,181 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import re
+import time
+import shutil
+import tempfile
+import unittest
+import xml.etree.ElementTree
+
+from esrf.utils import esrf_utils_epuxml
+from esrf.utils.esrf_utils_epuxml import UtilsEpuXml
+from esrf.utils.esrf_utils_path import UtilsPath
+
+XML_FILE_PATH = os.path.join(
+    os.path.dirname(__file__),
+    "testdata",
+    "FoilHole_15445484_Data_15444206_15444207_20171115_1620.xml",
+)
+
+
+def legacyEtreeToDict(t):
+    # Implementation before the iterparse extractor, kept for benchmarking
+    # ('getchildren' replaced by 'list' for recent Python versions)
+    p = re.compile("^{(.*)}")
+    m = p.match(t.tag)
+    if m is not None:
+        t.tag = t.tag[m.span()[1] :]
+    listTmp = list(map(legacyEtreeToDict, list(t)))
+    if len(listTmp) > 0:
+        d = {t.tag: listTmp}
+    else:
+        d = {t.tag: t.text}
+    return d
+
+
+def legacyGetRecursively(search_dict, field):
+    fields_found = []
+    for key, value in search_dict.items():
+        if key == field:
+            fields_found.append(value)
+        elif isinstance(value, dict):
+            fields_found.extend(legacyGetRecursively(value, field))
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    fields_found.extend(legacyGetRecursively(item, field))
+    return fields_found
+
+
+def legacyGetXmlMetaData(xmlMetaDataFullPath):
+    root = xml.etree.ElementTree.parse(xmlMetaDataFullPath).getroot()
+    dictXML = legacyEtreeToDict(root)
+    dictResults = {
+        "numberOffractions": legacyGetRecursively(dictXML, "NumberOffractions")[0],
+        "magnification": legacyGetRecursively(dictXML, "NominalMagnification")[0],
+        "positionX": legacyGetRecursively(dictXML, "X")[0],
+        "positionY": legacyGetRecursively(dictXML, "Y")[0],
+        "accelerationVoltage": legacyGetRecursively(dictXML, "AccelerationVoltage")[0],
+        "acquisitionDateTime": legacyGetRecursively(dictXML, "acquisitionDateTime")[0],
+    }
+    listKeyValue = legacyGetRecursively(dictXML, "KeyValueOfstringanyType")
+    for dictKey, dictValue in listKeyValue:
+        if dictKey["Key"] == "Dose":
+            dictResults["dose"] = dictValue["Value"]
+        if dictKey["Key"] == "PhasePlateUsed":
+            dictResults["phasePlateUsed"] = dictValue["Value"]
+    listKeyValue = legacyGetRecursively(dictXML, "CameraSpecificInput")[0]
+    for dictKeyValueOfstringanyType in listKeyValue:
+        dictKey = dictKeyValueOfstringanyType["KeyValueOfstringanyType"][0]
+        dictValue = dictKeyValueOfstringanyType["KeyValueOfstringanyType"][1]
+        if dictKey["Key"] == "SuperResolutionFactor":
+            dictResults["superResolutionFactor"] = dictValue["Value"]
+    return dictResults
+
+
+class Test(unittest.TestCase):
+    def test_getXmlMetaData(self):
+        dictResult = UtilsPath.getXmlMetaData(XML_FILE_PATH)
+        dictRef = {
+            "accelerationVoltage": "300000",
+            "acquisitionDateTime": "2017-11-15T16:20:52.2530023+01:00",
+            "dose": "2.3276455783574426E+21",
+            "magnification": "130000",
+            "numberOffractions": "30",
+            "phasePlateUsed": "true",
+            "positionX": "0.00026971729600000011",
+            "positionY": "0.00014176793600000005",
+            "superResolutionFactor": "1",
+        }
+        self.assertEqual(dictRef, dictResult)
+        self.assertEqual(legacyGetXmlMetaData(XML_FILE_PATH), dictResult)
+
+    def test_parse_fieldSpec(self):
+        fields = (
+            esrf_utils_epuxml.XmlField("defocus", esrf_utils_epuxml.ELEMENT, "Defocus"),
+            esrf_utils_epuxml.XmlField(
+                "detector", esrf_utils_epuxml.KEY_VALUE, "DetectorCommercialName"
+            ),
+            esrf_utils_epuxml.XmlField(
+                "counting",
+                esrf_utils_epuxml.CAMERA_KEY_VALUE,
+                "ElectronCountingEnabled",
+            ),
+            esrf_utils_epuxml.XmlField(
+                "missing", esrf_utils_epuxml.ELEMENT, "NotInTheFile"
+            ),
+        )
+        dictResult = UtilsEpuXml.parse(XML_FILE_PATH, fields)
+        self.assertEqual(
+            dictResult,
+            {
+                "defocus": "-1.9998900000000001E-06",
+                "detector": "Falcon 3EC",
+                "counting": "true",
+            },
+        )
+
+    def test_parseMany(self):
+        tmpDir = tempfile.mkdtemp(prefix="EpuXml_")
+        try:
+            listXmlFilePath = []
+            for index in range(esrf_utils_epuxml.PARSE_MANY_MIN_POOL):
+                xmlFilePath = os.path.join(tmpDir, "movie_{0}.xml".format(index))
+                shutil.copy(XML_FILE_PATH, xmlFilePath)
+                listXmlFilePath.append(xmlFilePath)
+            listXmlFilePath.append(os.path.join(tmpDir, "missing.xml"))
+            listResult = UtilsPath.getXmlMetaDataMany(listXmlFilePath)
+        finally:
+            shutil.rmtree(tmpDir)
+        self.assertEqual(len(listResult), len(listXmlFilePath))
+        self.assertIsNone(listResult[-1])
+        for dictResult in listResult[:-1]:
+            self.assertEqual(dictResult["numberOffractions"], "30")
+
+    def test_benchmark_getXmlMetaData(self):
+        noIterations = 2000
+        startTime = time.time()
+        for _ in range(noIterations):
+            legacyGetXmlMetaData(XML_FILE_PATH)
+        legacyTime = time.time() - startTime
+        startTime = time.time()
+        for _ in range(noIterations):
+            UtilsEpuXml.parse(XML_FILE_PATH)
+        parseTime = time.time() - startTime
+        print(
+            "{0} EPU XML files: legacy {1:.3f} s, iterparse {2:.3f} s".format(
+                noIterations, legacyTime, parseTime
+            )
+        )
+        self.assertLess(parseTime, legacyTime)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,209 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import re
+import time
+import unittest
+
+import numpy
+
+from esrf.utils import esrf_utils_filename
+from esrf.utils.esrf_utils_filename import UtilsFileName
+from esrf.utils.esrf_utils_path import UtilsPath
+
+EPU_MOVIE_PATH = "/data/visitor/mx415/cm01/20180315/RAW_DATA/EPU_BSA_grid5_2mg_2_test8/Images-Disc1/GridSquare_15806527/Data/FoilHole_15814308_Data_15808956_15808957_20180317_1109-17665.mrc"
+EPU_TIFF_MOVIE_PATH = "/data/visitor/mx2263/cm01/20210628/RAW_DATA/mx2263_vDLPA_grid1_EPU/Images-Disc1/GridSquare_28833986/Data/FoilHole_29901259_Data_28850949_28850951_20210630_051336_fractions.tiff"
+TOMO_MOVIE_PATH = "/data/visitor/ihls3501/cm01/20230523/RAW_DATA/grid5-test-tomo-processing/test_1_001_0.00_20230525_155045_fractions.tiff"
+
+
+def legacyGetMovieFileNameParameters(mrcFilePath):
+    # Implementation before the grammar engine, kept for benchmarking
+    dictResult = {}
+    dictResult["directory"] = os.path.dirname(mrcFilePath)
+    p = re.compile(
+        "^(.*)/(GridSquare_[0-9]*)/"
+        + "Data/(.*)_([0-9]*)_Data_([0-9]*)_([0-9]*)_([0-9]*)_([0-9]*)"
+        + r"-([0-9]*)(_?.*)\.(.*)"
+    )
+    m = p.match(mrcFilePath)
+    dictResult["gridSquare"] = m.group(2)
+    dictResult["prefix"] = m.group(3)
+    dictResult["id1"] = m.group(4)
+    dictResult["id2"] = m.group(5)
+    dictResult["id3"] = m.group(6)
+    dictResult["date"] = m.group(7)
+    dictResult["hour"] = m.group(8)
+    dictResult["movieNumber"] = m.group(9)
+    dictResult["extra"] = m.group(10)
+    dictResult["suffix"] = m.group(11)
+    dictResult["movieName"] = (
+        "{prefix}_{id1}_Data_{id2}_{id3}_{date}_{hour}-{movieNumber}".format(
+            **dictResult
+        )
+    )
+    if not dictResult["hour"].isdigit() or not dictResult["movieNumber"].isdigit():
+        dictResult = None
+    return dictResult
+
+
+def legacyGetEpuTiffMovieFileNameParameters(mrcFilePath):
+    # Implementation before the grammar engine, kept for benchmarking
+    dictResult = {}
+    dictResult["directory"] = os.path.dirname(mrcFilePath)
+    p = re.compile(
+        "^(.*)/(GridSquare_[0-9]*)/"
+        + "Data/(.*)_([0-9]*)_Data_([0-9]*)_([0-9]*)_([0-9]*)_([0-9]*)"
+        + r"_fractions\.(.*)"
+    )
+    m = p.match(mrcFilePath)
+    dictResult["gridSquare"] = m.group(2)
+    dictResult["prefix"] = m.group(3)
+    dictResult["id1"] = m.group(4)
+    dictResult["id2"] = m.group(5)
+    dictResult["id3"] = m.group(6)
+    dictResult["date"] = m.group(7)
+    dictResult["hour"] = m.group(8)
+    dictResult["suffix"] = m.group(9)
+    dictResult["movieName"] = (
+        "{prefix}_{id1}_Data_{id2}_{id3}_{date}_{hour}_fractions".format(**dictResult)
+    )
+    dictResult["movieNumber"] = dictResult["date"][-2:] + dictResult["hour"]
+    return dictResult
+
+
+class Test(unittest.TestCase):
+    def test_parse_epu(self):
+        record = UtilsFileName.parse(EPU_MOVIE_PATH, esrf_utils_filename.EPU)
+        self.assertEqual(record.gridSquare, "GridSquare_15806527")
+        self.assertEqual(record.movieNumber, "17665")
+        self.assertEqual(
+            record.movieName,
+            "FoilHole_15814308_Data_15808956_15808957_20180317_1109-17665",
+        )
+        self.assertEqual(
+            legacyGetMovieFileNameParameters(EPU_MOVIE_PATH), record._asdict()
+        )
+        # Records are immutable and shared between calls
+        with self.assertRaises(AttributeError):
+            record.movieNumber = "1"
+        self.assertIs(
+            record, UtilsFileName.parse(EPU_MOVIE_PATH, esrf_utils_filename.EPU)
+        )
+
+    def test_parse_epuWithoutGridSquare(self):
+        record = UtilsFileName.parse(
+            "/tmp/FoilHole_19150795_Data_19148847_19148848_20170619_2101-0344.mrc",
+            esrf_utils_filename.EPU,
+        )
+        self.assertIsNone(record.gridSquare)
+        self.assertEqual(record.directory, "/tmp")
+        self.assertEqual(record.movieNumber, "0344")
+
+    def test_parse_epuTiff(self):
+        dictResult = UtilsPath.getEpuTiffMovieFileNameParameters(EPU_TIFF_MOVIE_PATH)
+        self.assertEqual(
+            legacyGetEpuTiffMovieFileNameParameters(EPU_TIFF_MOVIE_PATH), dictResult
+        )
+        self.assertEqual(dictResult["movieNumber"], "30051336")
+
+    def test_parse_tomo(self):
+        dict_movie = UtilsPath.getTSFileParameters(TOMO_MOVIE_PATH)
+        self.assertEqual(dict_movie["ts_name"], "test_1")
+        self.assertEqual(dict_movie["movie_number"], 1)
+        self.assertEqual(dict_movie["tilt_angle"], 0.0)
+        self.assertEqual(
+            dict_movie["movie_name"], "test_1_001_0.00_20230525_155045_fractions"
+        )
+        self.assertEqual(
+            dict_movie["icat_raw_dir"],
+            "/data/visitor/ihls3501/cm01/20230523/RAW_DATA/grid5-test-tomo-processing/test_1/001",
+        )
+        # Wrappers return a new dictionary for each call
+        dict_movie["search_path"] = "/tmp/search.jpg"
+        self.assertNotIn("search_path", UtilsPath.getTSFileParameters(TOMO_MOVIE_PATH))
+
+    def test_parse_notAMovie(self):
+        self.assertIsNone(
+            UtilsFileName.parse("/tmp/gain.mrc", esrf_utils_filename.EPU_TIFF)
+        )
+        self.assertEqual(
+            UtilsPath.getMovieFileNameParametersFromMotioncorrPath("/tmp/gain.mrc"),
+            {},
+        )
+        with self.assertRaises(RuntimeError):
+            UtilsFileName.parse(EPU_MOVIE_PATH, "UNKNOWN")
+
+    def test_parseMany(self):
+        listPath = [
+            EPU_TIFF_MOVIE_PATH,
+            "/tmp/gain.mrc",
+            EPU_TIFF_MOVIE_PATH.replace("GridSquare_28833986", "GridSquare_1"),
+        ]
+        dictColumns = UtilsPath.parseMany(listPath, esrf_utils_filename.EPU_TIFF)
+        self.assertEqual(dictColumns["valid"].tolist(), [True, False, True])
+        self.assertEqual(
+            dictColumns["gridSquare"].tolist(),
+            ["GridSquare_28833986", "", "GridSquare_1"],
+        )
+        self.assertEqual(dictColumns["path"][1], "/tmp/gain.mrc")
+        dictColumns = UtilsPath.parseMany(
+            [TOMO_MOVIE_PATH, "/tmp/gain.mrc"], esrf_utils_filename.TOMO
+        )
+        self.assertEqual(dictColumns["movie_number"].tolist(), [1, -1])
+        self.assertEqual(dictColumns["tilt_angle"][0], 0.0)
+        self.assertTrue(numpy.isnan(dictColumns["tilt_angle"][1]))
+
+    def test_benchmark_parse(self):
+        noIterations = 20000
+        listPath = [
+            EPU_MOVIE_PATH.replace("17665", "{0:05d}".format(index))
+            for index in range(200)
+        ]
+        startTime = time.time()
+        for index in range(noIterations):
+            legacyGetMovieFileNameParameters(listPath[index % len(listPath)])
+        legacyTime = time.time() - startTime
+        startTime = time.time()
+        for index in range(noIterations):
+            UtilsPath.getMovieFileNameParameters(listPath[index % len(listPath)])
+        wrapperTime = time.time() - startTime
+        startTime = time.time()
+        for index in range(noIterations):
+            UtilsPath.parse(listPath[index % len(listPath)], esrf_utils_filename.EPU)
+        parseTime = time.time() - startTime
+        print(
+            "{0} parses: legacy {1:.3f} s, wrapper {2:.3f} s, parse {3:.3f} s".format(
+                noIterations, legacyTime, wrapperTime, parseTime
+            )
+        )
+        self.assertLess(parseTime, legacyTime)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
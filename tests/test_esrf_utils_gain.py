@@ -0,0 +1,365 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import time
+import shutil
+import struct
+import tempfile
+import unittest
+import unittest.mock
+
+import numpy
+from PIL import Image
+
+from esrf.utils import esrf_utils_serialem
+from esrf.utils.esrf_utils_gain import GainCache, UtilsGain
+from esrf.utils.esrf_utils_header import UtilsHeader
+from esrf.utils.esrf_utils_serialem import UtilsSerialEM
+from esrf.utils.esrf_utils_snapshot import UtilsSnapshot
+
+from esrf_test_utils import writeMrc
+
+DEFECT_LIST = """CameraSizeX 8
+CameraSizeY 6
+K2Type 1
+BadColumns 1
+PartialBadCol 5 2 3
+BadRows 4
+BadPixels 7 0 6 1
+"""
+
+
+def dmTag(name, content, isGroup=False):
+    nameBytes = name.encode("latin-1")
+    return (
+        struct.pack(">BH", 20 if isGroup else 21, len(nameBytes))
+        + nameBytes
+        + struct.pack(">Q", len(content))
+        + content
+    )
+
+
+def dmGroup(listTag):
+    return struct.pack(">BBQ", 0, 1, len(listTag)) + b"".join(listTag)
+
+
+def dmData(listInfo, data):
+    return (
+        b"%%%%"
+        + struct.pack(">Q", len(listInfo))
+        + struct.pack(">{0}Q".format(len(listInfo)), *listInfo)
+        + data
+    )
+
+
+def dmImage(image, arrayType, dataType):
+    height, width = image.shape
+    return dmTag(
+        "",
+        dmGroup(
+            [
+                dmTag(
+                    "ImageData",
+                    dmGroup(
+                        [
+                            dmTag(
+                                "Data",
+                                dmData([20, arrayType, image.size], image.tobytes()),
+                            ),
+                            dmTag("DataType", dmData([3], struct.pack("<i", dataType))),
+                            dmTag(
+                                "Dimensions",
+                                dmGroup(
+                                    [
+                                        dmTag(
+                                            "", dmData([5], struct.pack("<I", width))
+                                        ),
+                                        dmTag(
+                                            "", dmData([5], struct.pack("<I", height))
+                                        ),
+                                    ]
+                                ),
+                                isGroup=True,
+                            ),
+                        ]
+                    ),
+                    isGroup=True,
+                )
+            ]
+        ),
+        isGroup=True,
+    )
+
+
+def writeDm4(dm4FilePath, image):
+    # Thumbnail followed by the float32 image, as saved by SerialEM
+    thumbnail = numpy.zeros((2, 2), dtype=numpy.uint8)
+    root = dmGroup(
+        [
+            dmTag(
+                "ApplicationBounds",
+                dmData([15, 0, 2, 0, 3, 0, 3], struct.pack("<2i", 0, 0)),
+            ),
+            dmTag(
+                "ImageList",
+                dmGroup(
+                    [
+                        dmImage(thumbnail, 10, 6),
+                        dmImage(image.astype("<f4"), 6, 2),
+                    ]
+                ),
+                isGroup=True,
+            ),
+            dmTag("Name", dmData([18, 4], "gain".encode("utf-16-le"))),
+        ]
+    )
+    with open(dm4FilePath, "wb") as fd:
+        fd.write(struct.pack(">IQI", 4, len(root), 1))
+        fd.write(root)
+        fd.write(b"\0" * 16)
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp(prefix="test_esrf_utils_gain_")
+        UtilsGain.setCache(GainCache(os.path.join(self.tempDir, "cache")))
+
+    def tearDown(self):
+        UtilsGain.setCache(None)
+        shutil.rmtree(self.tempDir)
+
+    def test_readDm4Tags(self):
+        dm4FilePath = os.path.join(self.tempDir, "CountRef.dm4")
+        writeDm4(dm4FilePath, numpy.ones((3, 5)))
+        root, byteOrder = UtilsGain.readDm4Tags(dm4FilePath)
+        self.assertEqual(byteOrder, "<")
+        self.assertEqual(root["Name"], "gain")
+        self.assertEqual(root["ApplicationBounds"], (0, 0))
+        self.assertEqual(len(root["ImageList"]), 2)
+        imageData = root["ImageList"][1]["ImageData"]
+        self.assertEqual(imageData["Dimensions"], [5, 3])
+        self.assertEqual(imageData["DataType"], 2)
+        self.assertEqual(imageData["Data"].count, 15)
+
+    def test_convertDm4ToMrc(self):
+        dm4FilePath = os.path.join(self.tempDir, "CountRef.dm4")
+        image = numpy.arange(12, dtype=numpy.float32).reshape(3, 4) / 4
+        writeDm4(dm4FilePath, image)
+        mrcFilePath = os.path.join(self.tempDir, "CountRef.mrc")
+        UtilsGain.convertDm4ToMrc(dm4FilePath, mrcFilePath)
+        movieHeader = UtilsHeader.probe(mrcFilePath)
+        self.assertEqual(
+            (movieHeader.frames, movieHeader.height, movieHeader.width), (1, 3, 4)
+        )
+        self.assertEqual(movieHeader.dtype, "<f4")
+        data = numpy.fromfile(mrcFilePath, dtype="<f4", offset=movieHeader.dataOffset)
+        numpy.testing.assert_array_equal(data.reshape(3, 4), image)
+        # min, max, mean
+        header = numpy.fromfile(mrcFilePath, dtype="<f4", count=22)
+        numpy.testing.assert_allclose(header[19:22], [0.0, 2.75, 1.375])
+
+    def test_convertDm4ToMrc_invalid(self):
+        dm4FilePath = os.path.join(self.tempDir, "CountRef.dm4")
+        with open(dm4FilePath, "wb") as fd:
+            fd.write(struct.pack(">IQI", 3, 0, 1))
+        with self.assertRaises(RuntimeError):
+            UtilsGain.convertDm4ToMrc(dm4FilePath, dm4FilePath + ".mrc")
+
+    def test_createDefectMap(self):
+        defectFilePath = os.path.join(self.tempDir, "defects.txt")
+        with open(defectFilePath, "w") as fd:
+            fd.write(DEFECT_LIST)
+        dictDefect = UtilsGain.readDefectList(defectFilePath)
+        self.assertEqual(dictDefect["BadPixels"], [7, 0, 6, 1])
+        defectMap = UtilsGain.createDefectMap(dictDefect, 8, 6)
+        expected = numpy.zeros((6, 8), dtype=numpy.uint8)
+        expected[:, 1] = 1
+        expected[2:4, 5] = 1
+        expected[4, :] = 1
+        expected[0, 7] = 1
+        expected[1, 6] = 1
+        numpy.testing.assert_array_equal(defectMap, expected)
+        # Super-resolution: each camera pixel is 2x2 image pixels
+        defectMap = UtilsGain.createDefectMap(dictDefect, 16, 12)
+        numpy.testing.assert_array_equal(
+            defectMap, numpy.kron(expected, numpy.ones((2, 2), dtype=numpy.uint8))
+        )
+        with self.assertRaises(RuntimeError):
+            UtilsGain.createDefectMap(dictDefect, 10, 6)
+        dictDefect["RotationFlip"] = [1]
+        with self.assertRaises(RuntimeError):
+            UtilsGain.createDefectMap(dictDefect, 8, 6)
+
+    def test_createGainFile(self):
+        dm4File = os.path.join(self.tempDir, "CountRef_mx2214_00005.dm4")
+        writeDm4(dm4File, numpy.full((6, 8), 1.5))
+        gainDir = os.path.join(self.tempDir, "gain1")
+        os.makedirs(gainDir)
+        gainPath = UtilsSerialEM.createGainFile(
+            dm4File, gainDir, backend=esrf_utils_serialem.NATIVE
+        )
+        self.assertEqual(gainPath, os.path.join(gainDir, "CountRef_mx2214_00005.mrc"))
+        self.assertEqual(UtilsHeader.probe(gainPath).width, 8)
+        # Next session with the same gain reference: no conversion
+        gainDir = os.path.join(self.tempDir, "gain2")
+        os.makedirs(gainDir)
+        with unittest.mock.patch.object(
+            UtilsGain, "convertDm4ToMrc", side_effect=AssertionError
+        ):
+            secondGainPath = UtilsSerialEM.createGainFile(
+                dm4File, gainDir, backend=esrf_utils_serialem.NATIVE
+            )
+        self.assertTrue(os.path.samefile(gainPath, secondGainPath))
+
+    def test_createGainFile_fallback(self):
+        dm4File = os.path.join(self.tempDir, "CountRef.dm4")
+        with open(dm4File, "wb") as fd:
+            fd.write(b"Not a DM4 file")
+
+        def run(args):
+            self.assertEqual(args[0], "dm2mrc")
+            writeMrc(args[2], numpy.zeros((1, 2, 2)))
+            return unittest.mock.Mock(stdout="")
+
+        with unittest.mock.patch.object(
+            esrf_utils_serialem.UtilsJobs, "run", side_effect=run
+        ):
+            gainPath = UtilsSerialEM.createGainFile(
+                dm4File, self.tempDir, backend=esrf_utils_serialem.NATIVE
+            )
+        self.assertEqual(UtilsHeader.probe(gainPath).width, 2)
+        # Default backend, the IMOD tools
+        self.assertEqual(esrf_utils_serialem.GAIN_BACKEND, esrf_utils_serialem.EXTERNAL)
+
+    def test_createDefectMapFile(self):
+        shiftFile = os.path.join(self.tempDir, "defects_bgal-215k-img-shift_0001.txt")
+        with open(shiftFile, "w") as fd:
+            fd.write(DEFECT_LIST)
+        tifFile = os.path.join(self.tempDir, "mx2214_00005.tif")
+        Image.fromarray(numpy.zeros((12, 16), dtype=numpy.uint8)).save(tifFile)
+        defectMapPath = UtilsSerialEM.createDefectMapFile(
+            shiftFile, tifFile, self.tempDir, backend=esrf_utils_serialem.NATIVE
+        )
+        movieHeader = UtilsHeader.probe(defectMapPath)
+        self.assertEqual((movieHeader.width, movieHeader.height), (16, 12))
+        defectMap = numpy.fromfile(
+            defectMapPath, dtype=numpy.uint8, offset=movieHeader.dataOffset
+        ).reshape(12, 16)
+        self.assertEqual(defectMap[:, 2:4].min(), 1)
+        self.assertEqual(defectMap[0, 0], 0)
+
+    def test_createDefectMapFile_fallback(self):
+        shiftFile = os.path.join(self.tempDir, "defects_bgal-215k-img-shift_0001.txt")
+        with open(shiftFile, "w") as fd:
+            fd.write(DEFECT_LIST)
+        # Movie not readable, 'clip defect' without cache
+        tifFile = os.path.join(self.tempDir, "mx2214_00005.tif")
+        with open(tifFile, "wb") as fd:
+            fd.write(b"Not a TIFF file")
+        listArgs = []
+
+        def run(args):
+            listArgs.append(args)
+            writeMrc(args[5], numpy.zeros((1, 2, 2)))
+            return unittest.mock.Mock(stdout="")
+
+        with unittest.mock.patch.object(
+            esrf_utils_serialem.UtilsJobs, "run", side_effect=run
+        ):
+            for backend in [esrf_utils_serialem.NATIVE, esrf_utils_serialem.EXTERNAL]:
+                defectMapPath = UtilsSerialEM.createDefectMapFile(
+                    shiftFile, tifFile, self.tempDir, backend=backend
+                )
+                self.assertEqual(listArgs[-1][0:2], ["clip", "defect"])
+                self.assertEqual(listArgs[-1][5], defectMapPath)
+        self.assertEqual(len(listArgs), 2)
+
+    @unittest.skipIf(
+        shutil.which("dm2mrc") is None or shutil.which("clip") is None,
+        "IMOD not installed",
+    )
+    def test_nativeParity(self):
+        # Same pixels, in the same orientation, as dm2mrc and 'clip defect'
+        dm4File = os.path.join(self.tempDir, "CountRef.dm4")
+        writeDm4(dm4File, numpy.arange(6 * 8, dtype=numpy.float32).reshape(6, 8))
+        dictImage = {}
+        for backend in [esrf_utils_serialem.NATIVE, esrf_utils_serialem.EXTERNAL]:
+            gainDir = os.path.join(self.tempDir, backend)
+            os.makedirs(gainDir)
+            gainPath = UtilsSerialEM.createGainFile(dm4File, gainDir, backend=backend)
+            dictImage[backend] = numpy.array(UtilsSnapshot.readMrc(gainPath))
+        numpy.testing.assert_allclose(
+            dictImage[esrf_utils_serialem.NATIVE],
+            dictImage[esrf_utils_serialem.EXTERNAL],
+        )
+        shiftFile = os.path.join(self.tempDir, "defects.txt")
+        with open(shiftFile, "w") as fd:
+            fd.write(DEFECT_LIST)
+        for tifShape in [(6, 8), (12, 16)]:
+            tifFile = os.path.join(self.tempDir, "movie_{0}.tif".format(tifShape[0]))
+            Image.fromarray(numpy.zeros(tifShape, dtype=numpy.uint8)).save(tifFile)
+            dictImage = {}
+            for backend in [esrf_utils_serialem.NATIVE, esrf_utils_serialem.EXTERNAL]:
+                defectMapPath = UtilsSerialEM.createDefectMapFile(
+                    shiftFile,
+                    tifFile,
+                    os.path.join(self.tempDir, backend),
+                    backend=backend,
+                )
+                dictImage[backend] = numpy.array(UtilsSnapshot.readMrc(defectMapPath))
+            numpy.testing.assert_array_equal(
+                dictImage[esrf_utils_serialem.NATIVE] != 0,
+                dictImage[esrf_utils_serialem.EXTERNAL] != 0,
+            )
+
+    def test_benchmark_createGainFile(self):
+        dm4File = os.path.join(self.tempDir, "CountRef.dm4")
+        writeDm4(dm4File, numpy.random.default_rng(0).random((4092, 5760)))
+        startTime = time.time()
+        UtilsSerialEM.createGainFile(
+            dm4File, self.tempDir, backend=esrf_utils_serialem.NATIVE
+        )
+        convertTime = time.time() - startTime
+        os.remove(os.path.join(self.tempDir, "CountRef.mrc"))
+        startTime = time.time()
+        UtilsSerialEM.createGainFile(
+            dm4File, self.tempDir, backend=esrf_utils_serialem.NATIVE
+        )
+        cachedTime = time.time() - startTime
+        print(
+            "Gain reference 5760x4092: converted {0:.3f} s, cached {1:.3f} s".format(
+                convertTime, cachedTime
+            )
+        )
+        self.assertLess(cachedTime, convertTime)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
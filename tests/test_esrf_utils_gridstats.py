@@ -0,0 +1,146 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import json
+import unittest
+
+import numpy
+
+from esrf.utils import esrf_utils_gridstats
+from esrf.utils.esrf_utils_gridstats import (
+    GridSquareStatistics,
+    QuantileSketch,
+    RunningStatistics,
+)
+
+
+class Test(unittest.TestCase):
+    def test_runningStatistics(self):
+        values = numpy.random.default_rng(0).normal(20000.0, 1500.0, 5000)
+        statistics = RunningStatistics()
+        self.assertIsNone(statistics.getMean())
+        for value in values:
+            statistics.add(value)
+        for value in [None, "", "nan", "not a number"]:
+            statistics.add(value)
+        self.assertEqual(statistics.count, 5000)
+        self.assertAlmostEqual(statistics.getMean(), values.mean(), places=6)
+        self.assertAlmostEqual(statistics.getVariance(), values.var(ddof=1), places=3)
+        self.assertEqual(statistics.minimum, values.min())
+        self.assertEqual(statistics.maximum, values.max())
+
+    def test_quantileSketch(self):
+        values = numpy.random.default_rng(1).gamma(2.0, 2.0, 20000)
+        statistics = RunningStatistics(withSketch=True)
+        for value in values:
+            statistics.add(value)
+        self.assertLessEqual(
+            len(statistics.sketch.listMean), esrf_utils_gridstats.SKETCH_SIZE
+        )
+        self.assertEqual(sum(statistics.sketch.listWeight), 20000)
+        for fraction in [0.1, 0.5, 0.9]:
+            # Rank error below 2 %
+            estimate = statistics.getQuantile(fraction)
+            rank = numpy.mean(values <= estimate)
+            self.assertLess(abs(rank - fraction), 0.02)
+        self.assertEqual(statistics.getQuantile(0.0), values.min())
+        self.assertEqual(statistics.getQuantile(1.0), values.max())
+        self.assertIsNone(QuantileSketch().quantile(0.5))
+
+    def test_gridSquareStatistics(self):
+        gridSquareStatistics = GridSquareStatistics()
+        gridSquareStatistics.addMovie("1.5e-05", "-2e-05")
+        gridSquareStatistics.addMovie("2.5e-05", "-4e-05")
+        gridSquareStatistics.addMotionCorrection(12.3)
+        gridSquareStatistics.addMotionCorrection(None)
+        gridSquareStatistics.addCtf("20000.0", "22000.0", "3.5")
+        gridSquareStatistics.addCtf(None, "22000.0", None)
+        self.assertAlmostEqual(gridSquareStatistics.getMean("positionX"), 2e-05)
+        self.assertAlmostEqual(gridSquareStatistics.getMean("positionY"), -3e-05)
+        dictSummary = gridSquareStatistics.getSummary()
+        self.assertEqual(dictSummary["defocus"]["count"], 1)
+        self.assertEqual(dictSummary["defocus"]["median"], 21000.0)
+        self.assertEqual(dictSummary["totalMotion"]["count"], 1)
+        self.assertNotIn("median", dictSummary["positionX"])
+        # Serialized with the session state
+        dictState = json.loads(json.dumps(gridSquareStatistics.toDict()))
+        restored = GridSquareStatistics.fromDict(dictState)
+        self.assertEqual(restored.getSummary(), dictSummary)
+        restored.addCtf(24000.0, 24000.0, 4.0)
+        self.assertEqual(restored.getSummary()["defocus"]["count"], 2)
+
+    def test_gridSquareStatistics_fromMovies(self):
+        listDictMovie = [
+            {"positionX": "1.0", "positionY": "2.0", "totalMotion": 10.0},
+            {
+                "positionX": "3.0",
+                "positionY": "4.0",
+                "totalMotion": 20.0,
+                "defocusU": 10000.0,
+                "defocusV": 12000.0,
+                "resolutionLimit": 3.1,
+            },
+        ]
+        gridSquareStatistics = GridSquareStatistics.fromMovies(listDictMovie)
+        self.assertEqual(gridSquareStatistics.getMean("positionX"), 2.0)
+        self.assertEqual(gridSquareStatistics.getMean("totalMotion"), 15.0)
+        self.assertEqual(gridSquareStatistics.getMean("defocus"), 11000.0)
+
+    def test_gridSquareStatistics_countedOnce(self):
+        gridSquareStatistics = GridSquareStatistics()
+        gridSquareStatistics.addMovie(1.0, 2.0, "movie_1")
+        gridSquareStatistics.addMovie(3.0, 4.0, "movie_2")
+        gridSquareStatistics.addMotionCorrection(10.0, "movie_1")
+        # Uploaded again
+        gridSquareStatistics.addMovie(1.0, 2.0, "movie_1")
+        gridSquareStatistics.addMotionCorrection(10.0, "movie_1")
+        dictSummary = gridSquareStatistics.getSummary()
+        self.assertEqual(dictSummary["positionX"]["count"], 2)
+        self.assertEqual(dictSummary["totalMotion"]["count"], 1)
+        restored = GridSquareStatistics.fromDict(
+            json.loads(json.dumps(gridSquareStatistics.toDict()))
+        )
+        restored.addMovie(3.0, 4.0, "movie_2")
+        restored.addMotionCorrection(20.0, "movie_2")
+        dictSummary = restored.getSummary()
+        self.assertEqual(dictSummary["positionX"]["count"], 2)
+        self.assertEqual(dictSummary["totalMotion"]["count"], 2)
+        # Rebuilt from the movie entries, by name
+        rebuilt = GridSquareStatistics.fromMovies(
+            {
+                "movie_1": {"positionX": 1.0, "positionY": 2.0, "totalMotion": 10.0},
+                "movie_2": {"positionX": 3.0, "positionY": 4.0},
+            }
+        )
+        rebuilt.addMovie(3.0, 4.0, "movie_2")
+        rebuilt.addMotionCorrection(20.0, "movie_2")
+        self.assertEqual(rebuilt.getSummary(), dictSummary)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,155 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import numpy
+from PIL import Image
+
+from esrf.utils import esrf_utils_header
+from esrf.utils.esrf_utils_header import UtilsHeader
+
+from esrf_test_utils import writeMrc
+
+
+def writeTiff(tiffFilePath, noFrames, shape=(32, 48), dtype=numpy.uint8):
+    listImage = [
+        Image.fromarray(numpy.full(shape, index, dtype=dtype))
+        for index in range(noFrames)
+    ]
+    listImage[0].save(
+        tiffFilePath,
+        save_all=True,
+        append_images=listImage[1:],
+        dpi=(254000000 / 0.827, 254000000 / 0.827),
+    )
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp(prefix="test_esrf_utils_header_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def test_probe_mrc(self):
+        mrcFilePath = os.path.join(self.tempDir, "movie.mrc")
+        writeMrc(mrcFilePath, numpy.zeros((5, 16, 24)), mode=1, nsymbt=80)
+        movieHeader = UtilsHeader.probe(mrcFilePath)
+        self.assertEqual(movieHeader.format, esrf_utils_header.MRC)
+        self.assertEqual(movieHeader.frames, 5)
+        self.assertEqual((movieHeader.width, movieHeader.height), (24, 16))
+        self.assertEqual(movieHeader.dtype, "<i2")
+        self.assertEqual(movieHeader.dataOffset, 1104)
+        self.assertIsNone(movieHeader.pixelSize)
+
+    def test_probe_mrcPixelSize(self):
+        mrcFilePath = os.path.join(self.tempDir, "movie.mrc")
+        writeMrc(mrcFilePath, numpy.zeros((2, 8, 10)), byteOrder=">")
+        # mx = 10, xlen = 8.27 A
+        with open(mrcFilePath, "r+b") as fd:
+            fd.seek(28)
+            fd.write(numpy.array([10], dtype=">i4").tobytes())
+            fd.seek(40)
+            fd.write(numpy.array([8.27], dtype=">f4").tobytes())
+        movieHeader = UtilsHeader.probe(mrcFilePath)
+        self.assertEqual(movieHeader.dtype, ">f4")
+        self.assertAlmostEqual(movieHeader.pixelSize, 0.827, places=5)
+
+    def test_probe_tiff(self):
+        tiffFilePath = os.path.join(self.tempDir, "movie_fractions.tiff")
+        writeTiff(tiffFilePath, 7)
+        movieHeader = UtilsHeader.probe(tiffFilePath)
+        self.assertEqual(movieHeader.format, esrf_utils_header.TIFF)
+        self.assertEqual(movieHeader.frames, 7)
+        self.assertEqual((movieHeader.width, movieHeader.height), (48, 32))
+        self.assertEqual(movieHeader.dtype, "|u1")
+        self.assertAlmostEqual(movieHeader.pixelSize, 0.827, places=3)
+
+    def test_probe_invalid(self):
+        textFilePath = os.path.join(self.tempDir, "movie.mrc")
+        with open(textFilePath, "w") as fd:
+            fd.write("Not a movie")
+        with self.assertRaises(RuntimeError):
+            UtilsHeader.probe(textFilePath)
+        with open(textFilePath, "wb") as fd:
+            fd.write(b"II*\0")
+        with self.assertRaises(RuntimeError):
+            UtilsHeader.probe(textFilePath)
+
+    def test_probe_largeMrc(self):
+        # Sparse 2.6 GB movie, only the header is read
+        mrcFilePath = os.path.join(self.tempDir, "large.mrc")
+        writeMrc(mrcFilePath, numpy.zeros((1, 1, 1)))
+        noFrames, height, width = 40, 5760, 11520
+        with open(mrcFilePath, "r+b") as fd:
+            fd.write(numpy.array([width, height, noFrames], dtype="<i4").tobytes())
+            fd.truncate(1024 + noFrames * height * width)
+        startTime = time.time()
+        movieHeader = UtilsHeader.probe(mrcFilePath)
+        probeTime = time.time() - startTime
+        print(
+            "Probe of a {0} bytes movie: {1:.6f} s".format(
+                os.path.getsize(mrcFilePath), probeTime
+            )
+        )
+        self.assertEqual(movieHeader.frames, noFrames)
+        self.assertLess(probeTime, 0.1)
+
+    def test_checkHomogeneous(self):
+        listMovieFilePath = []
+        for index in range(6):
+            tiffFilePath = os.path.join(self.tempDir, "movie_{0}.tiff".format(index))
+            writeTiff(tiffFilePath, 4)
+            listMovieFilePath.append(tiffFilePath)
+        reference, listDifference = UtilsHeader.checkHomogeneous(listMovieFilePath)
+        self.assertEqual(reference.frames, 4)
+        self.assertEqual(listDifference, [])
+        # Different number of frames and a broken movie
+        writeTiff(listMovieFilePath[3], 3)
+        with open(listMovieFilePath[5], "wb") as fd:
+            fd.write(b"broken")
+        reference, listDifference = UtilsHeader.checkHomogeneous(listMovieFilePath)
+        self.assertEqual(listDifference[0], (listMovieFilePath[3], "frames", 4, 3))
+        self.assertEqual(listDifference[1][:2], (listMovieFilePath[5], "error"))
+        # Sampling
+        reference, listDifference = UtilsHeader.checkHomogeneous(
+            listMovieFilePath, sampleSize=2
+        )
+        self.assertEqual(len(listDifference), 1)
+        with self.assertRaises(RuntimeError):
+            UtilsHeader.checkHomogeneous([])
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
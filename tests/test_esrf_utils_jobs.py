@@ -0,0 +1,101 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import sys
+import time
+import unittest
+
+from esrf.utils.esrf_utils_jobs import JobEngine, JobError, JobTimeoutError, UtilsJobs
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.jobEngine = JobEngine(maxWorkers=4, toolConcurrency={"sleep": 1})
+
+    def tearDown(self):
+        self.jobEngine.shutdown()
+
+    def test_run(self):
+        jobResult = self.jobEngine.run(
+            [sys.executable, "-c", "import sys; print('out'); sys.stderr.write('err')"]
+        )
+        self.assertEqual(jobResult.returnCode, 0)
+        self.assertEqual(jobResult.stdout.strip(), b"out")
+        self.assertEqual(jobResult.stderr, b"err")
+
+    def test_run_exitCode(self):
+        with self.assertRaises(JobError) as context:
+            self.jobEngine.run(
+                [
+                    sys.executable,
+                    "-c",
+                    "import sys; sys.stderr.write('bad'); sys.exit(3)",
+                ]
+            )
+        self.assertEqual(context.exception.jobResult.returnCode, 3)
+        self.assertIn("bad", str(context.exception))
+        jobResult = self.jobEngine.run([sys.executable, "-c", "exit(3)"], check=False)
+        self.assertEqual(jobResult.returnCode, 3)
+
+    def test_run_timeout(self):
+        startTime = time.time()
+        with self.assertRaises(JobTimeoutError):
+            self.jobEngine.run(["sleep", "10"], timeout=0.2)
+        self.assertLess(time.time() - startTime, 5)
+
+    def test_submit_toolConcurrency(self):
+        startTime = time.time()
+        listFuture = [self.jobEngine.submit(["sleep", "0.2"]) for index in range(3)]
+        listFuture += [
+            self.jobEngine.submit(
+                [sys.executable, "-c", "import time; time.sleep(0.2)"]
+            )
+            for index in range(3)
+        ]
+        for future in listFuture[3:]:
+            future.result()
+        otherTime = time.time() - startTime
+        for future in listFuture[:3]:
+            future.result()
+        sleepTime = time.time() - startTime
+        # 'sleep' jobs run one at a time, the others in parallel
+        self.assertGreaterEqual(sleepTime, 0.6)
+        self.assertLess(otherTime, 0.6)
+
+    def test_shutdown(self):
+        UtilsJobs.run(["true"])
+        jobEngine = UtilsJobs.getEngine()
+        UtilsJobs.shutdown()
+        with self.assertRaises(RuntimeError):
+            jobEngine.submit(["true"])
+        self.assertIsNot(jobEngine, UtilsJobs.getEngine())
+        UtilsJobs.shutdown()
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,338 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import glob
+import json
+import time
+import pickle
+import shutil
+import tempfile
+import unittest
+import collections
+
+from esrf.utils import esrf_utils_journal
+from esrf.utils.esrf_utils_journal import ParamsJournal, UtilsJournal
+from esrf.utils.esrf_utils_path import UtilsPath
+
+
+def getMovieEntry(index):
+    return {
+        "movieNumber": index,
+        "movieFullPath": "/data/GridSquare_1/Data/movie_{0:05d}.tiff".format(index),
+        "dosePerFrame": 1.1,
+        "processDir": "/data/PROCESSED_DATA/movie_{0:05d}".format(index),
+    }
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp(prefix="test_esrf_utils_journal_")
+        self.jsonFilePath = os.path.join(self.tempDir, "allParams.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def getJournalLines(self):
+        with open(UtilsJournal.getJournalPath(self.jsonFilePath)) as fd:
+            return [json.loads(line) for line in fd]
+
+    def test_flush(self):
+        allParams = UtilsJournal.load(self.jsonFilePath)
+        allParams["movie_1"] = getMovieEntry(1)
+        allParams["movie_2"] = getMovieEntry(2)
+        allParams.flush()
+        self.assertEqual(len(self.getJournalLines()), 2)
+        # Only the entry updated in place is appended
+        allParams["movie_2"]["motionCorrectionId"] = 12
+        allParams.flush()
+        listRecord = self.getJournalLines()
+        self.assertEqual(len(listRecord), 3)
+        self.assertEqual(listRecord[2]["set"]["movie_2"]["motionCorrectionId"], 12)
+        # Read but not changed: nothing appended
+        self.assertEqual(allParams["movie_1"]["movieNumber"], 1)
+        allParams.flush()
+        self.assertEqual(len(self.getJournalLines()), 3)
+        del allParams["movie_1"]
+        allParams.flush()
+        self.assertEqual(self.getJournalLines()[3], {"del": "movie_1"})
+        self.assertFalse(os.path.exists(self.jsonFilePath))
+        dictParams = UtilsJournal.read(self.jsonFilePath)
+        self.assertEqual(list(dictParams), ["movie_2"])
+        self.assertEqual(dictParams["movie_2"]["motionCorrectionId"], 12)
+
+    def test_flushFailed(self):
+        allParams = UtilsJournal.load(self.jsonFilePath)
+        allParams["movie_1"] = getMovieEntry(1)
+        allParams.flush()
+        allParams["movie_1"]["motionCorrectionId"] = 11
+        allParams["movie_2"] = getMovieEntry(2)
+        writeChanges = allParams.writeChanges
+
+        def failedWriteChanges(dictChanged, listDeleted):
+            raise OSError(28, "No space left on device")
+
+        allParams.writeChanges = failedWriteChanges
+        with self.assertRaises(OSError):
+            allParams.flush()
+        self.assertEqual(len(self.getJournalLines()), 1)
+        # Written at the next flush
+        allParams.writeChanges = writeChanges
+        allParams.flush()
+        dictParams = UtilsJournal.read(self.jsonFilePath)
+        self.assertEqual(list(dictParams), ["movie_1", "movie_2"])
+        self.assertEqual(dictParams["movie_1"]["motionCorrectionId"], 11)
+        # Deletions too
+        del allParams["movie_1"]
+        allParams.writeChanges = failedWriteChanges
+        with self.assertRaises(OSError):
+            allParams.flush()
+        allParams.writeChanges = writeChanges
+        allParams.flush()
+        self.assertEqual(list(UtilsJournal.read(self.jsonFilePath)), ["movie_2"])
+
+    def test_deleteLoaded(self):
+        allParams = UtilsJournal.load(self.jsonFilePath)
+        allParams["movie_1"] = getMovieEntry(1)
+        allParams["movie_2"] = getMovieEntry(2)
+        allParams.close()
+        # Entries loaded from disk are deleted from the journal too
+        allParams = UtilsJournal.load(self.jsonFilePath)
+        del allParams["movie_1"]
+        allParams.flush()
+        allParams.close()
+        allParams = UtilsJournal.load(self.jsonFilePath)
+        self.assertEqual(list(allParams), ["movie_2"])
+        allParams.close()
+
+    def test_load(self):
+        # allParams.json written before the journal
+        dictLegacy = collections.OrderedDict(
+            ("movie_{0}".format(index), getMovieEntry(index)) for index in range(3)
+        )
+        with open(self.jsonFilePath, "w") as fd:
+            fd.write(json.dumps(dictLegacy, indent=4))
+        allParams = UtilsJournal.load(self.jsonFilePath)
+        self.assertIsInstance(allParams, collections.OrderedDict)
+        self.assertEqual(allParams, dictLegacy)
+        allParams.flush()
+        self.assertFalse(os.path.exists(UtilsJournal.getJournalPath(self.jsonFilePath)))
+        allParams[7] = {"done": True}
+        allParams.flush()
+        # Last line cut by a crash
+        with open(UtilsJournal.getJournalPath(self.jsonFilePath), "a") as fd:
+            fd.write('{"set": {"movie_9": {"mov')
+        allParams = UtilsJournal.load(self.jsonFilePath)
+        self.assertEqual(list(allParams), ["movie_0", "movie_1", "movie_2", "7"])
+        self.assertEqual(UtilsPath.getProcessedMovieNames(allParams), set())
+
+    def test_compact(self):
+        allParams = UtilsJournal.load(self.jsonFilePath)
+        for index in range(10):
+            allParams["movie_{0}".format(index)] = getMovieEntry(index)
+            allParams.flush()
+        allParams.compact(wait=True)
+        self.assertFalse(os.path.exists(UtilsJournal.getJournalPath(self.jsonFilePath)))
+        self.assertEqual(UtilsJournal.listRotatedJournalPath(self.jsonFilePath), [])
+        with open(self.jsonFilePath) as fd:
+            self.assertEqual(json.load(fd), allParams)
+        # Journal written while compacting
+        allParams["movie_3"]["CTFid"] = 5
+        allParams.flush()
+        os.replace(
+            UtilsJournal.getJournalPath(self.jsonFilePath),
+            UtilsJournal.getJournalPath(self.jsonFilePath) + ".1",
+        )
+        allParams["movie_4"]["CTFid"] = 6
+        allParams.flush()
+        dictParams = UtilsJournal.read(self.jsonFilePath)
+        self.assertEqual(dictParams["movie_3"]["CTFid"], 5)
+        self.assertEqual(dictParams["movie_4"]["CTFid"], 6)
+        allParams.close()
+        with open(self.jsonFilePath) as fd:
+            self.assertEqual(json.load(fd), allParams)
+
+    def test_compactOnFlush(self):
+        allParams = UtilsJournal.load(self.jsonFilePath)
+        compactMinSize = esrf_utils_journal.COMPACT_MIN_SIZE
+        esrf_utils_journal.COMPACT_MIN_SIZE = 1000
+        try:
+            for index in range(20):
+                allParams["movie_{0}".format(index)] = getMovieEntry(index)
+                allParams.flush()
+        finally:
+            esrf_utils_journal.COMPACT_MIN_SIZE = compactMinSize
+        allParams.compactThread.join()
+        self.assertTrue(os.path.exists(self.jsonFilePath))
+        self.assertEqual(UtilsJournal.read(self.jsonFilePath), allParams)
+
+    def test_create(self):
+        with open(self.jsonFilePath, "w") as fd:
+            fd.write("{ broken")
+        with self.assertRaises(ValueError):
+            UtilsJournal.load(self.jsonFilePath)
+        allParams = UtilsJournal.create(self.jsonFilePath)
+        allParams["movie_1"] = getMovieEntry(1)
+        allParams.close()
+        self.assertEqual(list(UtilsJournal.read(self.jsonFilePath)), ["movie_1"])
+        # The broken file is kept
+        listCorrupted = glob.glob(self.jsonFilePath + ".corrupted.*")
+        self.assertEqual(len(listCorrupted), 1)
+        with open(listCorrupted[0]) as fd:
+            self.assertEqual(fd.read(), "{ broken")
+
+    @unittest.skipIf(esrf_utils_journal.msgpack is None, "msgpack not installed")
+    def test_binarySnapshot(self):
+        allParams = UtilsJournal.load(self.jsonFilePath)
+        for index in range(5):
+            allParams["movie_{0}".format(index)] = getMovieEntry(index)
+        allParams[7] = {"done": True}
+        allParams.close()
+        binaryFilePath = UtilsJournal.getBinarySnapshotPath(self.jsonFilePath)
+        self.assertEqual(binaryFilePath, os.path.join(self.tempDir, "allParams.bin"))
+        dictParams = UtilsJournal.readBinarySnapshot(self.jsonFilePath)
+        self.assertIsInstance(dictParams, collections.OrderedDict)
+        with open(self.jsonFilePath) as fd:
+            self.assertEqual(list(dictParams.items()), list(json.load(fd).items()))
+        self.assertEqual(UtilsJournal.load(self.jsonFilePath), dictParams)
+        # Not the copy of the JSON snapshot any more
+        with open(self.jsonFilePath, "w") as fd:
+            fd.write(json.dumps({"movie_9": getMovieEntry(9)}))
+        self.assertIsNone(UtilsJournal.readBinarySnapshot(self.jsonFilePath))
+        self.assertEqual(list(UtilsJournal.load(self.jsonFilePath)), ["movie_9"])
+        # Other format version, or truncated
+        UtilsJournal.writeSnapshot(self.jsonFilePath, dictParams)
+        with open(binaryFilePath, "r+b") as fd:
+            fd.seek(len(esrf_utils_journal.BINARY_MAGIC))
+            fd.write(b"\xff\xff")
+        self.assertIsNone(UtilsJournal.readBinarySnapshot(self.jsonFilePath))
+        UtilsJournal.writeSnapshot(self.jsonFilePath, dictParams)
+        with open(binaryFilePath, "r+b") as fd:
+            fd.truncate(100)
+        with self.assertLogs("esrf.utils.esrf_utils_journal", "WARNING"):
+            self.assertIsNone(UtilsJournal.readBinarySnapshot(self.jsonFilePath))
+        self.assertEqual(UtilsJournal.load(self.jsonFilePath), dictParams)
+        # Only data is read back, e.g. not a pickle with a valid header
+        with open(binaryFilePath, "r+b") as fd:
+            fd.seek(esrf_utils_journal.BINARY_HEADER.size)
+            fd.truncate()
+            fd.write(pickle.dumps(collections.OrderedDict(dictParams)))
+        with self.assertLogs("esrf.utils.esrf_utils_journal", "WARNING"):
+            self.assertIsNone(UtilsJournal.readBinarySnapshot(self.jsonFilePath))
+
+    def test_noFile(self):
+        allParams = UtilsJournal.load(None)
+        allParams["movie_1"] = getMovieEntry(1)
+        allParams.flush()
+        allParams.close()
+        self.assertEqual(os.listdir(self.tempDir), [])
+        self.assertIsInstance(allParams, ParamsJournal)
+
+    def test_benchmark_flush(self):
+        # One import, one motion correction and one CTF update per movie
+        noMovies = 500
+        legacyBytes = 0
+        legacyFilePath = os.path.join(self.tempDir, "legacy.json")
+        legacyParams = collections.OrderedDict()
+        allParams = UtilsJournal.load(self.jsonFilePath)
+        listTime = [0.0, 0.0]
+        for index in range(noMovies):
+            movieName = "movie_{0}".format(index)
+            for update in [
+                getMovieEntry(index),
+                {"motionCorrectionId": index},
+                {"CTFid": index},
+            ]:
+                legacyParams.setdefault(movieName, {}).update(update)
+                startTime = time.time()
+                with open(legacyFilePath, "w") as fd:
+                    legacyBytes += fd.write(json.dumps(legacyParams, indent=4))
+                listTime[0] += time.time() - startTime
+                allParams.setdefault(movieName, {}).update(update)
+                startTime = time.time()
+                allParams.flush()
+                listTime[1] += time.time() - startTime
+        journalBytes = os.path.getsize(UtilsJournal.getJournalPath(self.jsonFilePath))
+        allParams.close()
+        print(
+            "{0} movies: legacy {1} kB in {2:.3f} s, journal {3} kB in {4:.3f} s".format(
+                noMovies,
+                legacyBytes // 1024,
+                listTime[0],
+                journalBytes // 1024,
+                listTime[1],
+            )
+        )
+        self.assertEqual(UtilsJournal.read(self.jsonFilePath), legacyParams)
+        self.assertLess(listTime[1], listTime[0])
+
+    @unittest.skipIf(esrf_utils_journal.msgpack is None, "msgpack not installed")
+    def test_benchmark_binarySnapshot(self):
+        # Monitor start with the JSON snapshot of 10k to 100k movies
+        for noMovies in [10000, 50000, 100000]:
+            dictParams = collections.OrderedDict()
+            for index in range(noMovies):
+                dictMovie = getMovieEntry(index)
+                dictMovie.update(
+                    {"movieId": index, "motionCorrectionId": index, "CTFid": index}
+                )
+                dictParams["movie_{0}".format(index)] = dictMovie
+            UtilsJournal.writeSnapshot(self.jsonFilePath, dictParams)
+            binaryFilePath = UtilsJournal.getBinarySnapshotPath(self.jsonFilePath)
+            startTime = time.time()
+            with open(self.jsonFilePath) as fd:
+                legacyParams = collections.OrderedDict(json.loads(fd.read()))
+            legacyTime = time.time() - startTime
+            startTime = time.time()
+            allParams = UtilsJournal.load(self.jsonFilePath)
+            binaryTime = time.time() - startTime
+            binarySize = os.path.getsize(binaryFilePath)
+            os.remove(binaryFilePath)
+            startTime = time.time()
+            jsonParams = UtilsJournal.load(self.jsonFilePath)
+            jsonTime = time.time() - startTime
+            print(
+                "{0} movies: legacy {1:.3f} s, load from JSON {2:.3f} s ({3} MB), "
+                "from binary {4:.3f} s ({5} MB)".format(
+                    noMovies,
+                    legacyTime,
+                    jsonTime,
+                    os.path.getsize(self.jsonFilePath) // 1024**2,
+                    binaryTime,
+                    binarySize // 1024**2,
+                )
+            )
+            self.assertEqual(allParams, legacyParams)
+            self.assertEqual(jsonParams, legacyParams)
+            self.assertLess(binarySize, os.path.getsize(self.jsonFilePath))
+        self.assertLess(binaryTime, jsonTime)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,101 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from esrf.utils.esrf_utils_mdoc import UtilsMdoc
+from esrf.utils.esrf_utils_path import UtilsPath
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), "testdata")
+FRAME_MDOC_PATH = os.path.join(TEST_DATA_DIR, "mx2214_00005.tif.mdoc")
+TILT_SERIES_MDOC_PATH = os.path.join(TEST_DATA_DIR, "grid1_Position_17.mrc.mdoc")
+
+
+class Test(unittest.TestCase):
+    def test_getMdocMetaData(self):
+        dictResult = UtilsPath.getMdocMetaData(FRAME_MDOC_PATH)
+        self.assertEqual(dictResult["StagePosition"], "-62.6189 730.271")
+        self.assertEqual(dictResult["DateTime"], "05-Sep-19  15:52:08")
+        self.assertEqual(
+            dictResult["T"],
+            "SerialEM: Acquired on Titan Krios D3693                 05-Sep-19  11:24:48",
+        )
+        self.assertEqual(
+            dictResult["SubFramePath"],
+            "X:\\DoseFractions\\mx2214\\data\\mx2214_00005.tif",
+        )
+        self.assertEqual(dictResult["[FrameSet"], "0]")
+        self.assertEqual(len(dictResult), 31)
+
+    def test_parse_tiltSeries(self):
+        mdocData = UtilsMdoc.parse(TILT_SERIES_MDOC_PATH)
+        self.assertEqual(mdocData.header["ImageSize"], "4096 4096")
+        self.assertEqual(mdocData.sectionType, "ZValue")
+        self.assertEqual(mdocData.sectionIndex.tolist(), [0, 1, 2])
+        # Title with '=' in the value
+        self.assertEqual(
+            mdocData.titles[1],
+            "Tilt axis angle = 84.9, binning = 1  spot = 7  camera = 0",
+        )
+        self.assertEqual(
+            mdocData.arrays["TiltAngle"].tolist(), [0.00370566, 3.00365, -2.99685]
+        )
+        self.assertEqual(mdocData.arrays["ExposureDose"].tolist(), [3.01, 3.02, 3.0])
+        self.assertEqual(mdocData.sections[1]["DateTime"], "02-Mar-23  04:16:06")
+        dictSection = UtilsMdoc.getSection(TILT_SERIES_MDOC_PATH, tiltAngle=-3.0)
+        self.assertEqual(dictSection["Defocus"], "-3.49914")
+        self.assertEqual(dictSection["Voltage"], "300")
+        dictSection = UtilsMdoc.getSection(TILT_SERIES_MDOC_PATH, sectionIndex=1)
+        self.assertEqual(dictSection["TiltAngle"], "3.00365")
+        self.assertIsNone(UtilsMdoc.getSection(TILT_SERIES_MDOC_PATH, sectionIndex=7))
+
+    def test_parse_cache(self):
+        tmpDir = tempfile.mkdtemp(prefix="Mdoc_")
+        try:
+            mdocFilePath = os.path.join(tmpDir, "ts.mrc.mdoc")
+            shutil.copy(TILT_SERIES_MDOC_PATH, mdocFilePath)
+            mdocData = UtilsMdoc.parse(mdocFilePath)
+            self.assertIs(mdocData, UtilsMdoc.parse(mdocFilePath))
+            # A tilt appended by SerialEM invalidates the cache
+            with open(mdocFilePath, "a") as fd:
+                fd.write("\n[ZValue = 3]\nTiltAngle = 6.00372\nExposureDose = 3.04\n")
+            mdocData = UtilsMdoc.parse(mdocFilePath)
+            self.assertEqual(len(mdocData.sections), 4)
+            self.assertEqual(mdocData.arrays["TiltAngle"][3], 6.00372)
+            self.assertTrue(numpy.isnan(mdocData.arrays["Defocus"][3]))
+        finally:
+            shutil.rmtree(tmpDir)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
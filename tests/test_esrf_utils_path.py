@@ -31,10 +31,17 @@ import glob
 import pprint
 import pathlib
 import shutil
+import time
 import tempfile
 import unittest
 
 from esrf.utils.esrf_utils_path import UtilsPath
+from esrf.utils.esrf_utils_watcher import FileArrivalWatcher
+
+try:
+    from esrf.protocols.protocol_monitor_ispyb import MonitorISPyB_ESRF
+except ImportError:
+    MonitorISPyB_ESRF = None
 
 
 class Test(unittest.TestCase):
@@ -523,6 +530,89 @@ class Test(unittest.TestCase):
         # import pprint
         # pprint.pprint(blackList)
 
+    def test_getBlacklist_timing(self):
+        # 50 000 movies in 200 grid squares, every other grid square processed
+        test_dir = pathlib.Path(tempfile.mkdtemp())
+        listMovies = []
+        dictAllParams = {}
+        for index in range(50000):
+            gridSquare = "GridSquare_{0}".format(index // 250)
+            movieName = "FoilHole_1_Data_2_3_20210630_{0:06d}_fractions".format(index)
+            listMovies.append(
+                "/data/RAW_DATA/Images-Disc1/{0}/Data/{1}.tiff".format(
+                    gridSquare, movieName
+                )
+            )
+            if (index // 250) % 2 == 0:
+                dictAllParams[movieName] = {"motionCorrectionId": 1, "CTFid": 2}
+        allParamsJsonFile = str(test_dir / "allParams.json")
+        with open(allParamsJsonFile, "w") as f:
+            f.write(json.dumps(dictAllParams))
+        startTime = time.time()
+        blackList = UtilsPath.getBlacklist(listMovies, allParamsJsonFile)
+        deltaTime = time.time() - startTime
+        # About one second, generous bound for slow test machines
+        self.assertLess(deltaTime, 10.0)
+        self.assertEqual(len(blackList), 100)
+        self.assertEqual(blackList[0], "(.*)GridSquare_0(.*)")
+        self.assertEqual(blackList[1], "(.*)GridSquare_2(.*)")
+        blackList = UtilsPath.getBlacklistAllMovies(listMovies, allParamsJsonFile)
+        self.assertEqual(len(blackList), 25000)
+        shutil.rmtree(test_dir)
+
+    @unittest.skipIf(MonitorISPyB_ESRF is None, "Scipion not installed")
+    def test_getUploadedMovieFullPaths_timing(self):
+        class Prot(object):
+            def __init__(self, listMatchFiles):
+                self.listMatchFiles = listMatchFiles
+
+            def getMatchFiles(self):
+                return self.listMatchFiles
+
+        dictStepTime = {}
+        for noMovies in [2000, 20000]:
+            allParams = {}
+            for index in range(noMovies):
+                allParams["movie_{0}".format(index)] = {
+                    "movieFullPath": "/data/Data/movie_{0}.tiff".format(index),
+                    "movieId": index,
+                }
+            # One new movie on disk
+            prot = Prot(
+                [dictMovie["movieFullPath"] for dictMovie in allParams.values()]
+                + ["/data/Data/movie_new.tiff"]
+            )
+            # Monitor without Scipion project, only the step is run
+            monitor = MonitorISPyB_ESRF.__new__(MonitorISPyB_ESRF)
+            monitor.dataType = 1  # "EPU_TIFF"
+            monitor.info = lambda message: None
+            monitor.sidecarWatcher = FileArrivalWatcher(useInotify=False)
+            listUploaded = []
+            monitor.uploadMovie = lambda prot, movieFullPath: listUploaded.append(
+                movieFullPath
+            )
+            startTime = time.time()
+            monitor.setUploadedMovieFullPath = UtilsPath.getUploadedMovieFullPaths(
+                allParams
+            )
+            loadTime = time.time() - startTime
+            listStepTime = []
+            for _ in range(5):
+                del listUploaded[:]
+                startTime = time.time()
+                monitor.uploadImportMovies(prot)
+                listStepTime.append(time.time() - startTime)
+                self.assertEqual(listUploaded, ["/data/Data/movie_new.tiff"])
+            monitor.sidecarWatcher.close()
+            dictStepTime[noMovies] = min(listStepTime)
+            print(
+                "{0} movies: load {1:.4f} s, step {2:.4f} s".format(
+                    noMovies, loadTime, dictStepTime[noMovies]
+                )
+            )
+        # Linear in the number of movies, the step used to be quadratic
+        self.assertLess(dictStepTime[20000], 30 * dictStepTime[2000])
+
     def test_getInputParticleDict(self):
         testDataPath = pathlib.Path(__file__).parent / "testdata"
         allParamsFile = str(testDataPath / "allParams.json")
@@ -0,0 +1,288 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+import unittest.mock
+
+import numpy
+from PIL import Image
+
+from esrf.utils.esrf_utils_snapshot import SnapshotCache, UtilsSnapshot
+from esrf.utils.esrf_utils_path import UtilsPath
+
+from esrf_test_utils import writeMrc
+
+BIMG = "/cvmfs/sb.esrf.fr/bin/bimg"
+BSCALE = "/cvmfs/sb.esrf.fr/bin/bscale"
+
+# Stand-ins for 'bimg' and 'bscale' when CVMFS is not mounted: one process
+# per step with a full size temporary TIFF in between, as in the legacy path
+LEGACY_BIMG = (
+    "import sys, numpy; from PIL import Image;"
+    "from esrf.utils.esrf_utils_snapshot import UtilsSnapshot;"
+    "image = UtilsSnapshot.loadImage(sys.argv[1], average=True);"
+    "Image.fromarray(image.astype(numpy.float32)).save(sys.argv[2])"
+)
+LEGACY_BSCALE = (
+    "import sys, numpy; from PIL import Image;"
+    "from esrf.utils.esrf_utils_snapshot import UtilsSnapshot;"
+    "image = numpy.asarray(Image.open(sys.argv[1]), dtype=numpy.float64);"
+    "image = UtilsSnapshot.binImage(image, int(sys.argv[3]));"
+    "Image.fromarray(UtilsSnapshot.scaleToUint8(image)).save(sys.argv[2])"
+)
+
+
+def legacyCreateSnapshot(imageFilePath, snapshotFilePath, binning):
+    # Two processes and a temporary TIFF, as done with bimg / bscale
+    tempTifPath = str(snapshotFilePath) + ".tif"
+    if os.path.exists(BIMG):
+        subprocess.check_call([BIMG, "-average", str(imageFilePath), tempTifPath])
+        subprocess.check_call(
+            [BSCALE, "-bin", str(binning), tempTifPath, str(snapshotFilePath)]
+        )
+    else:
+        subprocess.check_call(
+            [sys.executable, "-c", LEGACY_BIMG, str(imageFilePath), tempTifPath]
+        )
+        subprocess.check_call(
+            [
+                sys.executable,
+                "-c",
+                LEGACY_BSCALE,
+                tempTifPath,
+                str(snapshotFilePath),
+                str(binning),
+            ]
+        )
+    os.remove(tempTifPath)
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.workingDir = tempfile.mkdtemp(prefix="UtilsSnapshot_")
+        self.cacheDir = os.path.join(self.workingDir, "cache")
+        UtilsSnapshot.setCache(SnapshotCache(self.cacheDir))
+
+    def tearDown(self):
+        UtilsSnapshot.setCache(None)
+        shutil.rmtree(self.workingDir)
+
+    def test_readMrc(self):
+        data = numpy.arange(2 * 3 * 4).reshape(2, 3, 4)
+        for mode in [0, 1, 2, 6]:
+            for byteOrder in ["<", ">"]:
+                mrcFilePath = os.path.join(self.workingDir, "test.mrc")
+                writeMrc(mrcFilePath, data, mode=mode, nsymbt=64, byteOrder=byteOrder)
+                stack = UtilsSnapshot.readMrc(mrcFilePath)
+                self.assertEqual(stack.shape, (2, 3, 4))
+                self.assertEqual(stack.tolist(), data.tolist())
+                del stack
+        writeMrc(mrcFilePath, data)
+        with open(mrcFilePath, "r+b") as fd:
+            fd.seek(12)
+            fd.write(numpy.int32(4).tobytes())
+        with self.assertRaises(RuntimeError):
+            UtilsSnapshot.readMrc(mrcFilePath)
+
+    def test_loadImage_average(self):
+        mrcFilePath = os.path.join(self.workingDir, "movie.mrc")
+        writeMrc(mrcFilePath, numpy.stack([numpy.zeros((4, 4)), numpy.ones((4, 4))]))
+        self.assertEqual(UtilsSnapshot.loadImage(mrcFilePath).max(), 0)
+        self.assertEqual(
+            UtilsSnapshot.loadImage(mrcFilePath, average=True).tolist(),
+            numpy.full((4, 4), 0.5).tolist(),
+        )
+        tiffFilePath = os.path.join(self.workingDir, "movie.tiff")
+        listFrame = [
+            Image.fromarray(numpy.full((4, 4), value, dtype=numpy.uint8))
+            for value in [0, 2, 4]
+        ]
+        listFrame[0].save(tiffFilePath, save_all=True, append_images=listFrame[1:])
+        self.assertEqual(UtilsSnapshot.loadImage(tiffFilePath, average=True)[0, 0], 2)
+
+    def test_binImage(self):
+        image = numpy.arange(5 * 7, dtype=numpy.float64).reshape(5, 7)
+        binned = UtilsSnapshot.binImage(image, 2)
+        self.assertEqual(binned.shape, (2, 3))
+        self.assertEqual(binned[0, 0], image[0:2, 0:2].mean())
+        self.assertIs(UtilsSnapshot.binImage(image, 1), image)
+
+    def test_createSnapshot(self):
+        mrcFilePath = os.path.join(self.workingDir, "movie.mrc")
+        data = numpy.zeros((3, 40, 60))
+        data[:, :, 30:] = 5.0
+        data[0, 0, 0] = 1000.0
+        writeMrc(mrcFilePath, data)
+        snapshotPath = os.path.join(self.workingDir, "movie.jpg")
+        UtilsSnapshot.createSnapshot(
+            mrcFilePath,
+            snapshotPath,
+            average=True,
+            truncate=(0, 1),
+            minmax=(0, 1),
+            binning=10,
+        )
+        with Image.open(snapshotPath) as snapshot:
+            self.assertEqual(snapshot.format, "JPEG")
+            self.assertEqual(snapshot.size, (6, 4))
+            pixels = numpy.asarray(snapshot)
+        self.assertLess(pixels[:, :2].max(), 30)
+        self.assertGreater(pixels[:, 4:].min(), 225)
+        self.assertFalse(os.path.exists(snapshotPath + ".tmp"))
+
+    def test_createSnapshot_minmax(self):
+        # Power spectrum rendered in the 0-300 window, as 'bimg -minmax 0,300'
+        mrcFilePath = os.path.join(self.workingDir, "ctf.mrc")
+        data = numpy.zeros((16, 48))
+        data[:, 16:32] = 150.0
+        data[:, 32:] = 3000.0
+        writeMrc(mrcFilePath, data)
+        snapshotPath = os.path.join(self.workingDir, "ctf.jpg")
+        UtilsSnapshot.createSnapshot(mrcFilePath, snapshotPath, minmax=(0, 300))
+        with Image.open(snapshotPath) as snapshot:
+            pixels = numpy.asarray(snapshot).astype(numpy.int64)
+        self.assertLess(pixels[:, 4:12].max(), 10)
+        self.assertLess(abs(int(numpy.median(pixels[:, 20:28])) - 128), 10)
+        self.assertGreater(pixels[:, 36:].min(), 245)
+        with self.assertRaises(RuntimeError):
+            UtilsSnapshot.createSnapshot(mrcFilePath, snapshotPath, minmax=(300, 0))
+
+    def test_createSpectraImageSnapshot(self):
+        mrcFileBase = "movie_aligned_mic"
+        writeMrc(
+            os.path.join(self.workingDir, mrcFileBase + "_ctf.mrc"),
+            numpy.random.default_rng(0).random((32, 32)),
+        )
+        spectraPath, snapshotPath = UtilsPath.createSpectraImageSnapshot(
+            self.workingDir, mrcFileBase
+        )
+        self.assertTrue(os.path.exists(snapshotPath))
+        # Not a MRC file
+        with open(spectraPath, "w") as fd:
+            fd.write("Not a MRC file")
+        _, snapshotPath = UtilsPath.createSpectraImageSnapshot(
+            self.workingDir, mrcFileBase
+        )
+        self.assertIsNone(snapshotPath)
+
+    def test_snapshotCache(self):
+        mrcFilePath = os.path.join(self.workingDir, "search.mrc")
+        writeMrc(mrcFilePath, numpy.random.default_rng(0).random((2, 64, 64)))
+        os.makedirs(os.path.join(self.workingDir, "gallery"))
+        snapshotPath1 = os.path.join(self.workingDir, "search.jpg")
+        snapshotPath2 = os.path.join(self.workingDir, "gallery", "search.jpg")
+        UtilsSnapshot.createCachedSnapshot(
+            mrcFilePath, snapshotPath1, average=True, binning=6
+        )
+        with unittest.mock.patch.object(
+            UtilsSnapshot, "createSnapshot", side_effect=AssertionError
+        ):
+            # Same source and parameters: handed out from the cache
+            UtilsSnapshot.createCachedSnapshot(
+                mrcFilePath, snapshotPath2, average=True, binning=6
+            )
+            # A new cache instance, as after a restart, finds the entry
+            UtilsSnapshot.setCache(SnapshotCache(self.cacheDir))
+            UtilsSnapshot.createCachedSnapshot(
+                mrcFilePath, snapshotPath2, average=True, binning=6
+            )
+            self.assertTrue(os.path.samefile(snapshotPath1, snapshotPath2))
+            with self.assertRaises(AssertionError):
+                UtilsSnapshot.createCachedSnapshot(
+                    mrcFilePath, snapshotPath2, average=True, binning=4
+                )
+        # A modified source is rendered again
+        stat = os.stat(mrcFilePath)
+        os.utime(mrcFilePath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        UtilsSnapshot.createCachedSnapshot(
+            mrcFilePath, snapshotPath2, average=True, binning=6
+        )
+        self.assertFalse(os.path.samefile(snapshotPath1, snapshotPath2))
+
+    def test_snapshotCache_evict(self):
+        listMrcFilePath = []
+        for index in range(3):
+            mrcFilePath = os.path.join(self.workingDir, "image_{0}.mrc".format(index))
+            writeMrc(mrcFilePath, numpy.random.default_rng(index).random((64, 64)))
+            listMrcFilePath.append(mrcFilePath)
+        snapshotCache = SnapshotCache(self.cacheDir, maxSize=10**9)
+        snapshotPath = os.path.join(self.workingDir, "snapshot.jpg")
+        for mrcFilePath in listMrcFilePath:
+            snapshotCache.getSnapshot(mrcFilePath, snapshotPath)
+        # Keep the first one recently used, room for two entries only
+        time.sleep(0.01)
+        snapshotCache.getSnapshot(listMrcFilePath[0], snapshotPath)
+        snapshotCache.maxSize = snapshotCache.totalSize * 2 // 3 + 1
+        snapshotCache.getSnapshot(listMrcFilePath[2], snapshotPath, binning=2)
+        self.assertLessEqual(snapshotCache.totalSize, snapshotCache.maxSize)
+        self.assertTrue(
+            os.path.exists(
+                snapshotCache.getEntryPath(snapshotCache.getKey(listMrcFilePath[0], {}))
+            )
+        )
+        self.assertFalse(
+            os.path.exists(
+                snapshotCache.getEntryPath(snapshotCache.getKey(listMrcFilePath[1], {}))
+            )
+        )
+
+    def test_benchmark_createSnapshot(self):
+        noImages = 5
+        mrcFilePath = os.path.join(self.workingDir, "search.mrc")
+        writeMrc(mrcFilePath, numpy.random.default_rng(0).random((4, 1024, 1024)) * 100)
+        startTime = time.time()
+        for index in range(noImages):
+            legacyCreateSnapshot(
+                mrcFilePath, os.path.join(self.workingDir, "legacy.jpg"), 6
+            )
+        legacyTime = time.time() - startTime
+        startTime = time.time()
+        for index in range(noImages):
+            UtilsSnapshot.createSnapshot(
+                mrcFilePath,
+                os.path.join(self.workingDir, "snapshot.jpg"),
+                average=True,
+                binning=6,
+            )
+        snapshotTime = time.time() - startTime
+        print(
+            "{0} snapshots: subprocesses {1:.3f} s, in-process {2:.3f} s".format(
+                noImages, legacyTime, snapshotTime
+            )
+        )
+        self.assertLess(snapshotTime, legacyTime)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,183 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from esrf.utils import esrf_utils_star
+from esrf.utils.esrf_utils_star import UtilsStar
+from esrf.utils.esrf_utils_path import UtilsPath
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), "testdata")
+PARTICLES_STAR_PATH = os.path.join(TEST_DATA_DIR, "input_particles.star")
+MODEL_STAR_PATH = os.path.join(TEST_DATA_DIR, "relion_it025_model.star")
+
+
+class Test(unittest.TestCase):
+    def test_getLoop(self):
+        starLoop = UtilsStar.getLoop(PARTICLES_STAR_PATH, "particles")
+        self.assertEqual(len(starLoop.labels), 13)
+        self.assertEqual(starLoop.labels[3], "rlnMicrographName")
+        with open(PARTICLES_STAR_PATH) as fd:
+            fd.seek(starLoop.dataOffset)
+            self.assertTrue(fd.readline().startswith(" 1 "))
+        with self.assertRaises(RuntimeError):
+            UtilsStar.getLoop(PARTICLES_STAR_PATH, "model_classes")
+        with self.assertRaises(RuntimeError):
+            UtilsStar.getLoop(MODEL_STAR_PATH, "model_general")
+
+    def test_getValues(self):
+        dictValues = UtilsStar.getValues(MODEL_STAR_PATH, "model_general")
+        self.assertEqual(dictValues["rlnNrClasses"], "3")
+        self.assertEqual(dictValues["rlnLogLikelihood"], "1.107547e+07")
+
+    def test_iterRows(self):
+        iterRows = UtilsStar.iterRows(
+            PARTICLES_STAR_PATH, "particles", ["_rlnImageId", "rlnCoordinateX"]
+        )
+        self.assertEqual(next(iterRows), {"rlnImageId": "1", "rlnCoordinateX": "501"})
+        self.assertEqual(len(list(iterRows)), 2020)
+        # Rows of the following blocks are not included
+        listRow = list(UtilsStar.iterRows(MODEL_STAR_PATH, "model_classes"))
+        self.assertEqual(len(listRow), 3)
+        self.assertEqual(listRow[2]["rlnEstimatedResolution"], "15.428571")
+        with self.assertRaises(RuntimeError):
+            next(UtilsStar.iterRows(MODEL_STAR_PATH, "model_classes", ["rlnUnknown"]))
+
+    def test_getFirstAndLastRow(self):
+        self.assertEqual(
+            UtilsStar.getFirstRow(PARTICLES_STAR_PATH, "optics", ["rlnVoltage"]),
+            {"rlnVoltage": "300.000000"},
+        )
+        dictRow = UtilsStar.getLastRow(PARTICLES_STAR_PATH, "particles")
+        self.assertEqual(dictRow["rlnImageId"], "2021")
+        self.assertEqual(
+            dictRow, list(UtilsStar.iterRows(PARTICLES_STAR_PATH, "particles"))[-1]
+        )
+        # Not the last block of the file
+        dictRow = UtilsStar.getLastRow(
+            MODEL_STAR_PATH, "model_classes", ["rlnClassDistribution"]
+        )
+        self.assertEqual(dictRow, {"rlnClassDistribution": "0.231562"})
+
+    def test_getLastRow_tailOnly(self):
+        workingDir = tempfile.mkdtemp(prefix="UtilsStar_")
+        starFilePath = os.path.join(workingDir, "particles.star")
+        with open(starFilePath, "w") as fd:
+            fd.write("data_particles\n\nloop_\n_rlnImageId #1\n_rlnCoordinateX #2\n")
+            for index in range(100000):
+                fd.write("{0} {1}\n".format(index + 1, index % 1000))
+            fd.write("\n\n")
+        try:
+            self.assertGreater(
+                os.path.getsize(starFilePath), 10 * esrf_utils_star.TAIL_SIZE
+            )
+            # The loop isn't streamed through
+            with unittest.mock.patch.object(
+                UtilsStar, "iterRows", side_effect=AssertionError
+            ):
+                self.assertEqual(
+                    UtilsStar.getLastRow(starFilePath, "particles", ["rlnImageId"]),
+                    {"rlnImageId": "100000"},
+                )
+        finally:
+            shutil.rmtree(workingDir)
+
+    def test_loadColumns(self):
+        dictColumns = UtilsStar.loadColumns(
+            PARTICLES_STAR_PATH,
+            "particles",
+            ["rlnImageId", "rlnDefocusU", "rlnMicrographName"],
+        )
+        self.assertEqual(dictColumns["rlnImageId"].dtype.kind, "i")
+        self.assertEqual(dictColumns["rlnImageId"][-1], 2021)
+        self.assertEqual(dictColumns["rlnDefocusU"].dtype.kind, "f")
+        self.assertEqual(dictColumns["rlnMicrographName"].dtype.kind, "U")
+        self.assertEqual(len(dictColumns["rlnMicrographName"]), 2021)
+
+    def test_parseModel(self):
+        UtilsStar.clearCache()
+        relionModel = UtilsStar.parseModel(MODEL_STAR_PATH)
+        self.assertEqual(relionModel.numberOfClasses, 3)
+        self.assertEqual(relionModel.general["rlnPixelSize"], "3.000000")
+        arrayClasses = relionModel.classes
+        self.assertEqual(arrayClasses.shape, (3,))
+        self.assertEqual(arrayClasses["rlnClassDistribution"].dtype.kind, "f")
+        self.assertAlmostEqual(arrayClasses["rlnEstimatedResolution"][1], 11.571429)
+        self.assertFalse(arrayClasses.flags.writeable)
+        self.assertIs(relionModel, UtilsStar.parseModel(MODEL_STAR_PATH))
+
+    def test_parseModel_reorderedColumns(self):
+        workingDir = tempfile.mkdtemp(prefix="UtilsStar_")
+        modelStarFilePath = os.path.join(workingDir, "relion_it025_model.star")
+        with open(MODEL_STAR_PATH) as fd:
+            listLine = fd.read().split("\n")
+        # Swap the first two labels and their values
+        indexLabel = listLine.index("_rlnReferenceImage #1 ")
+        listLine[indexLabel : indexLabel + 2] = [
+            "_rlnClassDistribution #1",
+            "_rlnReferenceImage #2",
+        ]
+        for index in range(indexLabel + 8, indexLabel + 11):
+            listValue = listLine[index].split()
+            listLine[index] = " ".join([listValue[1], listValue[0]] + listValue[2:])
+        with open(modelStarFilePath, "w") as fd:
+            fd.write("\n".join(listLine))
+        try:
+            self.assertEqual(
+                UtilsPath.parseRelionModelStarFile(modelStarFilePath),
+                UtilsPath.parseRelionModelStarFile(MODEL_STAR_PATH),
+            )
+        finally:
+            shutil.rmtree(workingDir)
+
+    def test_findLatestModelStarFile(self):
+        workingDir = tempfile.mkdtemp(prefix="UtilsStar_")
+        try:
+            self.assertIsNone(UtilsStar.findLatestModelStarFile(workingDir))
+            for fileName in [
+                "relion_it000_model.star",
+                "relion_it025_model.star",
+                "relion_it025_data.star",
+                "relion_it100_optimiser.star",
+                "relion_ct25_it050_model.star",
+            ]:
+                open(os.path.join(workingDir, fileName), "w").close()
+            self.assertEqual(
+                UtilsPath.findLatestRelionModelStarFile(workingDir),
+                os.path.join(workingDir, "relion_ct25_it050_model.star"),
+            )
+        finally:
+            shutil.rmtree(workingDir)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,173 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import time
+import shutil
+import signal
+import tempfile
+import unittest
+import threading
+
+from esrf.utils.esrf_utils_journal import UtilsJournal
+from esrf.utils.esrf_utils_state import StateWriter, UtilsState
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp(prefix="test_esrf_utils_state_")
+        self.jsonFilePath = os.path.join(self.tempDir, "allParams.json")
+        self.allParams = UtilsState.load(self.jsonFilePath)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def test_coalesce(self):
+        stateWriter = StateWriter(self.allParams, interval=0.5).start()
+        try:
+            for index in range(100):
+                self.allParams["movie_{0}".format(index)] = {"movieId": index}
+                stateWriter.markDirty()
+            # First update written at once, the others after the interval
+            time.sleep(0.8)
+            self.assertIn(stateWriter.noWrites, [1, 2])
+            self.assertEqual(len(UtilsJournal.read(self.jsonFilePath)), 100)
+        finally:
+            stateWriter.stop()
+
+    def test_flush(self):
+        stateWriter = StateWriter(self.allParams, interval=60).start()
+        try:
+            self.allParams["movie_1"] = {"movieId": 1}
+            stateWriter.markDirty()
+            self.allParams["movie_2"] = {"movieId": 2}
+            stateWriter.markDirty()
+            stateWriter.flush()
+            self.assertEqual(
+                list(UtilsJournal.read(self.jsonFilePath)), ["movie_1", "movie_2"]
+            )
+            # Pending updates are written when stopped
+            self.allParams["movie_3"] = {"movieId": 3}
+            stateWriter.markDirty()
+        finally:
+            stateWriter.stop()
+        self.assertFalse(stateWriter.thread.is_alive())
+        self.assertIn("movie_3", UtilsJournal.read(self.jsonFilePath))
+
+    def test_signal(self):
+        listSignal = []
+
+        def testHandler(signalNumber, frame):
+            listSignal.append(signalNumber)
+
+        previousHandler = signal.signal(signal.SIGUSR1, testHandler)
+        try:
+            stateWriter = StateWriter(self.allParams, interval=60).start()
+            self.assertTrue(stateWriter.installSignalHandlers([signal.SIGUSR1]))
+            self.allParams["movie_1"] = {"movieId": 1}
+            stateWriter.markDirty()
+            os.kill(os.getpid(), signal.SIGUSR1)
+            self.assertEqual(listSignal, [signal.SIGUSR1])
+            self.assertTrue(stateWriter.isStopped)
+            self.assertIn("movie_1", UtilsJournal.read(self.jsonFilePath))
+            # The previous handler is back
+            self.assertIs(signal.getsignal(signal.SIGUSR1), testHandler)
+        finally:
+            signal.signal(signal.SIGUSR1, previousHandler)
+
+    def test_signalRestored(self):
+        previousHandler = signal.getsignal(signal.SIGUSR2)
+        stateWriter = StateWriter(self.allParams, interval=60).start()
+        self.assertTrue(stateWriter.installSignalHandlers([signal.SIGUSR2]))
+        self.assertIsNot(signal.getsignal(signal.SIGUSR2), previousHandler)
+        stateWriter.stop()
+        self.assertIs(signal.getsignal(signal.SIGUSR2), previousHandler)
+        # Not from another thread
+        stateWriter = StateWriter(self.allParams, interval=60)
+        listResult = []
+        thread = threading.Thread(
+            target=lambda: listResult.append(
+                stateWriter.installSignalHandlers([signal.SIGUSR2])
+            )
+        )
+        thread.start()
+        thread.join()
+        self.assertEqual(listResult, [False])
+        self.assertIs(signal.getsignal(signal.SIGUSR2), previousHandler)
+
+    def test_writeFailed(self):
+        stateWriter = StateWriter(self.allParams, interval=0.05)
+        writeChanges = self.allParams.writeChanges
+        listCall = []
+
+        def failedWriteChanges(dictChanged, listDeleted):
+            listCall.append(dictChanged)
+            if len(listCall) == 1:
+                raise OSError(28, "No space left on device")
+            writeChanges(dictChanged, listDeleted)
+
+        self.allParams.writeChanges = failedWriteChanges
+        stateWriter.start()
+        self.allParams["movie_1"] = {"movieId": 1}
+        with self.assertLogs("esrf.utils.esrf_utils_state", "WARNING"):
+            stateWriter.markDirty()
+            startTime = time.time()
+            while len(listCall) < 2 and time.time() - startTime < 5:
+                time.sleep(0.01)
+        stateWriter.stop()
+        self.assertIn("movie_1", UtilsJournal.read(self.jsonFilePath))
+
+    def test_benchmark_markDirty(self):
+        # Cost on the monitor side of an update, legacy is a synchronous flush
+        noUpdates = 2000
+        stateWriter = StateWriter(self.allParams, interval=0.2).start()
+        try:
+            startTime = time.time()
+            for index in range(noUpdates):
+                self.allParams["movie_{0}".format(index)] = {"movieId": index}
+                stateWriter.markDirty()
+            asyncTime = time.time() - startTime
+        finally:
+            stateWriter.stop()
+        noWrites = stateWriter.noWrites
+        startTime = time.time()
+        for index in range(noUpdates):
+            self.allParams["movie_{0}".format(index)]["CTFid"] = index
+            self.allParams.flush()
+        syncTime = time.time() - startTime
+        print(
+            "{0} updates: synchronous {1:.3f} s, state writer {2:.3f} s "
+            "({3} writes)".format(noUpdates, syncTime, asyncTime, noWrites)
+        )
+        self.assertLess(noWrites, noUpdates)
+        self.assertLess(asyncTime, syncTime)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
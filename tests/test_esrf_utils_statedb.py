@@ -0,0 +1,212 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import json
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import collections
+
+from esrf.utils import esrf_utils_state
+from esrf.utils import esrf_utils_statedb
+from esrf.utils.esrf_utils_journal import UtilsJournal
+from esrf.utils.esrf_utils_state import UtilsState
+from esrf.utils.esrf_utils_statedb import ParamsDatabase, UtilsStateDb
+
+
+def getAllParams(noGridSquares, noMoviesPerGridSquare):
+    # Entries as written by the ISPyB monitor
+    allParams = collections.OrderedDict()
+    allParams["config_dict_20240101-120000"] = {"proposal": "mx415"}
+    allParams["EM_meta_data"] = {"EM_directory": "/data"}
+    for gridIndex in range(noGridSquares):
+        gridSquare = "GridSquare_{0}".format(gridIndex)
+        allParams[gridSquare] = {"lastMovieTime": 1000.0 + gridIndex}
+        for index in range(noMoviesPerGridSquare):
+            movieName = "FoilHole_{0}_{1}".format(gridIndex, index)
+            allParams[movieName] = {
+                "movieFullPath": "/data/{0}/Data/{1}.tiff".format(
+                    gridSquare, movieName
+                ),
+                "gridSquare": gridSquare,
+                "movieId": gridIndex * 1000 + index,
+                "archived": gridIndex == 0,
+            }
+    allParams["GridSquare_0 [2024-01-01 12:30:00]"] = {"EM_position_x": 1.0}
+    return allParams
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp(prefix="test_esrf_utils_statedb_")
+        self.jsonFilePath = os.path.join(self.tempDir, "allParams.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def test_getTable(self):
+        self.assertEqual(
+            UtilsStateDb.getTable("config_dict_20240101-120000", {}),
+            esrf_utils_statedb.CONFIGS,
+        )
+        self.assertEqual(
+            UtilsStateDb.getTable("GridSquare_1", {}), esrf_utils_statedb.GRID_SQUARES
+        )
+        self.assertEqual(
+            UtilsStateDb.getTable("GridSquare_1 [2024-01-01 12:30:00]", {}),
+            esrf_utils_statedb.DATASETS,
+        )
+        self.assertEqual(
+            UtilsStateDb.getTable("movie", {"movieFullPath": "/data/movie.tiff"}),
+            esrf_utils_statedb.MOVIES,
+        )
+        self.assertEqual(
+            UtilsStateDb.getTable("EM_meta_data", {}), esrf_utils_statedb.OTHERS
+        )
+
+    def test_importJson(self):
+        allParams = getAllParams(3, 4)
+        with open(self.jsonFilePath, "w") as fd:
+            fd.write(json.dumps(allParams, indent=4))
+        params = UtilsState.load(self.jsonFilePath, backend=esrf_utils_state.SQLITE)
+        self.assertIsInstance(params, ParamsDatabase)
+        self.assertEqual(params, allParams)
+        self.assertEqual(list(params), list(allParams))
+        params.close()
+        connection = sqlite3.connect(UtilsStateDb.getDatabasePath(self.jsonFilePath))
+        self.assertEqual(
+            connection.execute("SELECT COUNT(*) FROM movies").fetchone()[0], 12
+        )
+        self.assertEqual(
+            connection.execute("SELECT COUNT(*) FROM grid_squares").fetchone()[0], 3
+        )
+        connection.close()
+        # The database is used from now on
+        self.assertEqual(
+            UtilsState.getBackend(self.jsonFilePath), esrf_utils_state.SQLITE
+        )
+        self.assertEqual(UtilsState.read(self.jsonFilePath), allParams)
+
+    def test_queries(self):
+        params = UtilsState.load(self.jsonFilePath, backend=esrf_utils_state.SQLITE)
+        params.update(getAllParams(3, 4))
+        self.assertEqual(
+            params.findMovie("/data/GridSquare_1/Data/FoilHole_1_2.tiff"),
+            "FoilHole_1_2",
+        )
+        self.assertIsNone(params.findMovie("/data/unknown.tiff"))
+        self.assertEqual(
+            params.listGridSquareNotArchived(), ["GridSquare_1", "GridSquare_2"]
+        )
+        self.assertEqual(
+            params.listMovie(gridSquare="GridSquare_2"),
+            ["FoilHole_2_{0}".format(index) for index in range(4)],
+        )
+        self.assertEqual(len(params.listMovie(missingStage="CTFid")), 12)
+        # In place updates are seen by the queries
+        params["FoilHole_1_0"]["CTFid"] = 5
+        for index in range(4):
+            params["FoilHole_1_{0}".format(index)]["archived"] = True
+        self.assertEqual(len(params.listMovie(missingStage="CTFid")), 11)
+        self.assertEqual(params.listGridSquareNotArchived(), ["GridSquare_2"])
+        self.assertEqual(
+            params.listDataset("GridSquare_0"), ["GridSquare_0 [2024-01-01 12:30:00]"]
+        )
+        with self.assertRaises(RuntimeError):
+            params.listMovie(missingStage="unknown")
+        del params["FoilHole_2_0"]
+        params[7] = {"done": True}
+        params.close()
+        dictParams = UtilsState.read(self.jsonFilePath)
+        self.assertNotIn("FoilHole_2_0", dictParams)
+        self.assertEqual(list(dictParams)[-1], "7")
+        self.assertEqual(dictParams["FoilHole_1_0"]["CTFid"], 5)
+
+    def test_deleteLoaded(self):
+        params = UtilsState.load(self.jsonFilePath, backend=esrf_utils_state.SQLITE)
+        params.update(getAllParams(1, 2))
+        params.close()
+        # Entries loaded from the database are deleted from it too
+        params = UtilsState.load(self.jsonFilePath, backend=esrf_utils_state.SQLITE)
+        del params["FoilHole_0_0"]
+        params.flush()
+        params.close()
+        params = UtilsState.load(self.jsonFilePath, backend=esrf_utils_state.SQLITE)
+        self.assertNotIn("FoilHole_0_0", params)
+        self.assertIsNone(params.findMovie("/data/GridSquare_0/Data/FoilHole_0_0.tiff"))
+        self.assertEqual(params.listMovie(gridSquare="GridSquare_0"), ["FoilHole_0_1"])
+        params.close()
+
+    def test_journalBackend(self):
+        params = UtilsState.load(self.jsonFilePath, backend=esrf_utils_state.JOURNAL)
+        params["movie"] = {"movieFullPath": "/data/movie.tiff"}
+        params.close()
+        self.assertFalse(UtilsStateDb.exists(self.jsonFilePath))
+        self.assertTrue(UtilsState.exists(self.jsonFilePath))
+        self.assertEqual(
+            UtilsState.read(self.jsonFilePath), UtilsJournal.read(self.jsonFilePath)
+        )
+
+    def test_benchmark_query(self):
+        allParams = getAllParams(100, 300)
+        params = UtilsState.load(self.jsonFilePath, backend=esrf_utils_state.SQLITE)
+        params.update(allParams)
+        params.flush()
+        listMovieFullPath = [
+            entry["movieFullPath"]
+            for entry in allParams.values()
+            if "movieFullPath" in entry
+        ][::300]
+        startTime = time.time()
+        for movieFullPath in listMovieFullPath:
+            [
+                key
+                for key, entry in allParams.items()
+                if isinstance(entry, dict)
+                and entry.get("movieFullPath") == movieFullPath
+            ]
+        scanTime = time.time() - startTime
+        startTime = time.time()
+        for movieFullPath in listMovieFullPath:
+            params.findMovie(movieFullPath)
+        queryTime = time.time() - startTime
+        print(
+            "{0} lookups in {1} entries: scan {2:.3f} s, index {3:.3f} s".format(
+                len(listMovieFullPath), len(allParams), scanTime, queryTime
+            )
+        )
+        params.close()
+        self.assertLess(queryTime, scanTime)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
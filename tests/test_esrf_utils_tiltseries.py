@@ -0,0 +1,208 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from esrf.utils import esrf_utils_tiltseries
+from esrf.utils.esrf_utils_tiltseries import TiltSeriesIndex
+from esrf.utils.esrf_utils_path import UtilsPath
+
+MOVIE_DIR = "/data/visitor/ihls3501/cm01/20230523/RAW_DATA/grid5-test-tomo-processing"
+LIST_TILT = [(1, 0.0), (2, 3.0), (3, -3.0), (4, -6.0), (5, 6.0)]
+
+
+def getMoviePath(tsName, movieNumber, tiltAngle):
+    return "{0}/{1}_{2:03d}_{3:.2f}_20230525_155045_fractions.tiff".format(
+        MOVIE_DIR, tsName, movieNumber, tiltAngle
+    )
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tiltSeriesIndex = TiltSeriesIndex()
+        for tsName in ["test_1", "test_2"]:
+            # Arrival order isn't the movie number order
+            for movieNumber, tiltAngle in reversed(LIST_TILT):
+                dictMovie = UtilsPath.getTSFileParameters(
+                    getMoviePath(tsName, movieNumber, tiltAngle)
+                )
+                self.assertTrue(
+                    self.tiltSeriesIndex.addTilt(
+                        dictMovie["movie_name"],
+                        dictMovie["ts_name"],
+                        dictMovie["movie_number"],
+                        dictMovie["tilt_angle"],
+                    )
+                )
+        self.listMovieName = [
+            UtilsPath.getTSFileParameters(getMoviePath("test_1", *tilt))["movie_name"]
+            for tilt in LIST_TILT
+        ]
+
+    def test_addTilt(self):
+        self.assertEqual(len(self.tiltSeriesIndex), 10)
+        self.assertFalse(
+            self.tiltSeriesIndex.addTilt(self.listMovieName[0], "test_1", 1, 0.0)
+        )
+        self.assertEqual(
+            self.tiltSeriesIndex.getSeriesName(self.listMovieName[0]), "test_1"
+        )
+        self.assertEqual(self.tiltSeriesIndex.listSeriesName(), ["test_1", "test_2"])
+        self.assertEqual(
+            self.tiltSeriesIndex.getFirstTilt("test_1"), self.listMovieName[0]
+        )
+        arrayTiltAngle, listMovieName = self.tiltSeriesIndex.getTiltAngles("test_1")
+        self.assertEqual(arrayTiltAngle.tolist(), [-6.0, -3.0, 0.0, 3.0, 6.0])
+        self.assertEqual(listMovieName[0], self.listMovieName[3])
+
+    def test_growth(self):
+        for index in range(esrf_utils_tiltseries.TILT_SERIES_CAPACITY * 2):
+            self.tiltSeriesIndex.addTilt("movie_{0}".format(index), "big", index, 0.0)
+        tiltSeries = self.tiltSeriesIndex.getSeries("big")
+        self.assertEqual(
+            tiltSeries.noTilts, 2 * esrf_utils_tiltseries.TILT_SERIES_CAPACITY
+        )
+        self.assertEqual(
+            tiltSeries.movieNumber[tiltSeries.noTilts - 1], tiltSeries.noTilts - 1
+        )
+        self.assertEqual(
+            len(
+                self.tiltSeriesIndex.getMissing("big", esrf_utils_tiltseries.STAGE_CTF)
+            ),
+            tiltSeries.noTilts,
+        )
+
+    def test_stages(self):
+        self.assertFalse(self.tiltSeriesIndex.isComplete("test_1"))
+        for movieName in self.listMovieName:
+            for stage in esrf_utils_tiltseries.LIST_STAGE:
+                self.tiltSeriesIndex.setStage(movieName, stage)
+                # Setting a stage twice doesn't count twice
+                self.tiltSeriesIndex.setStage(movieName, stage)
+            self.assertTrue(
+                self.tiltSeriesIndex.hasStage(
+                    movieName, esrf_utils_tiltseries.STAGE_CTF
+                )
+            )
+        self.assertTrue(self.tiltSeriesIndex.isComplete("test_1"))
+        self.assertFalse(self.tiltSeriesIndex.isComplete("test_2"))
+        self.assertFalse(self.tiltSeriesIndex.isComplete("unknown"))
+        self.tiltSeriesIndex.setExpectedTilts("test_1", 41)
+        self.assertFalse(self.tiltSeriesIndex.isComplete("test_1"))
+        self.assertEqual(
+            self.tiltSeriesIndex.getMissing(
+                "test_1", esrf_utils_tiltseries.STAGE_MOTION_CORRECTION
+            ),
+            [],
+        )
+        self.assertFalse(
+            self.tiltSeriesIndex.hasStage("unknown", esrf_utils_tiltseries.STAGE_MOVIE)
+        )
+
+    def test_isComplete_quiescence(self):
+        for movieName in self.listMovieName:
+            for stage in esrf_utils_tiltseries.LIST_STAGE:
+                self.tiltSeriesIndex.setStage(movieName, stage)
+        # Number of tilts unknown: still being acquired until quiet
+        self.assertFalse(self.tiltSeriesIndex.isComplete("test_1", quiescence=600))
+        tiltSeries = self.tiltSeriesIndex.getSeries("test_1")
+        tiltSeries.lastTiltTime -= 601
+        self.assertTrue(self.tiltSeriesIndex.isComplete("test_1", quiescence=600))
+        # Known number of tilts
+        tiltSeries.lastTiltTime += 601
+        self.tiltSeriesIndex.setExpectedTilts("test_1", 5)
+        self.assertTrue(self.tiltSeriesIndex.isComplete("test_1", quiescence=600))
+
+    def test_getTiltSerieNoTilts(self):
+        movieDir = tempfile.mkdtemp(prefix="test_esrf_utils_tiltseries_")
+        try:
+            self.assertIsNone(UtilsPath.getTiltSerieNoTilts(movieDir, "test_1"))
+            with open(os.path.join(movieDir, "test_1.mdoc"), "w") as fd:
+                fd.write("PixelSpacing = 1.1\n")
+                for index, (_, tiltAngle) in enumerate(LIST_TILT):
+                    fd.write(
+                        "\n[ZValue = {0}]\nTiltAngle = {1}\n".format(index, tiltAngle)
+                    )
+            self.assertEqual(UtilsPath.getTiltSerieNoTilts(movieDir, "test_1"), 5)
+        finally:
+            shutil.rmtree(movieDir)
+
+    def test_getMissing(self):
+        for movieName in self.listMovieName[1:3]:
+            self.tiltSeriesIndex.setStage(
+                movieName, esrf_utils_tiltseries.STAGE_MOTION_CORRECTION
+            )
+        self.assertEqual(
+            self.tiltSeriesIndex.getMissing(
+                "test_1", esrf_utils_tiltseries.STAGE_MOTION_CORRECTION
+            ),
+            [self.listMovieName[0], self.listMovieName[3], self.listMovieName[4]],
+        )
+
+    def test_fromAllParams(self):
+        allParams = {
+            "EM_meta_data": {"EM_voltage": 300000},
+            "grid1_Position_1_001_0.00_20230301_171849_fractions": {
+                "ts_name": "grid1_Position_1",
+                "movie_number": 1,
+                "tilt_angle": 0.0,
+                "raw_movie_archived": True,
+                "mc_archived": True,
+                "search_path": "/tmp/Search/grid1_Position_1_Search.jpg",
+                "directory": "/tmp/RAW_DATA/grid1",
+            },
+            "grid1_Position_1_002_3.00_20230301_172010_fractions": {
+                "ts_name": "grid1_Position_1",
+                "movie_number": 2,
+                "tilt_angle": 3.0,
+                "raw_movie_archived": True,
+            },
+        }
+        tiltSeriesIndex = TiltSeriesIndex.fromAllParams(allParams)
+        self.assertEqual(len(tiltSeriesIndex), 2)
+        self.assertEqual(
+            tiltSeriesIndex.getMissing(
+                "grid1_Position_1", esrf_utils_tiltseries.STAGE_MOTION_CORRECTION
+            ),
+            ["grid1_Position_1_002_3.00_20230301_172010_fractions"],
+        )
+        self.assertEqual(
+            tiltSeriesIndex.getSeries("grid1_Position_1").searchPath,
+            "/tmp/Search/grid1_Position_1_Search.jpg",
+        )
+        self.assertEqual(
+            tiltSeriesIndex.getSeries("grid1_Position_1").directory,
+            "/tmp/RAW_DATA/grid1",
+        )
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
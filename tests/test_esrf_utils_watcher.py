@@ -0,0 +1,102 @@
+# coding: utf-8
+# **************************************************************************
+# *
+# * Author:     Olof Svensson (svensson@esrf.fr) [1]
+# *
+# * [1] European Synchrotron Radiation Facility
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from esrf.utils.esrf_utils_watcher import FileArrivalWatcher
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp(prefix="Data_")
+
+    def tearDown(self):
+        shutil.rmtree(self.dataDir)
+
+    def createFilesLater(self, delay, listName):
+        def createFiles():
+            time.sleep(delay)
+            for name in listName:
+                open(os.path.join(self.dataDir, name), "w").close()
+
+        thread = threading.Thread(target=createFiles)
+        thread.start()
+        return thread
+
+    def isReady(self, listName):
+        return lambda: all(
+            os.path.exists(os.path.join(self.dataDir, name)) for name in listName
+        )
+
+    def runWatcher(self, watcher):
+        listLate = ["movie1.jpg", "movie1.xml"]
+        watcher.add("movie1", [self.dataDir], self.isReady(listLate), timeout=10)
+        watcher.add("movie2", [self.dataDir], self.isReady(["movie2.xml"]), timeout=0.5)
+        self.assertIn("movie1", watcher)
+        self.assertEqual(len(watcher), 2)
+        # Nothing there yet, poll doesn't block
+        startTime = time.time()
+        self.assertEqual(watcher.poll(), ([], []))
+        self.assertLess(time.time() - startTime, 0.1)
+        thread = self.createFilesLater(1.0, listLate)
+        dictResult = {}
+        while len(watcher) > 0 and time.time() - startTime < 10:
+            listReady, listTimedOut = watcher.wait(1.0)
+            for key in listReady:
+                dictResult[key] = ("ready", time.time() - startTime)
+            for key in listTimedOut:
+                dictResult[key] = ("timeout", time.time() - startTime)
+        thread.join()
+        watcher.close()
+        # movie2 times out while movie1 is still waiting
+        self.assertEqual(dictResult["movie2"][0], "timeout")
+        self.assertEqual(dictResult["movie1"][0], "ready")
+        self.assertLess(dictResult["movie2"][1], dictResult["movie1"][1])
+        self.assertGreaterEqual(dictResult["movie1"][1], 1.0)
+        return dictResult["movie1"][1]
+
+    def test_inotify(self):
+        watcher = FileArrivalWatcher(pollInterval=60.0)
+        if watcher.inotify is None:
+            self.skipTest("inotify not available")
+        # Files seen through inotify events, long before the next poll
+        self.assertLess(self.runWatcher(watcher), 3.0)
+
+    def test_polling(self):
+        watcher = FileArrivalWatcher(pollInterval=0.2, useInotify=False)
+        self.assertIsNone(watcher.inotify)
+        self.assertLess(self.runWatcher(watcher), 3.0)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()